@@ -0,0 +1,269 @@
+# asyncio transports for the RPC clients in rpc.py
+#
+# The Partial*Client classes only ever call self.make_call() and return its
+# result, so they can be combined with these transports exactly like with
+# the blocking ones; every procedure then returns a coroutine:
+#
+#     async with AsyncTCPMountClient(host) as mount_client:
+#         status, fh = await mount_client.mount('/export')
+#
+# Each client keeps a single connection on which any number of calls can be
+# outstanding; replies are matched to their callers by xid.
+
+import asyncio
+import socket
+import threading
+import time
+
+import rpc
+from rpc import Client, PartialPortMapperClient, PMAP_PROG, PMAP_VERS, IPPROTO_TCP, IPPROTO_UDP, \
+    LAST_FRAGMENT, record_header
+
+
+class AsyncClient(Client):
+
+    def __init__(self, host, prog, vers, port):
+        # Unlike Client.__init__ nothing is connected here, see connect()
+        self.host = host
+        self.prog = prog
+        self.vers = vers
+        self.port = port
+        self.last_xid = 0
+        self.packer = None
+        self.unpacker = None
+        self.addpackers()
+        self.cred = None
+        self.verf = None
+        self.call_templates = {}
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.reader_error = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        # This MUST be overridden
+        raise RuntimeError('connect not defined')
+
+    async def close(self):
+        raise RuntimeError('close not defined')
+
+    async def make_call(self, proc, args, pack_func, unpack_func):
+        if pack_func is None and args is not None:
+            raise TypeError('non-null args with null pack_func')
+        # Packing never yields to the loop, so the shared packer is safe here
+        self.start_call(proc)
+        if pack_func:
+            pack_func(args)
+        xid = self.last_xid
+        call = self.call_record(proc)
+        future = asyncio.get_running_loop().create_future()
+        with self.pending_lock:
+            if self.reader_error is not None:
+                raise self.reader_error
+            self.pending[xid] = (future, unpack_func, call)
+        try:
+            await self.send_call(xid, self.packer.get_buffers())
+            return await future
+        except (OSError, RuntimeError) as e:
+            if not future.done():
+                # Failed before a reply came, dispatch_reply did not see it
+                self.observe_call(call, 0, error=e)
+            raise
+        finally:
+            with self.pending_lock:
+                self.pending.pop(xid, None)
+
+
+# Client using TCP to a specific port
+
+class AsyncRawTCPClient(AsyncClient):
+
+    def __init__(self, host, prog, vers, port):
+        AsyncClient.__init__(self, host, prog, vers, port)
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.read_task = asyncio.ensure_future(self.read_replies())
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def send_call(self, xid, call):
+        self.writer.write(record_header.pack(sum(memoryview(buf).nbytes for buf in call) | LAST_FRAGMENT))
+        self.writer.writelines(call)
+        await self.writer.drain()
+
+    async def recvrecord(self):
+        frags = []
+        last = False
+        while not last:
+            x, = record_header.unpack(await self.reader.readexactly(record_header.size))
+            last = (x & LAST_FRAGMENT) != 0
+            frags.append(await self.reader.readexactly(x & ~LAST_FRAGMENT))
+        return frags[0] if len(frags) == 1 else b''.join(frags)
+
+    async def read_replies(self):
+        try:
+            while True:
+                self.dispatch_reply(await self.recvrecord())
+        except (asyncio.IncompleteReadError, OSError) as e:
+            self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} lost: {e!r}'))
+        except asyncio.CancelledError:
+            self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} closed'))
+            raise
+
+
+# Client using UDP to a specific port
+
+class AsyncUDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        try:
+            self.client.dispatch_reply(data)
+        except Exception:
+            # Garbage datagrams must not kill the endpoint
+            pass
+
+    def error_received(self, exc):
+        # e.g. an ICMP port unreachable; the server may be back for the next calls
+        self.client.fail_outstanding(exc)
+
+
+class AsyncRawUDPClient(AsyncClient):
+    # Retransmissions before giving up; timeouts come from an rpc.RTTEstimator
+    retries = 5
+    procedure_classes = {}
+
+    def __init__(self, host, prog, vers, port):
+        AsyncClient.__init__(self, host, prog, vers, port)
+        self.transport = None
+        self.rtt = None
+
+    async def connect(self):
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: AsyncUDPProtocol(self), remote_addr=(self.host, self.port), family=socket.AF_INET)
+        self.rtt = rpc.get_rtt_estimator(self.host, self.port, self.prog, self.vers)
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} closed'))
+
+    def fail_outstanding(self, error):
+        # Unlike fail_pending the endpoint remains usable
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future, _, call in pending.values():
+            if not future.done():
+                self.observe_call(call, 0, error=error)
+                future.set_exception(error)
+
+    async def send_call(self, xid, call):
+        with self.pending_lock:
+            future = self.pending[xid][0]
+        call = b''.join(call)
+        proc = rpc.call_header.unpack_from(call)[5]
+        key = self.procedure_classes.get(proc, proc)
+        timeout = self.rtt.timeout(key)
+        sent = time.monotonic()
+        for retry in range(self.retries + 1):
+            self.transport.sendto(call)
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                timeout = min(timeout * 2, self.rtt.maximum)
+                if self.metrics is not None and retry < self.retries:
+                    self.metrics.retransmitted(self.prog, self.vers, proc)
+                continue
+            if retry == 0:
+                self.rtt.sample(key, time.monotonic() - sent)
+            return
+        raise RuntimeError('timeout')
+
+
+class AsyncTCPPortMapperClient(PartialPortMapperClient, AsyncRawTCPClient):
+
+    def __init__(self, host):
+        AsyncRawTCPClient.__init__(self, host, PMAP_PROG, PMAP_VERS, rpc.PMAP_PORT)
+
+
+class AsyncUDPPortMapperClient(PartialPortMapperClient, AsyncRawUDPClient):
+
+    def __init__(self, host):
+        AsyncRawUDPClient.__init__(self, host, PMAP_PROG, PMAP_VERS, rpc.PMAP_PORT)
+
+
+async def get_port(host, prog, vers, prot):
+    """
+    Ask the port mapper on host for the port of the given program, unless rpc.port_cache
+    already knows it
+    :param prot: IPPROTO_TCP or IPPROTO_UDP
+    """
+    port = rpc.port_cache.get(host, prog, vers, prot)
+    if port is not None:
+        return port
+    pmap_class = AsyncTCPPortMapperClient if prot == IPPROTO_TCP else AsyncUDPPortMapperClient
+    async with pmap_class(host) as pmap:
+        port = await pmap.get_port((prog, vers, prot, 0))
+    if port == 0:
+        raise RuntimeError('program not registered')
+    rpc.port_cache.set(host, prog, vers, prot, port)
+    return port
+
+
+# Generic clients that find their server through the Port mapper
+
+class AsyncTCPClient(AsyncRawTCPClient):
+
+    def __init__(self, host, prog, vers):
+        AsyncRawTCPClient.__init__(self, host, prog, vers, None)
+
+    async def connect(self):
+        self.port = await get_port(self.host, self.prog, self.vers, IPPROTO_TCP)
+        try:
+            await AsyncRawTCPClient.connect(self)
+        except ConnectionRefusedError:
+            # The service may have been restarted on another port
+            rpc.port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_TCP)
+            self.port = await get_port(self.host, self.prog, self.vers, IPPROTO_TCP)
+            await AsyncRawTCPClient.connect(self)
+
+    async def make_call(self, proc, args, pack_func, unpack_func):
+        try:
+            return await AsyncRawTCPClient.make_call(self, proc, args, pack_func, unpack_func)
+        except rpc.ProgUnavail:
+            rpc.port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_TCP)
+            raise
+
+
+class AsyncUDPClient(AsyncRawUDPClient):
+
+    def __init__(self, host, prog, vers):
+        AsyncRawUDPClient.__init__(self, host, prog, vers, None)
+
+    async def connect(self):
+        self.port = await get_port(self.host, self.prog, self.vers, IPPROTO_UDP)
+        await AsyncRawUDPClient.connect(self)
+
+    async def make_call(self, proc, args, pack_func, unpack_func):
+        try:
+            return await AsyncRawUDPClient.make_call(self, proc, args, pack_func, unpack_func)
+        except rpc.ProgUnavail:
+            rpc.port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_UDP)
+            raise
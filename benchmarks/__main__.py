@@ -0,0 +1,11 @@
+"""
+Run every benchmark with its default parameters, no network or filer needed.
+
+Run from the repository root:
+    python -m benchmarks
+"""
+from benchmarks import bench_callheader, bench_codecs, bench_locks, bench_nfsfile, bench_wrapper, bench_xdr
+
+for benchmark in (bench_codecs, bench_xdr, bench_callheader, bench_nfsfile, bench_wrapper, bench_locks):
+    print(f'== {benchmark.__name__}')
+    benchmark.main()
@@ -0,0 +1,104 @@
+"""
+Cost of starting a call and packing the arguments of small RPCs (GETATTR,
+LOOKUP): call header templates with the xid patched in, against packing the
+whole header, AUTH_UNIX credential included, for every call.
+
+Run from the repository root:
+    python -m benchmarks.bench_callheader [calls]
+"""
+import sys
+import timeit
+
+import rpc
+from nfsclient import NFS_PROGRAM, NFS_VERSION, PartialNFSClient
+from packer_arguments import get_packer_arguments
+
+
+class OfflineNFSClient(PartialNFSClient, rpc.Client):
+    # Packs calls exactly like NFSClient, but never sends them
+
+    def __init__(self):
+        rpc.Client.__init__(self, 'localhost', NFS_PROGRAM, NFS_VERSION, 0)
+
+    def make_socket(self):
+        self.sock = None
+
+    def bind_socket(self):
+        pass
+
+    def connect_socket(self):
+        pass
+
+    def mkcred(self):
+        if self.cred is None:
+            self.cred = rpc.AuthFlavor.AUTH_UNIX.value, rpc.make_auth_unix(0, 'benchmark-host', 1000, 1000,
+                                                                            [1000, 4, 24, 27])
+        return self.cred
+
+    def make_call(self, proc, args, pack_func, unpack_func):
+        self.start_call(proc)
+        if pack_func:
+            pack_func(args)
+        return self.packer.get_buffers()
+
+
+class PerCallHeaderClient(OfflineNFSClient):
+    # The way calls were started before the header templates
+
+    def start_call(self, proc):
+        self.last_xid = xid = self.last_xid + 1
+        cred = self.mkcred()
+        verf = self.mkverf()
+        packer = self.packer
+        packer.reset()
+        packer.pack_callheader(xid, self.prog, self.vers, proc, cred, verf)
+
+
+FH = bytes(range(32))
+
+
+def getattr_call(client):
+    return client.getattr(FH)
+
+
+LOOKUP_ARGS = get_packer_arguments("LOOKUP", dir=FH, name='some-file.txt')["what"]
+
+
+def lookup_call(client):
+    return client.lookup(LOOKUP_ARGS)
+
+
+def function_calls(call, client):
+    """
+    :return: Python and builtin function calls made to pack one call, each a potential allocation
+    """
+    calls = [0]
+
+    def count(frame, event, arg):
+        if event in ('call', 'c_call'):
+            calls[0] += 1
+
+    sys.setprofile(count)
+    try:
+        call(client)
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+
+def main(calls=100000, repeat=5):
+    template_client = OfflineNFSClient()
+    per_call_client = PerCallHeaderClient()
+    for call in (getattr_call, lookup_call):
+        assert b''.join(call(template_client)) == b''.join(call(per_call_client))
+        results = {}
+        for name, client in (('per-call', per_call_client), ('template', template_client)):
+            best = min(timeit.repeat(lambda: call(client), number=calls, repeat=repeat))
+            results[name] = best / calls
+            print(f'{call.__name__:>13} {name:>9}: {results[name] * 1e6:6.2f} us per call, '
+                  f'{function_calls(call, client):3} function calls')
+        print(f'{call.__name__:>13} speedup: {results["per-call"] / results["template"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,76 @@
+"""
+Cost of the XDR codecs: packing and unpacking the basic types, the compiled
+structure layouts and the RPC headers with rpc.Packer and rpc.Unpacker.
+
+Run from the repository root:
+    python -m benchmarks.bench_codecs [operations]
+"""
+import sys
+import timeit
+
+import rpc
+from nfsclient import NFSUnpacker, fattr3
+
+ATTRIBUTES = (1, 0o644, 1, 1000, 1000, 4096, 4096, 0, 1, 1234, (1, 2), (3, 4), (5, 6))
+NAME = b'some-file-name.txt'
+SMALL_OPAQUE = bytes(32)
+LARGE_OPAQUE = bytes(65536)
+CRED = rpc.AuthFlavor.AUTH_UNIX.value, rpc.make_auth_unix(0, 'benchmark-host', 1000, 1000, [1000, 4, 24, 27])
+VERF = rpc.AuthFlavor.AUTH_NULL.value, rpc.make_auth_null()
+
+
+def packed(pack):
+    packer = rpc.Packer()
+    pack(packer)
+    return packer.get_buffer()
+
+
+def pack_cases():
+    return [
+        ('uint', lambda p: p.pack_uint(123456)),
+        ('uhyper', lambda p: p.pack_uhyper(1 << 40)),
+        ('string', lambda p: p.pack_string(NAME)),
+        ('opaque 32 B', lambda p: p.pack_opaque(SMALL_OPAQUE)),
+        ('opaque 64 KiB', lambda p: p.pack_opaque(LARGE_OPAQUE)),
+        ('opaque_ref 64 KiB', lambda p: p.pack_opaque_ref(LARGE_OPAQUE)),
+        ('fattr3 struct', lambda p: p.pack_struct(fattr3, ATTRIBUTES)),
+        ('call header', lambda p: p.pack_callheader(1, 100003, 3, 1, CRED, VERF)),
+        ('reply header', lambda p: p.pack_replyheader(1, VERF)),
+    ]
+
+
+def unpack_cases():
+    return [
+        ('uint', packed(lambda p: p.pack_uint(123456)), lambda u: u.unpack_uint()),
+        ('uhyper', packed(lambda p: p.pack_uhyper(1 << 40)), lambda u: u.unpack_uhyper()),
+        ('string', packed(lambda p: p.pack_string(NAME)), lambda u: u.unpack_string()),
+        ('opaque 32 B', packed(lambda p: p.pack_opaque(SMALL_OPAQUE)), lambda u: u.unpack_opaque()),
+        ('opaque 64 KiB', packed(lambda p: p.pack_opaque(LARGE_OPAQUE)), lambda u: u.unpack_opaque()),
+        ('fattr3 struct', packed(lambda p: p.pack_struct(fattr3, ATTRIBUTES)), lambda u: u.unpack_fattr3()),
+        ('call header', packed(lambda p: p.pack_callheader(1, 100003, 3, 1, CRED, VERF)),
+         lambda u: u.unpack_callheader()),
+        ('reply header', packed(lambda p: p.pack_replyheader(1, VERF)), lambda u: u.unpack_replyheader()),
+    ]
+
+
+def report(direction, name, seconds, operations):
+    print(f'{direction:>6} {name:>18}: {seconds / operations * 1e9:8.1f} ns   {operations / seconds:12.0f} ops/s')
+
+
+def main(operations=200000, repeat=5):
+    packer = rpc.Packer()
+    for name, pack in pack_cases():
+        def run():
+            packer.reset()
+            pack(packer)
+        report('pack', name, min(timeit.repeat(run, number=operations, repeat=repeat)), operations)
+    unpacker = NFSUnpacker(b'')
+    for name, data, unpack in unpack_cases():
+        def run():
+            unpacker.reset(data)
+            unpack(unpacker)
+        report('unpack', name, min(timeit.repeat(run, number=operations, repeat=repeat)), operations)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,57 @@
+"""
+How long a blocked NLM lock waits after the conflicting lock is released,
+against an in-process memserver.MemoryServer: the server calls NLM_GRANTED
+back on the wrapper's callback server, so the wait ends within a round-trip
+instead of at the next poll.
+
+Run from the repository root:
+    python -m benchmarks.bench_locks [latency in ms] [locks]
+"""
+import sys
+import threading
+import time
+
+import rpc
+from benchmarks.bench_wrapper import percentile
+from memserver import MemoryServer
+from nfs_nlm_wrapper import NFSClientWrapper
+
+EXPORT = '/export'
+HOLD = 0.05
+
+
+def main(latency_ms=0.5, locks=20):
+    with MemoryServer(latency=latency_ms / 1000) as server:
+        rpc.PMAP_PORT = server.port
+        server.make_file(EXPORT, 'file', b'')
+        # Connections and handles a benchmark run before this one left for its own server
+        NFSClientWrapper.pool.close()
+        NFSClientWrapper.export_handles.clear()
+        wrapper = NFSClientWrapper()
+        callback_server = wrapper._get_callback_server()
+        granted_before = callback_server.granted_by_callback
+        delays = []
+        for i in range(locks):
+            wrapper.exposed_lock(server.host, EXPORT, 'file', 'holder', 'localhost', offset=i, length=1)
+            statuses = []
+            waiter = threading.Thread(target=lambda: statuses.append(wrapper.exposed_lock(
+                server.host, EXPORT, 'file', 'waiter', 'localhost', offset=i, length=1, block=True, timeout=10)))
+            waiter.start()
+            time.sleep(HOLD)
+            released = time.perf_counter()
+            wrapper.exposed_unlock(server.host, EXPORT, 'file', 'holder', 'localhost', offset=i, length=1)
+            waiter.join()
+            delays.append(time.perf_counter() - released)
+            if statuses != ['NLM4_GRANTED']:
+                raise RuntimeError(f'the blocked lock ended with {statuses}')
+            wrapper.exposed_unlock(server.host, EXPORT, 'file', 'waiter', 'localhost', offset=i, length=1)
+        delays.sort()
+        print(f'{latency_ms} ms per reply, {locks} blocked locks, callback server registered: '
+              f'{callback_server.registered}')
+        print(f'{"granted after release":>22}: p50 {percentile(delays, 0.5) * 1e3:8.3f} ms   '
+              f'p99 {percentile(delays, 0.99) * 1e3:8.3f} ms   '
+              f'{callback_server.granted_by_callback - granted_before} by NLM_GRANTED')
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]], *[int(arg) for arg in sys.argv[2:3]])
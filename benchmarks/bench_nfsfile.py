@@ -0,0 +1,61 @@
+"""
+Sequential write and read throughput of nfsio.NFSFile against an in-process
+memserver.MemoryServer. Also checks that data appended to a file read to its
+end (one whole READ long, so the end of file is known to the read-ahead) is
+read back.
+
+Run from the repository root:
+    python -m benchmarks.bench_nfsfile [latency in ms] [MiB]
+"""
+import os
+import sys
+import time
+
+import rpc
+from memserver import MemoryServer
+from nfsclient import NFSClient
+from nfsio import NFSFile
+
+EXPORT = '/export'
+BLOCK = 65536
+
+
+def measure(name, operation, size):
+    started = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - started
+    print(f'{name:>22}: {size / elapsed / 1048576:9.1f} MiB/s   {elapsed * 1e3:9.1f} ms')
+
+
+def main(latency_ms=0.5, mebibytes=16):
+    data = os.urandom(mebibytes * 1048576)
+    with MemoryServer(latency=latency_ms / 1000) as server:
+        rpc.PMAP_PORT = server.port
+        fh = server.make_file(EXPORT, 'file', b'').fh
+        appended_fh = server.make_file(EXPORT, 'appended', b'x' * server.transfer_size).fh
+        client = NFSClient(server.host)
+        try:
+            print(f'{latency_ms} ms per reply, {mebibytes} MiB')
+            with NFSFile(client, fh) as f:
+                def write():
+                    for start in range(0, len(data), BLOCK):
+                        f.write(data[start:start + BLOCK])
+                    f.flush()
+                measure('write', write, len(data))
+                f.seek(0)
+                read = []
+                measure('read', lambda: read.extend(iter(lambda: f.read(BLOCK), b'')), len(data))
+                if b''.join(read) != data:
+                    raise RuntimeError('the data read back differs from the data written')
+            with NFSFile(client, appended_fh) as f:
+                f.read()
+                f.write(b'y' * 100)
+                f.seek(server.transfer_size)
+                if f.read() != b'y' * 100:
+                    raise RuntimeError('the data appended after reading to the end of file is not read back')
+        finally:
+            client.close()
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,77 @@
+"""
+Throughput and latency of NFSClientWrapper operations against an in-process
+memserver.MemoryServer, which holds back every reply by the given latency to
+stand in for the network and the filer.
+
+Run from the repository root:
+    python -m benchmarks.bench_wrapper [latency in ms] [calls per operation]
+"""
+import os
+import sys
+import time
+
+import rpc
+from memserver import MemoryServer
+from nfs_nlm_wrapper import NFSClientWrapper
+
+EXPORT = '/export'
+# An export of its own, so creating files elsewhere does not change the listing
+LISTING_EXPORT = '/listing'
+FILES = 1000
+LISTING_FILES = 100
+SMALL = b'x' * 100
+LARGE = os.urandom(4 * 1024 * 1024)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def measure(name, operation, calls):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(calls):
+        call_started = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f'{name:>22}: {calls / elapsed:9.1f} ops/s   p50 {percentile(latencies, 0.5) * 1e3:8.3f} ms   '
+          f'p99 {percentile(latencies, 0.99) * 1e3:8.3f} ms')
+
+
+def operations(wrapper, host):
+    """
+    :return: [(name, operation)], operation being called with the number of the call
+    """
+    paths = [f'dir{i % 10}/file{i}' for i in range(FILES)]
+    return [
+        ('create_file', lambda i: wrapper.exposed_create_file(host, EXPORT, f'created/file{i}')),
+        ('lookup_file', lambda i: wrapper.exposed_lookup_file(host, EXPORT, paths[i % FILES])),
+        ('lookup_files x100', lambda i: wrapper.exposed_lookup_files(host, EXPORT, paths[i % 10::10])),
+        ('write_to_file 100 B', lambda i: wrapper.exposed_write_to_file(host, EXPORT, paths[i % FILES], SMALL)),
+        ('read_file 100 B', lambda i: wrapper.exposed_read_file(host, EXPORT, paths[i % FILES])),
+        ('write_to_file 4 MiB', lambda i: wrapper.exposed_write_to_file(host, EXPORT, 'large', LARGE)),
+        ('read_file 4 MiB', lambda i: wrapper.exposed_read_file(host, EXPORT, 'large')),
+        (f'list_dir {LISTING_FILES} entries', lambda i: wrapper.list_dir(host, LISTING_EXPORT)),
+        ('lock + unlock', lambda i: (wrapper.exposed_lock(host, EXPORT, paths[0], f'owner{i}', 'bench'),
+                                     wrapper.exposed_unlock(host, EXPORT, paths[0], f'owner{i}', 'bench'))),
+    ]
+
+
+def main(latency_ms=0.5, calls=200):
+    with MemoryServer(latency=latency_ms / 1000) as server:
+        rpc.PMAP_PORT = server.port
+        server.make_directory(EXPORT, 'created')
+        for i in range(FILES):
+            server.make_file(EXPORT, f'dir{i % 10}/file{i}', SMALL)
+        for i in range(LISTING_FILES):
+            server.make_file(LISTING_EXPORT, f'file{i}', SMALL)
+        wrapper = NFSClientWrapper()
+        print(f'{latency_ms} ms per reply, {calls} calls per operation')
+        for name, operation in operations(wrapper, server.host):
+            measure(name, operation, calls)
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]], *[int(arg) for arg in sys.argv[2:3]])
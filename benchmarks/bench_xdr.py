@@ -0,0 +1,112 @@
+"""
+Decoding cost of READDIRPLUS replies: compiled xdr.Struct layouts against the
+former one-method-call-per-field unpacking, and the columnar decoding of
+nfscolumns.
+
+Run from the repository root:
+    python -m benchmarks.bench_xdr [entries per reply]
+"""
+import sys
+import timeit
+
+from nfscolumns import ColumnarListing
+from nfsclient import NFSUnpacker, NfsStat3, fattr3
+from rpc import Packer
+
+
+class PerFieldUnpacker(NFSUnpacker):
+    # The way fattr3 and entryplus3 were decoded before the layouts were compiled
+
+    def unpack_fattr3(self):
+        _type = self.unpack_enum()
+        mode = self.unpack_uint()
+        nlink = self.unpack_uint()
+        uid = self.unpack_uint()
+        gid = self.unpack_uint()
+        size = self.unpack_uhyper()
+        used = self.unpack_uhyper()
+        rdev = self.unpack_uhyper()
+        fsid = self.unpack_uhyper()
+        fileid = self.unpack_uhyper()
+        atime = self.unpack_timeval()
+        mtime = self.unpack_timeval()
+        ctime = self.unpack_timeval()
+        return _type, mode, nlink, uid, gid, size, used, rdev, fsid, fileid, atime, mtime, ctime
+
+    def unpack_timeval(self):
+        secs = self.unpack_uint()
+        usecs = self.unpack_uint()
+        return (secs, usecs)
+
+    def unpack_entry(self):
+        file_id = self.unpack_uhyper()
+        name = self.unpack_string()
+        cookie = self.unpack_uhyper()
+        return file_id, name, cookie
+
+    def unpack_entry_plus(self):
+        fh = None
+        fileid, name, cookie = self.unpack_entry()
+        entry_attr = self.unpack_obj_attributes()
+        handle_follow = self.unpack_bool()
+        if handle_follow:
+            fh = self.unpack_fh_attributes()
+        return fileid, name, cookie, entry_attr, fh
+
+
+def make_readdirplus_reply(entries):
+    packer = Packer()
+    packer.pack_enum(NfsStat3.NFS3_OK.value)
+    attributes = (2, 0o755, 2, 0, 0, 4096, 4096, 0, 1, 1, (1, 0), (2, 0), (3, 0))
+    packer.pack_bool(True)
+    packer.pack_struct(fattr3, attributes)
+    packer.pack_uhyper(0)
+    for i in range(entries):
+        packer.pack_bool(True)
+        packer.pack_uhyper(i + 100)
+        packer.pack_string(f'file-{i:08}.dat'.encode())
+        packer.pack_uhyper(i + 1)
+        packer.pack_bool(True)
+        packer.pack_struct(fattr3, (1, 0o644, 1, 1000, 1000, i, i, 0, 1, i + 100, (i, 0), (i, 0), (i, 0)))
+        packer.pack_bool(True)
+        packer.pack_opaque(i.to_bytes(32, 'big'))
+    packer.pack_bool(False)
+    packer.pack_bool(True)
+    return memoryview(packer.get_buf())
+
+
+def decode(unpacker_class, reply):
+    unpacker = unpacker_class(reply)
+    result = unpacker.unpack_readdirplus()
+    unpacker.done()
+    return result
+
+
+def decode_columns(reply):
+    listing = ColumnarListing()
+    unpacker = NFSUnpacker(reply)
+    unpacker.unpack_readdirplus_columns(listing)
+    unpacker.done()
+    return listing
+
+
+def main(entries=1000, repeat=5):
+    reply = make_readdirplus_reply(entries)
+    assert decode(NFSUnpacker, reply) == decode(PerFieldUnpacker, reply)
+    assert list(decode_columns(reply)) == decode(NFSUnpacker, reply)[2][0]
+    number = max(1, 20000 // entries)
+    results = {}
+    for name, function in (('per-field', lambda: decode(PerFieldUnpacker, reply)),
+                           ('compiled', lambda: decode(NFSUnpacker, reply)),
+                           ('columnar', lambda: decode_columns(reply))):
+        best = min(timeit.repeat(function, number=number, repeat=repeat))
+        results[name] = best / number
+        print(f'{name:>10}: {results[name] * 1e3:8.3f} ms per reply, '
+              f'{entries * number / best:12,.0f} entries/s')
+    print(f'speedup: {results["per-field"] / results["compiled"]:.2f}x compiled, '
+          f'{results["per-field"] / results["columnar"]:.2f}x columnar '
+          f'({entries} entries, {len(reply)} bytes per reply)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ClientPool:
+    """
+    Thread-safe pool of connected RPC clients, kept per (client class, host).
+    At most max_size clients exist per key; clients idle for more than max_idle seconds are closed,
+    and clients idle for more than health_check_interval seconds are checked with a NULL call
+    before being handed out again.
+
+        with pool.client(NFSClient, host) as nfs_client:
+            nfs_client.getattr(fh)
+    """
+
+    def __init__(self, max_size=8, max_idle=60, health_check_interval=10, wait_timeout=30):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Condition()
+        self.idle = defaultdict(list)       # key -> [(client, last used)], most recent last
+        self.in_use = defaultdict(int)
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    @contextmanager
+    def client(self, client_class, host):
+        client = self.acquire(client_class, host)
+        try:
+            yield client
+        except (OSError, EOFError):
+            # The connection is broken, don't hand it out again
+            self.discard(client_class, host, client)
+            raise
+        except BaseException:
+            self.release(client_class, host, client)
+            raise
+        else:
+            self.release(client_class, host, client)
+
+    def acquire(self, client_class, host):
+        key = (client_class, host)
+        deadline = time.monotonic() + self.wait_timeout
+        with self.lock:
+            self._evict_idle(key)
+            while not self.idle[key] and self.in_use[key] >= self.max_size:
+                self.counters[key]['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    raise PoolExhausted(f'no {client_class.__name__} for {host} within '
+                                        f'{self.wait_timeout}s ({self.max_size} in use)')
+            self.in_use[key] += 1
+            candidates = self.idle[key]
+            self.idle[key] = []
+        try:
+            client = self._reuse(key, candidates)
+            if client is None:
+                client = client_class(host)
+                self._count(key, 'created')
+        except BaseException:
+            with self.lock:
+                self.in_use[key] -= 1
+                self.lock.notify()
+            raise
+        return client
+
+    def _reuse(self, key, candidates):
+        # Take the most recently used idle client, give the rest back
+        client = None
+        now = time.monotonic()
+        while candidates and client is None:
+            client, last_used = candidates.pop()
+            if now - last_used > self.health_check_interval and not self._healthy(key, client):
+                client = None
+        with self.lock:
+            self.idle[key] = candidates + self.idle[key]
+            if client is not None:
+                self.counters[key]['reused'] += 1
+        return client
+
+    def _healthy(self, key, client):
+        self._count(key, 'health_checks')
+        try:
+            client.call_0()
+            return True
+        except Exception:
+            self._count(key, 'health_check_failures')
+            self._close(client)
+            return False
+
+    def _count(self, key, counter):
+        with self.lock:
+            self.counters[key][counter] += 1
+
+    def release(self, client_class, host, client):
+        key = (client_class, host)
+        with self.lock:
+            self.in_use[key] -= 1
+            self.idle[key].append((client, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, client_class, host, client):
+        key = (client_class, host)
+        self._close(client)
+        with self.lock:
+            self.in_use[key] -= 1
+            self.counters[key]['discarded'] += 1
+            self.lock.notify()
+
+    def evict_idle(self):
+        with self.lock:
+            for key in list(self.idle):
+                self._evict_idle(key)
+
+    def _evict_idle(self, key):
+        # Called with the lock held
+        now = time.monotonic()
+        keep = []
+        for client, last_used in self.idle[key]:
+            if now - last_used > self.max_idle:
+                self._close(client)
+                self.counters[key]['evicted'] += 1
+            else:
+                keep.append((client, last_used))
+        self.idle[key] = keep
+
+    def close(self):
+        with self.lock:
+            for key, idle in self.idle.items():
+                for client, _ in idle:
+                    self._close(client)
+            self.idle.clear()
+
+    @staticmethod
+    def _close(client):
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def stats(self):
+        """
+        :return: {"<client class>@<host>": {"in_use": .., "idle": .., "created": .., ...}}
+        """
+        with self.lock:
+            keys = set(self.counters) | set(self.idle) | set(self.in_use)
+            return {f'{client_class.__name__}@{host}': dict(self.counters[(client_class, host)],
+                                                           in_use=self.in_use[(client_class, host)],
+                                                           idle=len(self.idle[(client_class, host)]))
+                    for client_class, host in keys}
@@ -0,0 +1,256 @@
+# Client-side state of the NLM byte-range locks held by this client.
+#
+# The server keeps locks per owner and merges the ranges an owner locks the
+# way POSIX does, so the client can know exactly what it holds: locking a
+# range the owner holds already, and unlocking one it does not hold, change
+# nothing on the server and need no call. After a server restart the held
+# locks are reclaimed during its grace period, one coalesced range per request
+# and all requests pipelined.
+#
+# A LOCK whose outcome is not known (its call failed, or a blocked request was
+# cancelled after it was sent) may have been granted anyway: its range is kept
+# as possibly held, so unlocking it is not skipped.
+#
+# The table only knows about the locks taken through it, so all locks of an
+# owner should be.
+
+import os
+import struct
+import threading
+import time
+from itertools import count
+
+from nlmclient import NLM4_Stats
+from packer_arguments import get_packer_arguments
+
+# Lock end of a range locked up to the end of the file (l_len 0), beyond any NLM4 offset
+TO_END = 1 << 64
+
+_cookie = struct.Struct('>II')
+
+
+def lock_range(offset, length):
+    """
+    :return: (start, end) of the range of an l_offset and l_len
+    """
+    return offset, offset + length if length else TO_END
+
+
+class LockTable:
+    """
+    Ranges granted to each owner: (host, fh, caller_name, owner) -> [[start, end, exclusive]],
+    sorted and coalesced (overlapping and adjacent ranges of the same mode are one range).
+    Ranges possibly held are kept apart, in uncertain, with the same keys.
+    Also hands out what identifies this client's requests: an svid per owner, a fresh cookie per
+    request and the NSM state.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ranges = {}
+        self.uncertain = {}             # (host, fh, caller_name, owner) -> [[start, end, None]]
+        self.svids = {}                 # (caller_name, owner) -> svid
+        self.next_svid = count(1)
+        self.cookies = count(1)
+        self.cookie_prefix = os.getpid() & 0xffffffff
+        # Odd like the state of a running NSM, and larger after a restart of this process
+        self.state = (int(time.time()) | 1) & 0x7fffffff
+        self.last_reclaim = {}          # host -> time.monotonic() of the last reclaim
+        self.hits = 0
+        self.calls = 0
+
+    def svid(self, caller_name, owner):
+        with self.lock:
+            svid = self.svids.get((caller_name, owner))
+            if svid is None:
+                svid = self.svids[(caller_name, owner)] = next(self.next_svid)
+            return svid
+
+    def cookie(self):
+        return _cookie.pack(self.cookie_prefix, next(self.cookies) & 0xffffffff)
+
+    def lock_arguments(self, caller_name, file_handle, owner, offset, length, exclusive, block=False,
+                       reclaim=False):
+        return get_packer_arguments("LOCK",
+                                    cookie=self.cookie(),
+                                    caller_name=caller_name,
+                                    block=block,
+                                    exclusive=exclusive,
+                                    fh=file_handle,
+                                    owner=owner,
+                                    svid=self.svid(caller_name, owner),
+                                    l_offset=offset,
+                                    l_len=length,
+                                    reclaim=reclaim,
+                                    state=self.state)
+
+    def unlock_arguments(self, caller_name, file_handle, owner, offset, length):
+        return get_packer_arguments("UNLOCK",
+                                    cookie=self.cookie(),
+                                    caller_name=caller_name,
+                                    fh=file_handle,
+                                    owner=owner,
+                                    svid=self.svid(caller_name, owner),
+                                    l_offset=offset,
+                                    l_len=length)
+
+    @staticmethod
+    def _key(host, arguments):
+        lock = arguments["lock"]
+        return (host, lock["fh"], lock["caller_name"], lock["owner"]), lock_range(lock["l_offset"], lock["l_len"])
+
+    def is_held(self, host, arguments):
+        """
+        :param arguments: of a LOCK call
+        :return: True if the owner holds the whole range in the mode asked for already, so the
+                 LOCK would not change anything
+        """
+        key, (start, end) = self._key(host, arguments)
+        exclusive = arguments["exclusive"]
+        with self.lock:
+            self.calls += 1
+            for range_start, range_end, range_exclusive in self.ranges.get(key, ()):
+                if range_end <= start:
+                    continue
+                if range_start > start or range_exclusive != exclusive:
+                    return False
+                start = range_end
+                if start >= end:
+                    self.hits += 1
+                    return True
+            return False
+
+    def is_unlocked(self, host, arguments):
+        """
+        :param arguments: of an UNLOCK call
+        :return: True if the owner holds nothing in the range, so the UNLOCK would not change anything
+        """
+        key, (start, end) = self._key(host, arguments)
+        with self.lock:
+            self.calls += 1
+            if any(range_start < end and start < range_end
+                   for range_start, range_end, _ in self.ranges.get(key, []) + self.uncertain.get(key, [])):
+                return False
+            self.hits += 1
+            return True
+
+    def locked(self, host, arguments):
+        """
+        Record a granted LOCK; it replaces what the owner held on the range, like on the server
+        """
+        key, (start, end) = self._key(host, arguments)
+        with self.lock:
+            self._set(self.uncertain, key, self._remove(self.uncertain.get(key, []), start, end))
+            ranges = self._remove(self.ranges.get(key, []), start, end)
+            ranges.append([start, end, arguments["exclusive"]])
+            ranges.sort()
+            coalesced = [ranges[0]]
+            for entry in ranges[1:]:
+                last = coalesced[-1]
+                if entry[0] <= last[1] and entry[2] == last[2]:
+                    last[1] = max(last[1], entry[1])
+                else:
+                    coalesced.append(entry)
+            self.ranges[key] = coalesced
+
+    def possibly_locked(self, host, arguments):
+        """
+        Record a LOCK that may have been granted without its reply being seen; it is not held as
+        far as is_held is concerned, but unlocking it is not skipped
+        """
+        key, (start, end) = self._key(host, arguments)
+        with self.lock:
+            self.uncertain.setdefault(key, []).append([start, end, None])
+
+    def unlocked(self, host, arguments):
+        key, (start, end) = self._key(host, arguments)
+        with self.lock:
+            self._set(self.ranges, key, self._remove(self.ranges.get(key, []), start, end))
+            self._set(self.uncertain, key, self._remove(self.uncertain.get(key, []), start, end))
+
+    @staticmethod
+    def _set(table, key, ranges):
+        if ranges:
+            table[key] = ranges
+        else:
+            table.pop(key, None)
+
+    @staticmethod
+    def _remove(ranges, start, end):
+        remaining = []
+        for range_start, range_end, exclusive in ranges:
+            if range_end <= start or range_start >= end:
+                remaining.append([range_start, range_end, exclusive])
+                continue
+            if range_start < start:
+                remaining.append([range_start, start, exclusive])
+            if range_end > end:
+                remaining.append([end, range_end, exclusive])
+        return remaining
+
+    def held(self, host):
+        """
+        :return: [(fh, caller_name, owner, offset, length, exclusive)] of every range held on host
+        """
+        with self.lock:
+            return [(fh, caller_name, owner, start, end - start if end != TO_END else 0, exclusive)
+                    for (lock_host, fh, caller_name, owner), ranges in self.ranges.items() if lock_host == host
+                    for start, end, exclusive in ranges]
+
+    def forget(self, host):
+        with self.lock:
+            for table in (self.ranges, self.uncertain):
+                for key in [key for key in table if key[0] == host]:
+                    del table[key]
+
+    def clear(self):
+        with self.lock:
+            self.ranges.clear()
+            self.uncertain.clear()
+            self.last_reclaim.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"owners": len(self.ranges),
+                    "ranges": sum(len(ranges) for ranges in self.ranges.values()),
+                    "uncertain": sum(len(ranges) for ranges in self.uncertain.values()),
+                    "calls": self.calls,
+                    "hits": self.hits}
+
+    def reclaim(self, nlm_client, host, min_interval=0):
+        """
+        Reclaim every lock held on host after the server restarted: one LOCK with reclaim set per
+        coalesced range, all pipelined over nlm_client. Ranges the server does not grant again are
+        dropped from the table.
+        :param min_interval: do nothing if host was reclaimed less than this many seconds ago,
+                             e.g. the length of a grace period
+        :return: (reclaimed, lost), lists of (fh, caller_name, owner, offset, length, exclusive)
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_reclaim.get(host, -min_interval) < min_interval:
+                return [], []
+            self.last_reclaim[host] = now
+        held = self.held(host)
+        futures = [nlm_client.lock_async(self.lock_arguments(caller_name, fh, owner, offset, length, exclusive,
+                                                             reclaim=True))
+                   for fh, caller_name, owner, offset, length, exclusive in held]
+        reclaimed = []
+        lost = []
+        for lock, future in zip(held, futures):
+            fh, caller_name, owner, offset, length, exclusive = lock
+            try:
+                granted = future.result() == NLM4_Stats.NLM4_GRANTED.value
+                failed = False
+            except (OSError, RuntimeError):
+                granted = False
+                failed = True
+            if granted:
+                reclaimed.append(lock)
+            else:
+                arguments = self.unlock_arguments(caller_name, fh, owner, offset, length)
+                self.unlocked(host, arguments)
+                if failed:
+                    self.possibly_locked(host, arguments)
+                lost.append(lock)
+        return reclaimed, lost
@@ -0,0 +1,656 @@
+# In-memory NFSv3, MOUNT v3, NLM v4 and portmap server.
+#
+# Serves the procedures the clients of this repository use, all four programs
+# on one port over both TCP and UDP, so the clients (and changes to them) can
+# be exercised and measured without a filer. Every reply can be held back by
+# a fixed latency to stand in for the network and the filer; calls are still
+# served as they arrive, so pipelined calls overlap like they would on a real
+# server.
+#
+#     with MemoryServer(latency=0.001) as server:
+#         rpc.PMAP_PORT = server.port
+#         server.make_file('/export', 'dir/file', b'data')
+#         wrapper = NFSClientWrapper()
+#         wrapper.exposed_read_file(server.host, '/export', 'dir/file')
+#
+# Any path can be mounted; each export is an empty directory tree created on
+# its first use. Blocked lock requests are granted with an NLM_GRANTED call to
+# the lock's caller_name, through the port mapper on that host. As the server
+# maps NLM to itself, a client's NLM callback service (nlmclient.NLMCallbackServer)
+# registering with it is kept apart and called on the port it registered.
+
+import heapq
+import os
+import struct
+import threading
+import time
+from itertools import count
+
+import rpc
+from mountclient import MOUNTPROG, MOUNTVERS
+from nfscache import NF3DIR
+from nfsclient import NFS_PROGRAM, NFS_VERSION, NfsStat3, CreateMode, fattr3, fsinfo3, wcc_attr
+from nlmclient import NLM_PROGRAM, NLM_VERSION, NLM4_Stats, NLMClient, RawNLMClient
+from rpc import IPPROTO_TCP, IPPROTO_UDP, PMAP_PROG, PMAP_VERS
+
+NF3REG = 1
+
+# FSINFO3resok properties: FSF3_LINK | FSF3_SYMLINK | FSF3_HOMOGENEOUS | FSF3_CANSETTIME
+FSF3_PROPERTIES = 0x1b
+
+# Bytes a reply needs beyond its entries: status, post_op_attr, verifier and the eof flag
+_READDIR_REPLY_OVERHEAD = 4 + 4 + fattr3.size + 8 + 4 + 4
+
+# Number of FALSE flags (no post_op_attr, no wcc_data before and after) following the status of
+# a failed NFS reply, by procedure
+_NFS_FAILURE_FLAGS = {1: 0, 3: 1, 6: 1, 7: 2, 8: 2, 9: 2, 12: 2, 16: 1, 17: 1, 19: 1, 21: 2}
+
+
+class NfsError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status.name)
+        self.status = status
+
+
+class MemoryNode:
+    """
+    A file or directory. Its handle is the server's instance id followed by the fileid, so the
+    handles of another server instance are stale.
+    """
+
+    def __init__(self, instance, fileid, file_type, mode, now):
+        self.fileid = fileid
+        self.fh = instance + struct.pack('>Q', fileid)
+        self.type = file_type
+        self.mode = mode
+        self.data = bytearray()
+        self.children = {} if file_type == NF3DIR else None    # name (bytes) -> MemoryNode
+        self.atime = self.mtime = self.ctime = now
+
+    def attributes(self):
+        size = len(self.data) if self.children is None else 4096
+        nlink = 2 if self.children is not None else 1
+        return (self.type, self.mode, nlink, 0, 0, size, size, 0, 1, self.fileid,
+                self.atime, self.mtime, self.ctime)
+
+    def wcc(self):
+        return len(self.data) if self.children is None else 4096, self.mtime, self.ctime
+
+    @property
+    def verifier(self):
+        # Cookie verifier of a directory: changes whenever its entries do
+        return struct.pack('>II', *self.mtime)
+
+
+class MemoryServer(rpc.Server):
+    """
+    :param latency: seconds every reply is held back
+    :param transfer_size: the rtmax, rtpref, wtmax and wtpref FSINFO announces
+    :param port: 0 to listen on any free port, see self.port
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, transfer_size=65536, dtpref=8192):
+        rpc.Server.__init__(self, host, port)
+        self.latency = latency
+        self.transfer_size = transfer_size
+        self.dtpref = dtpref
+        self.instance = os.urandom(8)
+        self.write_verifier = os.urandom(8)
+        self.fileids = count(1)
+        self.clock = 0
+        self.nodes = {}                 # fh -> MemoryNode
+        self.exports = {}               # path -> root MemoryNode
+        self.locks = {}                 # fh -> [(owner, start, end, exclusive)]
+        self.blocked = []               # blocking lock requests waiting, (fh, owner, start, end, exclusive)
+        self.grace_until = 0.0
+        self.mappings = {}              # (prog, vers, prot) -> port
+        self.callbacks = {}             # (prog, vers, prot) -> port, of clients serving a program served here
+        for prog, vers in ((MOUNTPROG, MOUNTVERS), (NFS_PROGRAM, NFS_VERSION), (NLM_PROGRAM, NLM_VERSION)):
+            for prot in (IPPROTO_TCP, IPPROTO_UDP):
+                self.mappings[(prog, vers, prot)] = self.port
+        self.programs = {
+            (PMAP_PROG, PMAP_VERS): {0: self.null, 1: self.pmap_set, 2: self.pmap_unset,
+                                     3: self.pmap_getport, 4: self.pmap_dump},
+            (MOUNTPROG, MOUNTVERS): {0: self.null, 1: self.mount_mnt, 3: self.mount_umnt,
+                                     4: self.mount_umntall, 5: self.mount_export},
+            (NFS_PROGRAM, NFS_VERSION): {0: self.null, 1: self.nfs_getattr, 3: self.nfs_lookup,
+                                         6: self.nfs_read, 7: self.nfs_write, 8: self.nfs_create,
+                                         9: self.nfs_mkdir, 12: self.nfs_remove, 16: self.nfs_readdir,
+                                         17: self.nfs_readdirplus, 19: self.nfs_fsinfo,
+                                         21: self.nfs_commit},
+            (NLM_PROGRAM, NLM_VERSION): {0: self.null, 1: self.nlm_test, 2: self.nlm_lock,
+                                         3: self.nlm_cancel, 4: self.nlm_unlock},
+        }
+        self.delayed = []               # heap of (due, sequence, send, reply)
+        self.delayed_changed = threading.Condition()
+        self.sequence = count()
+
+    def start(self):
+        rpc.Server.start(self)
+        threading.Thread(target=self.send_delayed, daemon=True).start()
+
+    def close(self):
+        rpc.Server.close(self)
+        with self.delayed_changed:
+            self.delayed_changed.notify()
+
+    # The file system
+
+    def now(self):
+        # Strictly increasing, so every change is seen in the mtime and ctime
+        self.clock = max(time.time_ns(), self.clock + 1)
+        return divmod(self.clock, 1000000000)
+
+    def new_node(self, file_type, mode):
+        node = MemoryNode(self.instance, next(self.fileids), file_type, mode, self.now())
+        self.nodes[node.fh] = node
+        return node
+
+    def export_root(self, path):
+        with self.lock:
+            root = self.exports.get(path)
+            if root is None:
+                root = self.exports[path] = self.new_node(NF3DIR, 0o755)
+            return root
+
+    def make_directory(self, export, path):
+        """
+        The directory at path under export, created along with its parents if missing
+        :return: its MemoryNode
+        """
+        with self.lock:
+            node = self.export_root(export)
+            for name in filter(None, path.split('/')):
+                name = name.encode()
+                child = node.children.get(name)
+                if child is None:
+                    child = self.add_child(node, name, NF3DIR, 0o755)
+                node = child
+            return node
+
+    def make_file(self, export, path, data=b''):
+        """
+        Create (or replace the data of) the file at path under export, and its directories
+        :return: its MemoryNode
+        """
+        with self.lock:
+            directory, _, name = path.rpartition('/')
+            parent = self.make_directory(export, directory)
+            node = parent.children.get(name.encode())
+            if node is None:
+                node = self.add_child(parent, name.encode(), NF3REG, 0o644)
+            node.data[:] = data
+            node.mtime = node.ctime = self.now()
+            return node
+
+    def add_child(self, parent, name, file_type, mode):
+        node = self.new_node(file_type, mode)
+        parent.children[name] = node
+        parent.mtime = parent.ctime = self.now()
+        return node
+
+    def reboot(self, grace_period=0.0):
+        """
+        Act as if the server restarted: the write verifier changes, so data written UNSTABLE
+        since the last COMMIT must be written again by the clients, and all locks are lost
+        :param grace_period: seconds after which locks can be taken again; until then only
+                             reclaims of the lost ones are granted
+        """
+        with self.lock:
+            self.write_verifier = os.urandom(8)
+            self.locks.clear()
+            self.blocked = []
+            self.grace_until = time.monotonic() + grace_period
+
+    # Replies
+
+    def reply(self, send, reply):
+        if not self.latency:
+            send(reply)
+            return
+        with self.delayed_changed:
+            heapq.heappush(self.delayed, (time.monotonic() + self.latency, next(self.sequence), send, reply))
+            self.delayed_changed.notify()
+
+    def send_delayed(self):
+        while True:
+            with self.delayed_changed:
+                while not self.closing and (not self.delayed or self.delayed[0][0] > time.monotonic()):
+                    self.delayed_changed.wait(self.delayed[0][0] - time.monotonic() if self.delayed else None)
+                if self.closing:
+                    return
+                _, _, send, reply = heapq.heappop(self.delayed)
+            try:
+                send(reply)
+            except OSError:
+                pass
+
+    # Port mapper
+
+    def pmap_set(self, unpacker, packer):
+        prog, vers, prot, port = unpacker.unpack_mapping()
+        key = (prog, vers, prot)
+        if self.mappings.get(key) == self.port and port != self.port:
+            # A callback service, e.g. for NLM_GRANTED, of a client on this host
+            packer.pack_bool(key not in self.callbacks)
+            self.callbacks.setdefault(key, port)
+            return
+        packer.pack_bool(key not in self.mappings)
+        self.mappings.setdefault(key, port)
+
+    def pmap_unset(self, unpacker, packer):
+        prog, vers, prot, port = unpacker.unpack_mapping()
+        # Only the mappings to port, unless it is 0, so a callback service does not unset the server
+        removed = [(mappings, key) for mappings in (self.callbacks, self.mappings)
+                   for key, mapped in mappings.items() if key[:2] == (prog, vers) and port in (0, mapped)]
+        for mappings, key in removed:
+            del mappings[key]
+        packer.pack_bool(bool(removed))
+
+    def pmap_getport(self, unpacker, packer):
+        prog, vers, prot, port = unpacker.unpack_mapping()
+        packer.pack_uint(self.mappings.get((prog, vers, prot), 0))
+
+    def pmap_dump(self, unpacker, packer):
+        packer.pack_pmaplist([key + (port,) for key, port in sorted(self.mappings.items())])
+
+    # MOUNT
+
+    def mount_mnt(self, unpacker, packer):
+        root = self.export_root(unpacker.unpack_string().decode(errors='surrogateescape'))
+        packer.pack_uint(0)
+        packer.pack_opaque(root.fh)
+        packer.pack_array([rpc.AuthFlavor.AUTH_UNIX.value], packer.pack_uint)
+
+    def mount_umnt(self, unpacker, packer):
+        unpacker.unpack_string()
+
+    def mount_umntall(self, unpacker, packer):
+        pass
+
+    def mount_export(self, unpacker, packer):
+        for path in sorted(self.exports):
+            packer.pack_bool(True)
+            packer.pack_string(path.encode(errors='surrogateescape'))
+            packer.pack_bool(False)
+        packer.pack_bool(False)
+
+    # NFS
+
+    def dispatch(self, prog, proc, procedure, unpacker, packer):
+        if prog != NFS_PROGRAM:
+            procedure(unpacker, packer)
+            return
+        header_size = len(packer.buf)
+        try:
+            procedure(unpacker, packer)
+        except NfsError as e:
+            del packer.buf[header_size:]
+            packer.pack_enum(e.status.value)
+            for _ in range(_NFS_FAILURE_FLAGS.get(proc, 0)):
+                packer.pack_bool(False)
+
+    def node(self, fh, directory=None):
+        """
+        :param directory: True if the node must be a directory, False if it must not be one
+        """
+        node = self.nodes.get(fh)
+        if node is None:
+            raise NfsError(NfsStat3.NFS3ERR_STALE)
+        if directory is True and node.children is None:
+            raise NfsError(NfsStat3.NFS3ERR_NOTDIR)
+        if directory is False and node.children is not None:
+            raise NfsError(NfsStat3.NFS3ERR_ISDIR)
+        return node
+
+    @staticmethod
+    def pack_post_op_attr(packer, node):
+        packer.pack_bool(True)
+        packer.pack_struct(fattr3, node.attributes())
+
+    def pack_wcc_data(self, packer, before, node):
+        packer.pack_bool(True)
+        packer.pack_struct(wcc_attr, before)
+        self.pack_post_op_attr(packer, node)
+
+    @staticmethod
+    def unpack_sattr(unpacker):
+        """
+        :return: (mode, size), None for the ones not to be set
+        """
+        mode = unpacker.unpack_uint() if unpacker.unpack_bool() else None
+        for _ in ('uid', 'gid'):
+            if unpacker.unpack_bool():
+                unpacker.unpack_uint()
+        size = unpacker.unpack_uhyper() if unpacker.unpack_bool() else None
+        for _ in ('atime', 'mtime'):
+            if unpacker.unpack_enum() == 2:         # SET_TO_CLIENT_TIME
+                unpacker.unpack_uint()
+                unpacker.unpack_uint()
+        return mode, size
+
+    def nfs_getattr(self, unpacker, packer):
+        node = self.node(unpacker.unpack_opaque())
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        packer.pack_struct(fattr3, node.attributes())
+
+    def nfs_lookup(self, unpacker, packer):
+        directory = self.node(unpacker.unpack_opaque(), directory=True)
+        node = directory.children.get(unpacker.unpack_string())
+        if node is None:
+            packer.pack_enum(NfsStat3.NFS3ERR_NOENT.value)
+            self.pack_post_op_attr(packer, directory)
+            return
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        packer.pack_opaque(node.fh)
+        self.pack_post_op_attr(packer, node)
+        self.pack_post_op_attr(packer, directory)
+
+    def nfs_read(self, unpacker, packer):
+        node = self.node(unpacker.unpack_opaque(), directory=False)
+        offset = unpacker.unpack_uhyper()
+        length = min(unpacker.unpack_uint(), self.transfer_size)
+        data = bytes(node.data[offset:offset + length])
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_post_op_attr(packer, node)
+        packer.pack_uint(len(data))
+        packer.pack_bool(offset + len(data) >= len(node.data))
+        packer.pack_opaque(data)
+
+    def nfs_write(self, unpacker, packer):
+        node = self.node(unpacker.unpack_opaque(), directory=False)
+        offset = unpacker.unpack_uhyper()
+        unpacker.unpack_uint()
+        stable = unpacker.unpack_enum()
+        data = unpacker.unpack_opaque()
+        if len(data) > self.transfer_size:
+            raise NfsError(NfsStat3.NFS3ERR_INVAL)
+        before = node.wcc()
+        if len(node.data) < offset:
+            node.data.extend(bytes(offset - len(node.data)))
+        node.data[offset:offset + len(data)] = data
+        node.mtime = node.ctime = self.now()
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_wcc_data(packer, before, node)
+        packer.pack_uint(len(data))
+        # Nothing is lost unless reboot() is called, so every write is as stable as asked for
+        packer.pack_enum(stable)
+        packer.pack_fopaque(8, self.write_verifier)
+
+    def _create(self, unpacker, packer, file_type):
+        directory = self.node(unpacker.unpack_opaque(), directory=True)
+        name = unpacker.unpack_string()
+        if file_type == NF3DIR:
+            how = CreateMode.UNCHECKED.value
+            mode, size = self.unpack_sattr(unpacker)
+        else:
+            how = unpacker.unpack_enum()
+            mode, size = (None, None) if how == CreateMode.EXCLUSIVE.value else self.unpack_sattr(unpacker)
+        before = directory.wcc()
+        node = directory.children.get(name)
+        if node is not None and (how == CreateMode.GUARDED.value or file_type == NF3DIR or node.type != file_type):
+            raise NfsError(NfsStat3.NFS3ERR_EXIST)
+        if node is None:
+            node = self.add_child(directory, name, file_type, 0o755 if file_type == NF3DIR else 0o644)
+        if mode is not None:
+            node.mode = mode
+        if size is not None and file_type == NF3REG:
+            del node.data[size:]
+            node.data.extend(bytes(size - len(node.data)))
+            node.mtime = node.ctime = self.now()
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        packer.pack_bool(True)
+        packer.pack_opaque(node.fh)
+        self.pack_post_op_attr(packer, node)
+        self.pack_wcc_data(packer, before, directory)
+
+    def nfs_create(self, unpacker, packer):
+        self._create(unpacker, packer, NF3REG)
+
+    def nfs_mkdir(self, unpacker, packer):
+        self._create(unpacker, packer, NF3DIR)
+
+    def nfs_remove(self, unpacker, packer):
+        directory = self.node(unpacker.unpack_opaque(), directory=True)
+        name = unpacker.unpack_string()
+        node = directory.children.get(name)
+        if node is None:
+            raise NfsError(NfsStat3.NFS3ERR_NOENT)
+        if node.children is not None:
+            raise NfsError(NfsStat3.NFS3ERR_ISDIR)
+        before = directory.wcc()
+        del directory.children[name]
+        del self.nodes[node.fh]
+        self.locks.pop(node.fh, None)
+        self.blocked = [request for request in self.blocked if request[0] != node.fh]
+        directory.mtime = directory.ctime = self.now()
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_wcc_data(packer, before, directory)
+
+    def _readdir(self, unpacker, packer, plus):
+        directory = self.node(unpacker.unpack_opaque(), directory=True)
+        cookie = unpacker.unpack_uhyper()
+        verifier = unpacker.unpack_fopaque(8)
+        dircount = unpacker.unpack_uint()
+        maxcount = unpacker.unpack_uint() if plus else dircount
+        # Cookies are positions in the sorted names, which only hold while the directory is unchanged
+        if cookie and verifier != directory.verifier:
+            raise NfsError(NfsStat3.NFS3ERR_BAD_COOKIE)
+        names = sorted(directory.children)
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_post_op_attr(packer, directory)
+        packer.pack_fopaque(8, directory.verifier)
+        directory_bytes = 0
+        reply_bytes = _READDIR_REPLY_OVERHEAD
+        position = cookie
+        while position < len(names):
+            name = names[position]
+            node = directory.children[name]
+            entry_bytes = 4 + 8 + 4 + ((len(name) + 3) & ~3) + 8
+            entry_reply_bytes = entry_bytes + (4 + fattr3.size + 4 + 4 + len(node.fh) if plus else 0)
+            if position > cookie and (directory_bytes + entry_bytes > dircount or
+                                      reply_bytes + entry_reply_bytes > maxcount):
+                break
+            directory_bytes += entry_bytes
+            reply_bytes += entry_reply_bytes
+            position += 1
+            packer.pack_bool(True)
+            packer.pack_uhyper(node.fileid)
+            packer.pack_string(name)
+            packer.pack_uhyper(position)
+            if plus:
+                self.pack_post_op_attr(packer, node)
+                packer.pack_bool(True)
+                packer.pack_opaque(node.fh)
+        packer.pack_bool(False)
+        packer.pack_bool(position >= len(names))
+
+    def nfs_readdir(self, unpacker, packer):
+        self._readdir(unpacker, packer, plus=False)
+
+    def nfs_readdirplus(self, unpacker, packer):
+        self._readdir(unpacker, packer, plus=True)
+
+    def nfs_fsinfo(self, unpacker, packer):
+        node = self.node(unpacker.unpack_opaque())
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_post_op_attr(packer, node)
+        size = self.transfer_size
+        packer.pack_struct(fsinfo3, (size, size, 4096, size, size, 4096, self.dtpref, 1 << 62, (0, 1),
+                                     FSF3_PROPERTIES))
+
+    def nfs_commit(self, unpacker, packer):
+        node = self.node(unpacker.unpack_opaque(), directory=False)
+        unpacker.unpack_uhyper()
+        unpacker.unpack_uint()
+        packer.pack_enum(NfsStat3.NFS3_OK.value)
+        self.pack_wcc_data(packer, node.wcc(), node)
+        packer.pack_fopaque(8, self.write_verifier)
+
+    # NLM
+
+    @staticmethod
+    def unpack_nlm_lock(unpacker):
+        """
+        :return: (fh, owner, start, end) of an nlm4_lock; the owner is (caller_name, svid, oh)
+                 and end is None for a lock up to the end of the file
+        """
+        caller_name = unpacker.unpack_string()
+        fh = unpacker.unpack_opaque()
+        oh = unpacker.unpack_opaque()
+        svid = unpacker.unpack_uint()
+        offset = unpacker.unpack_uhyper()
+        length = unpacker.unpack_uhyper()
+        return fh, (caller_name, svid, oh), offset, offset + length if length else None
+
+    def conflicting_lock(self, fh, owner, start, end, exclusive):
+        for lock_owner, lock_start, lock_end, lock_exclusive in self.locks.get(fh, ()):
+            if lock_owner != owner and (exclusive or lock_exclusive) and \
+                    (end is None or lock_start < end) and (lock_end is None or start < lock_end):
+                return lock_owner, lock_start, lock_end, lock_exclusive
+        return None
+
+    def release_range(self, fh, owner, start, end):
+        """
+        Remove owner's locks on [start, end), splitting the ones that reach beyond it
+        """
+        remaining = []
+        for lock in self.locks.get(fh, ()):
+            lock_owner, lock_start, lock_end, exclusive = lock
+            if lock_owner != owner or (end is not None and lock_start >= end) or \
+                    (lock_end is not None and lock_end <= start):
+                remaining.append(lock)
+                continue
+            if lock_start < start:
+                remaining.append((lock_owner, lock_start, start, exclusive))
+            if end is not None and (lock_end is None or lock_end > end):
+                remaining.append((lock_owner, end, lock_end, exclusive))
+        if remaining:
+            self.locks[fh] = remaining
+        else:
+            self.locks.pop(fh, None)
+
+    def pack_nlm_res(self, packer, cookie, status):
+        packer.pack_opaque(cookie)
+        packer.pack_enum(status.value)
+
+    def nlm_test(self, unpacker, packer):
+        cookie = unpacker.unpack_opaque()
+        exclusive = unpacker.unpack_bool()
+        fh, owner, start, end = self.unpack_nlm_lock(unpacker)
+        if time.monotonic() < self.grace_until:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_DENIED_GRACE_PERIOD)
+            return
+        holder = self.conflicting_lock(fh, owner, start, end, exclusive)
+        if holder is None:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_GRANTED)
+            return
+        (caller_name, svid, oh), lock_start, lock_end, lock_exclusive = holder
+        self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_DENIED)
+        packer.pack_bool(lock_exclusive)
+        packer.pack_uint(svid)
+        packer.pack_opaque(oh)
+        packer.pack_uhyper(lock_start)
+        packer.pack_uhyper(lock_end - lock_start if lock_end is not None else 0)
+
+    def grant(self, fh, owner, start, end, exclusive):
+        # A lock replaces the owner's locks on the range, e.g. turning a shared lock exclusive
+        self.release_range(fh, owner, start, end)
+        self.locks.setdefault(fh, []).append((owner, start, end, exclusive))
+
+    def grant_blocked(self, fh):
+        """
+        Grant the blocked requests for fh that no longer conflict, in the order they came, and
+        call the clients back
+        """
+        for request in list(self.blocked):
+            if request[0] == fh and self.conflicting_lock(*request) is None:
+                self.blocked.remove(request)
+                self.grant(*request)
+                threading.Thread(target=self.send_granted, args=request, daemon=True).start()
+
+    def send_granted(self, fh, owner, start, end, exclusive):
+        caller_name, svid, oh = owner
+        data = {"cookie": (4, ''),
+                "exclusive": exclusive,
+                "lock": {"caller_name": caller_name.decode(errors='surrogateescape'),
+                         "fh": fh,
+                         "owner": oh,
+                         "svid": svid,
+                         "l_offset": start,
+                         "l_len": end - start if end is not None else 0}}
+        port = self.callbacks.get((NLM_PROGRAM, NLM_VERSION, IPPROTO_TCP))
+        try:
+            if port:
+                client = RawNLMClient(data["lock"]["caller_name"], port)
+            else:
+                client = NLMClient(data["lock"]["caller_name"])
+            try:
+                status = client.granted(data)
+            finally:
+                client.close()
+        except (OSError, RuntimeError):
+            # The client finds out when it sends its request again
+            return
+        if status != NLM4_Stats.NLM4_GRANTED.value:
+            with self.lock:
+                self.release_range(fh, owner, start, end)
+                self.grant_blocked(fh)
+
+    def nlm_lock(self, unpacker, packer):
+        cookie = unpacker.unpack_opaque()
+        block = unpacker.unpack_bool()
+        exclusive = unpacker.unpack_bool()
+        fh, owner, start, end = self.unpack_nlm_lock(unpacker)
+        reclaim = unpacker.unpack_bool()
+        if fh not in self.nodes:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_STALE_FH)
+            return
+        if not reclaim and time.monotonic() < self.grace_until:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_DENIED_GRACE_PERIOD)
+            return
+        request = (fh, owner, start, end, exclusive)
+        if self.conflicting_lock(*request) is None:
+            if request in self.blocked:
+                self.blocked.remove(request)
+            self.grant(*request)
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_GRANTED)
+        elif block:
+            # Granted by grant_blocked once the conflicting locks are released
+            if request not in self.blocked:
+                self.blocked.append(request)
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_BLOCKED)
+        else:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_DENIED)
+
+    def nlm_cancel(self, unpacker, packer):
+        cookie = unpacker.unpack_opaque()
+        unpacker.unpack_bool()          # block
+        exclusive = unpacker.unpack_bool()
+        request = (*self.unpack_nlm_lock(unpacker), exclusive)
+        if request in self.blocked:
+            self.blocked.remove(request)
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_GRANTED)
+        else:
+            self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_DENIED)
+
+    def nlm_unlock(self, unpacker, packer):
+        cookie = unpacker.unpack_opaque()
+        fh, owner, start, end = self.unpack_nlm_lock(unpacker)
+        self.release_range(fh, owner, start, end)
+        self.grant_blocked(fh)
+        self.pack_nlm_res(packer, cookie, NLM4_Stats.NLM4_GRANTED)
+
+
+if __name__ == '__main__':
+    import sys
+
+    server = MemoryServer(host='0.0.0.0', port=int(sys.argv[1]) if len(sys.argv) > 1 else 0,
+                          latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    print(f'Serving portmap, MOUNT, NFS and NLM on port {server.port}')
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
@@ -9,6 +9,7 @@
 # # protocol, use multiple inheritance as shown below.
 import rpc
 import os
+from asyncrpc import AsyncTCPClient, AsyncUDPClient
 from rpc import Packer, Unpacker, TCPClient, UDPClient
 
 
@@ -174,3 +175,16 @@ class UDPMountClient(PartialMountClient, UDPClient):
         UDPClient.__init__(self, host, MOUNTPROG, MOUNTVERS)
 
 
+# The same partial client works on top of the asyncio transports, in which
+# case every procedure returns a coroutine.
+
+class AsyncTCPMountClient(PartialMountClient, AsyncTCPClient):
+
+    def __init__(self, host):
+        AsyncTCPClient.__init__(self, host, MOUNTPROG, MOUNTVERS)
+
+
+class AsyncUDPMountClient(PartialMountClient, AsyncUDPClient):
+
+    def __init__(self, host):
+        AsyncUDPClient.__init__(self, host, MOUNTPROG, MOUNTVERS)
@@ -1,12 +1,21 @@
+import posixpath
 import sys
+import threading
+from concurrent.futures import wait
 
 import rpyc
 from logbook import Logger, FileHandler
 from rpyc.utils.server import ThreadedServer
 
+import rpcmetrics
+from clientpool import ClientPool
 from mountclient import TCPMountClient
-from nfsclient import NFSClient, NfsStat3, CreateMode, UnexpectedNfsStatus
-from nlmclient import NLMClient, NLM4_Stats
+from nfscache import ExportHandleCache, FATTR3_SIZE
+from nfsclient import NFSClient, NfsStat3, CreateMode, UnexpectedNfsStatus, STALE_HANDLE_STATUSES
+from nfsio import DEFAULT_WINDOW, read_file_into, transfer_sizes, write_file, write_stable
+from nfswalk import listdir
+from locktable import LockTable
+from nlmclient import NLMCallbackServer, NLMClient, NLM4_Stats
 from packer_arguments import get_packer_arguments
 
 logger = Logger("nfs_client")
@@ -18,106 +27,270 @@ class FileNotFound(Exception):
 
 class NFSClientWrapper(rpyc.Service):
     FILE_SYNC = 2
+    # WRITE calls kept in flight for buffers larger than the server's preferred write size
+    write_window = DEFAULT_WINDOW
+    # READ calls kept in flight by exposed_read_file
+    read_window = DEFAULT_WINDOW
+    # Shared by the service instances of all rpyc connections
+    pool = ClientPool()
+    export_handles = ExportHandleCache()
+    # Started by the first blocking lock
+    callback_server = None
+    callback_server_lock = threading.Lock()
+    # The ranges granted to each lock owner, to skip the calls that would not change anything
+    lock_table = LockTable()
+    # Seconds between two reclaims of the locks held on a host, about a grace period
+    reclaim_interval = 90
 
     def on_connect(self, *args):
         logger.info(f"Remote connection accepted")
 
+    def exposed_pool_stats(self):
+        return self.pool.stats()
+
+    def exposed_cache_stats(self):
+        return {"names": NFSClient.name_cache.stats() if NFSClient.name_cache else None,
+                "attributes": NFSClient.attribute_cache.stats() if NFSClient.attribute_cache else None,
+                "directories": NFSClient.directory_cache.stats() if NFSClient.directory_cache else None}
+
+    def exposed_rpc_stats(self):
+        """
+        :return: {(prog, vers, proc): per procedure call counts, latencies and bytes}, see rpcmetrics
+        """
+        return rpcmetrics.metrics.snapshot()
+
+    def exposed_stats(self):
+        """
+        :return: the RPC metrics in the Prometheus text exposition format
+        """
+        return rpcmetrics.metrics.prometheus()
+
     def _get_export_handle(self, host, export):
-        mount_client = TCPMountClient(host)
-        sf = mount_client.mount(export)
+        export_handle = self.export_handles.get(host, export)
+        if export_handle:
+            return export_handle
+        with self.pool.client(TCPMountClient, host) as mount_client:
+            sf = mount_client.mount(export)
         export_handle = sf[1]
         if export_handle:
+            self.export_handles.set(host, export, export_handle)
             return export_handle
 
+    def _with_export_handle(self, host, export, operation):
+        """
+        Call operation with the root handle of the export, mounting it again once if the cached
+        handle turned out to be stale
+        """
+        try:
+            return operation(self._get_export_handle(host, export))
+        except UnexpectedNfsStatus as e:
+            if e.status not in STALE_HANDLE_STATUSES:
+                raise
+            logger.debug(f"Root handle of {export} on host {host} is stale ({e}), mounting again")
+            self.export_handles.invalidate(host, export)
+            return operation(self._get_export_handle(host, export))
+
     def exposed_write_to_file(self, host, export, file_name, write_buffer, offset=0):
-        nfs_client = NFSClient(host=host)
         file_handle = self.exposed_lookup_file(host, export, file_name)
         if not file_handle:
             file_handle = self.exposed_create_file(host, export, file_name)
-        write_arguments = get_packer_arguments("WRITE",
-                                               file=file_handle,
-                                               offset=offset,
-                                               count=len(write_buffer),
-                                               stable=NFSClientWrapper.FILE_SYNC,
-                                               data=write_buffer)
-        nfs_client.write(write_arguments)
+        data = write_buffer.encode() if isinstance(write_buffer, str) else write_buffer
+        with self.pool.client(NFSClient, host) as nfs_client:
+            if len(data) > transfer_sizes(nfs_client, file_handle).write:
+                write_file(nfs_client, file_handle, data, offset, window=self.write_window)
+            else:
+                write_stable(nfs_client, file_handle, data, offset, stable=NFSClientWrapper.FILE_SYNC)
         return file_handle
 
+    def exposed_read_file(self, host, export, file_name, offset=0, length=None):
+        """
+        :param length: number of bytes to read, the rest of the file if None
+        :return: the data read, None if the file does not exist
+        """
+        file_handle = self.exposed_lookup_file(host, export, file_name)
+        if not file_handle:
+            return None
+        with self.pool.client(NFSClient, host) as nfs_client:
+            if length is None:
+                _, attributes = nfs_client.getattr(file_handle)
+                length = max(attributes[FATTR3_SIZE] - offset, 0)
+            buffer = bytearray(length)
+            count = read_file_into(nfs_client, file_handle, buffer, offset, window=self.read_window)
+        del buffer[count:]
+        return bytes(buffer)
+
     def exposed_lookup_file(self, host, export, file_name):
         logger.debug(f"Lookup for file {file_name} on export {export}, host {host}")
-        nfs_client = NFSClient(host=host)
-        lookup_args = get_packer_arguments("LOOKUP", dir=self._get_export_handle(host, export), name=file_name)
-        status, fh = nfs_client.lookup(lookup_args['what'])
+
+        def lookup(export_handle):
+            with self.pool.client(NFSClient, host) as nfs_client:
+                return nfs_client.resolve(export_handle, file_name)
+        status, fh = self._with_export_handle(host, export, lookup)
         if status == NfsStat3.NFS3_OK:
             logger.debug("file {} was found".format(file_name))
         else:
             logger.debug("file {} was not found".format(file_name))
         return fh
 
+    def exposed_lookup_files(self, host, export, file_names):
+        """
+        Look up many paths under the export at once, see NFSClient.resolve_many
+        :return: {file name: fh, None if it was not found}
+        """
+        def lookup(export_handle):
+            with self.pool.client(NFSClient, host) as nfs_client:
+                return nfs_client.resolve_many(export_handle, file_names)
+        return {file_name: fh for file_name, (status, fh) in self._with_export_handle(host, export, lookup).items()}
+
     def exposed_create_file(self, host, export, file_name):
-        nfs_client = NFSClient(host=host)
-        create_args = get_packer_arguments(action_name="CREATE",
-                                           dir=self._get_export_handle(host, export),
-                                           name=file_name,
-                                           create_mode=CreateMode.UNCHECKED.value)
-        status, fh = nfs_client.create(create_args)
+        def create(export_handle):
+            directory, name = posixpath.split(file_name)
+            with self.pool.client(NFSClient, host) as nfs_client:
+                status, dir_handle = nfs_client.resolve(export_handle, directory)
+                if status != NfsStat3.NFS3_OK:
+                    return status, None
+                create_args = get_packer_arguments(action_name="CREATE",
+                                                   dir=dir_handle,
+                                                   name=name,
+                                                   create_mode=CreateMode.UNCHECKED.value)
+                return nfs_client.create(create_args)
+        status, fh = self._with_export_handle(host, export, create)
         if status == NfsStat3.NFS3_OK:
             logger.debug("file {} was successfully created".format(file_name))
         return fh
 
     def read_dirs(self, host, export):
-        nfs_client = NFSClient(host=host)
-        list_dir = []
-        read_dir_arguments = get_packer_arguments("READDIR",
-                                                  dir=self._get_export_handle(host, export))
-        eof = False
-        while not eof:
-            status, rest = nfs_client.read_dir(read_dir_arguments)
-            if status != NfsStat3.NFS3_OK:
-                raise UnexpectedNfsStatus(NfsStat3(status))
-            entries, eof = rest
-            for fileid, name, cookie in entries:
-                list_dir.append((fileid, name))
-        return list_dir
+        return self.list_dir(host, export)
 
     def list_dir(self, host, export):
-        nfs_client = NFSClient(host=host)
-        list_dir = []
-        read_dir_plus_arguments = get_packer_arguments("READDIRPLUS",
-                                                       dir=self._get_export_handle(host, export))
-        eof = False
-        while not eof:
-            status, attributes, rest = nfs_client.read_dir_plus(read_dir_plus_arguments)
-            if status != NfsStat3.NFS3_OK:
-                raise UnexpectedNfsStatus(NfsStat3(status))
-            entries, eof = rest
-            for file_id, dir_or_file_name, dir_params, cookie, fh in entries:
-                list_dir.append((file_id, dir_or_file_name))
-        return list_dir
+        def list_dir(export_handle):
+            with self.pool.client(NFSClient, host) as nfs_client:
+                return [(file_id, dir_or_file_name) for file_id, dir_or_file_name, cookie, attributes, fh
+                        in listdir(nfs_client, export_handle)]
+        return self._with_export_handle(host, export, list_dir)
+
+    def _get_callback_server(self):
+        with self.callback_server_lock:
+            if NFSClientWrapper.callback_server is None:
+                callback_server = NLMCallbackServer()
+                callback_server.start()
+                if not callback_server.registered:
+                    logger.warning("Could not register for NLM_GRANTED callbacks, blocked locks are polled")
+                NFSClientWrapper.callback_server = callback_server
+            return NFSClientWrapper.callback_server
 
     def exposed_lock(self, host, export, file_name, owner, client_name, **kwargs):
+        """
+        With block=True, waits until the lock is granted (the server calls back client_name,
+        which must be this host) or timeout seconds passed, then the request is cancelled and
+        NLM4_DENIED returned
+        """
         exclusive = kwargs.get("exclusive", True)
         block = kwargs.get("block", False)
+        timeout = kwargs.get("timeout")
         offset = kwargs.get("offset", 0)
         l_len = kwargs.get("length", 0)
         file_handle = kwargs.get("file_handle")
         logger.debug(
             f"Locking the file {file_name} on host {host}, owner={owner}, client={client_name},"
             f" kwargs={kwargs}")
-        nlm_client = NLMClient(host)
         file_handle = self._get_file_handle(host, export,
                                             file_name) if not file_handle else file_handle
-        lock_arguments = get_packer_arguments("LOCK",
-                                              caller_name=client_name,
-                                              block=block,
-                                              exclusive=exclusive,
-                                              fh=file_handle,
-                                              owner=owner,
-                                              l_offset=offset,
-                                              l_len=l_len)
-        status = nlm_client.lock(lock_arguments)
+        lock_arguments = self.lock_table.lock_arguments(client_name, file_handle, owner, offset, l_len,
+                                                        exclusive, block=block)
+        if self.lock_table.is_held(host, lock_arguments):
+            return NLM4_Stats.NLM4_GRANTED.name
+        with self.pool.client(NLMClient, host) as nlm_client:
+            status, = self._send_locks(nlm_client, host, [lock_arguments], block, timeout)
         return NLM4_Stats(status).name
 
+    def exposed_lock_many(self, host, export, locks, owner, client_name, **kwargs):
+        """
+        Take many byte-range locks at once: the file handles are resolved together and the LOCK
+        requests pipelined over one NLM connection
+        :param locks: (file name or file handle, offset, length[, exclusive]) tuples, exclusive
+                      by default like in exposed_lock
+        :param kwargs: block and timeout, as for exposed_lock (the timeout is for all of them)
+        :return: the NLM4_Stats name for each lock, in the same order
+        """
+        block = kwargs.get("block", False)
+        timeout = kwargs.get("timeout")
+        locks = [tuple(lock) if len(lock) > 3 else (*lock, True) for lock in locks]
+        logger.debug(f"Locking {len(locks)} ranges on host {host}, owner={owner}, client={client_name}")
+        file_handles = self._get_file_handles(host, export, [lock[0] for lock in locks])
+        lock_arguments = [self.lock_table.lock_arguments(client_name, file_handles[file], owner, offset, length,
+                                                         exclusive, block=block)
+                          for file, offset, length, exclusive in locks]
+        statuses = [NLM4_Stats.NLM4_GRANTED.value if self.lock_table.is_held(host, arguments) else None
+                    for arguments in lock_arguments]
+        to_lock = [arguments for arguments, status in zip(lock_arguments, statuses) if status is None]
+        if to_lock:
+            with self.pool.client(NLMClient, host) as nlm_client:
+                replies = self._send_locks(nlm_client, host, to_lock, block, timeout)
+            replies = iter(replies)
+            statuses = [next(replies) if status is None else status for status in statuses]
+        return [NLM4_Stats(status).name for status in statuses]
+
+    def _send_locks(self, nlm_client, host, lock_arguments, block, timeout):
+        """
+        Send the LOCKs pipelined, with block waiting up to timeout seconds for all of them (the
+        ones still blocked then are cancelled), and record the outcome in the lock table. A lock
+        whose outcome is not known, cancelled after it was sent or its call failed, is recorded as
+        possibly held. A server in its grace period has restarted and forgotten the locks held,
+        which are reclaimed then.
+        :return: the NLM4_Stats value of each lock, NLM4_DENIED for the cancelled ones
+        """
+        if block:
+            callback_server = self._get_callback_server()
+            futures = [callback_server.wait_for_lock(nlm_client, arguments) for arguments in lock_arguments]
+            _, not_done = wait(futures, timeout)
+            for future in not_done:
+                future.cancel()
+            if not_done:
+                logger.debug(f"{len(not_done)} locks not granted within {timeout} seconds, cancelled")
+        else:
+            futures = [nlm_client.lock_async(arguments) for arguments in lock_arguments]
+        statuses = []
+        error = None
+        for arguments, future in zip(lock_arguments, futures):
+            if future.cancelled():
+                # The server may have granted it before the CANCEL came
+                self.lock_table.possibly_locked(host, arguments)
+                statuses.append(NLM4_Stats.NLM4_DENIED.value)
+                continue
+            try:
+                status = future.result()
+            except Exception as e:
+                self.lock_table.possibly_locked(host, arguments)
+                error = error or e
+                continue
+            if status == NLM4_Stats.NLM4_GRANTED.value:
+                self.lock_table.locked(host, arguments)
+            statuses.append(status)
+        if error is not None:
+            raise error
+        if NLM4_Stats.NLM4_DENIED_GRACE_PERIOD.value in statuses:
+            reclaimed, lost = self.lock_table.reclaim(nlm_client, host, self.reclaim_interval)
+            if reclaimed or lost:
+                logger.info(f"{host} restarted, reclaimed {len(reclaimed)} locks and lost {len(lost)}")
+        return statuses
+
+    def exposed_reclaim_locks(self, host):
+        """
+        Reclaim the locks held on host, to be called after it restarted
+        :return: {"reclaimed": number of ranges granted again, "lost": number of ranges not granted}
+        """
+        with self.pool.client(NLMClient, host) as nlm_client:
+            reclaimed, lost = self.lock_table.reclaim(nlm_client, host)
+        return {"reclaimed": len(reclaimed), "lost": len(lost)}
+
+    def exposed_lock_stats(self):
+        """
+        :return: {"owners", "ranges": held, "uncertain": ranges possibly held, "calls": lock and
+                  unlock requests checked against the table, "hits": the ones that needed no call}
+        """
+        return self.lock_table.stats()
+
     def exposed_unlock(self, host, export, file_name, owner, client_name, **kwargs):
         offset = kwargs.get("offset", 0)
         length = kwargs.get("length", 0)
@@ -127,22 +300,58 @@ class NFSClientWrapper(rpyc.Service):
             f" kwargs = {kwargs}")
         file_handle = self._get_file_handle(host, export,
                                             file_name) if not file_handle else file_handle
-        nlm_client = NLMClient(host)
-        unlock_arguments = get_packer_arguments("UNLOCK",
-                                                caller_name=client_name,
-                                                owner=owner,
-                                                fh=file_handle,
-                                                l_offset=offset,
-                                                l_len=length)
-        status = nlm_client.unlock(unlock_arguments)
+        unlock_arguments = self.lock_table.unlock_arguments(client_name, file_handle, owner, offset, length)
+        if self.lock_table.is_unlocked(host, unlock_arguments):
+            return NLM4_Stats.NLM4_GRANTED.name
+        with self.pool.client(NLMClient, host) as nlm_client:
+            status = nlm_client.unlock(unlock_arguments)
+        if status == NLM4_Stats.NLM4_GRANTED.value:
+            self.lock_table.unlocked(host, unlock_arguments)
         return NLM4_Stats(status).name
 
+    def exposed_unlock_many(self, host, export, locks, owner, client_name):
+        """
+        Release many byte-range locks at once, see exposed_lock_many
+        :param locks: (file name or file handle, offset, length) tuples; a fourth item (exclusive)
+                      is ignored, so the list given to exposed_lock_many can be passed as is
+        :return: the NLM4_Stats name for each range, in the same order
+        """
+        locks = [tuple(lock) for lock in locks]
+        logger.debug(f"Unlocking {len(locks)} ranges on host {host}, owner={owner}, client={client_name}")
+        file_handles = self._get_file_handles(host, export, [lock[0] for lock in locks])
+        unlock_arguments = [self.lock_table.unlock_arguments(client_name, file_handles[lock[0]], owner, lock[1],
+                                                             lock[2])
+                            for lock in locks]
+        statuses = [NLM4_Stats.NLM4_GRANTED.value] * len(unlock_arguments)
+        to_unlock = [i for i, arguments in enumerate(unlock_arguments)
+                     if not self.lock_table.is_unlocked(host, arguments)]
+        if to_unlock:
+            with self.pool.client(NLMClient, host) as nlm_client:
+                futures = [nlm_client.unlock_async(unlock_arguments[i]) for i in to_unlock]
+                for i, future in zip(to_unlock, futures):
+                    statuses[i] = future.result()
+                    if statuses[i] == NLM4_Stats.NLM4_GRANTED.value:
+                        self.lock_table.unlocked(host, unlock_arguments[i])
+        return [NLM4_Stats(status).name for status in statuses]
+
     def _get_file_handle(self, host, export, file_name):
         file_handle = self.exposed_lookup_file(host, export, file_name)
         if not file_handle:
             raise FileNotFound(f"{file_name} cannot be found and file_handle was not specified")
         return file_handle
 
+    def _get_file_handles(self, host, export, files):
+        """
+        :param files: file names, and file handles (bytes) which are used as they are
+        :return: {file: file handle}
+        """
+        file_names = list({file for file in files if isinstance(file, str)})
+        file_handles = self.exposed_lookup_files(host, export, file_names) if file_names else {}
+        missing = [file_name for file_name, file_handle in file_handles.items() if not file_handle]
+        if missing:
+            raise FileNotFound(f"{', '.join(sorted(missing))} cannot be found")
+        return {file: file_handles.get(file, file) for file in files}
+
 
 if __name__ == "__main__":
     FileHandler("nfs_client.log").push_application()
@@ -0,0 +1,325 @@
+# Client-side caches of NFS server state
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ExportHandleCache:
+    """
+    Root file handles of mounted exports, keyed by (host, export).
+    The root handle of an export practically never changes, so it is kept until the server
+    reports it as stale (see invalidate).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = {}
+
+    def get(self, host, export):
+        with self.lock:
+            return self.handles.get((host, export))
+
+    def set(self, host, export, handle):
+        with self.lock:
+            self.handles[(host, export)] = handle
+
+    def invalidate(self, host, export):
+        with self.lock:
+            self.handles.pop((host, export), None)
+
+    def clear(self):
+        with self.lock:
+            self.handles.clear()
+
+
+# Positions of mtime and ctime in an unpacked fattr3 / wcc_attr
+FATTR3_MTIME, FATTR3_CTIME = 11, 12
+WCC_ATTR_MTIME, WCC_ATTR_CTIME = 1, 2
+
+
+class NameCache:
+    """
+    Directory name lookup cache: (host, directory handle, name) -> file handle, where None
+    records that the server answered NFS3ERR_NOENT for the name.
+    Each entry belongs to a generation of its directory. A directory gets a new generation
+    (making all its entries stale) whenever it is seen with a different mtime/ctime than before,
+    unless the change is explained by our own operation (wcc pre-op attributes match).
+    Entries also expire after positive_ttl/negative_ttl seconds, and at most max_entries are kept,
+    evicting the least recently used.
+    """
+    MISS = object()
+
+    def __init__(self, max_entries=10000, positive_ttl=60, negative_ttl=5):
+        self.max_entries = max_entries
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # (host, dir, name) -> (fh, generation, expires)
+        self.directories = OrderedDict()    # (host, dir) -> [(mtime, ctime), generation]
+        self.generation = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, host, dir_fh, name):
+        """
+        :return: the cached file handle, None for a cached NOENT, or NameCache.MISS
+        """
+        key = (host, dir_fh, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                fh, generation, expires = entry
+                directory = self.directories.get((host, dir_fh))
+                if expires > time.monotonic() and directory is not None and directory[1] == generation:
+                    self.entries.move_to_end(key)
+                    if fh is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return fh
+                del self.entries[key]
+            self.misses += 1
+            return self.MISS
+
+    def set(self, host, dir_fh, name, fh):
+        """
+        Record the result of a lookup; observe_dir must have been called for the directory first.
+        """
+        with self.lock:
+            directory = self.directories.get((host, dir_fh))
+            if directory is None:
+                return
+            ttl = self.negative_ttl if fh is None else self.positive_ttl
+            key = (host, dir_fh, name)
+            self.entries[key] = (fh, directory[1], time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, host, dir_fh, name):
+        with self.lock:
+            self.entries.pop((host, dir_fh, name), None)
+
+    def observe_dir(self, host, dir_fh, attributes):
+        """
+        Record post-op attributes (fattr3) of a directory as returned by the server
+        """
+        if attributes is None:
+            return
+        self._update_dir(host, dir_fh, None, (attributes[FATTR3_MTIME], attributes[FATTR3_CTIME]))
+
+    def observe_dir_change(self, host, dir_fh, wcc):
+        """
+        Record the weak cache consistency data (before, after) of an operation that modified the
+        directory. Entries survive if the directory was not changed by anyone else meanwhile.
+        """
+        before, after = wcc
+        if after is None:
+            self.invalidate_dir(host, dir_fh)
+            return
+        before_times = None if before is None else (before[WCC_ATTR_MTIME], before[WCC_ATTR_CTIME])
+        self._update_dir(host, dir_fh, before_times, (after[FATTR3_MTIME], after[FATTR3_CTIME]))
+
+    def _update_dir(self, host, dir_fh, before_times, times):
+        key = (host, dir_fh)
+        with self.lock:
+            directory = self.directories.get(key)
+            if directory is None:
+                self.generation += 1
+                self.directories[key] = [times, self.generation]
+                while len(self.directories) > self.max_entries:
+                    self.directories.popitem(last=False)
+            elif directory[0] != times:
+                if directory[0] != before_times:
+                    self.generation += 1
+                    directory[1] = self.generation
+                directory[0] = times
+            self.directories.move_to_end(key)
+
+    def invalidate_dir(self, host, dir_fh):
+        with self.lock:
+            self.directories.pop((host, dir_fh), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.directories.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {"entries": len(self.entries),
+                    "hits": self.hits,
+                    "negative_hits": self.negative_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0}
+
+
+name_cache = NameCache()
+
+
+FATTR3_TYPE, FATTR3_SIZE = 0, 5
+NF3DIR = 2
+
+
+class AttributeCache:
+    """
+    File attributes (fattr3) keyed by (host, file handle), with the timeouts of the kernel client:
+    an entry is valid for acregmin seconds (acdirmin for directories), and every time the server
+    returns unchanged attributes the timeout doubles, up to acregmax (acdirmax). A change resets it
+    to the minimum.
+    """
+
+    def __init__(self, acregmin=3, acregmax=60, acdirmin=30, acdirmax=60, max_entries=100000):
+        self.acregmin = acregmin
+        self.acregmax = acregmax
+        self.acdirmin = acdirmin
+        self.acdirmax = acdirmax
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # (host, fh) -> (attributes, expires, timeout)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, host, fh):
+        key = (host, fh)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+    def is_valid(self, host, fh):
+        """
+        :return: True if attributes of fh are cached and not timed out; not counted as a lookup
+        """
+        with self.lock:
+            entry = self.entries.get((host, fh))
+            return entry is not None and entry[1] > time.monotonic()
+
+    def set(self, host, fh, attributes):
+        if attributes is None:
+            self.invalidate(host, fh)
+            return
+        if attributes[FATTR3_TYPE] == NF3DIR:
+            minimum, maximum = self.acdirmin, self.acdirmax
+        else:
+            minimum, maximum = self.acregmin, self.acregmax
+        key = (host, fh)
+        with self.lock:
+            previous = self.entries.get(key)
+            if previous is not None and self._unchanged(previous[0], attributes):
+                timeout = min(previous[2] * 2, maximum)
+            else:
+                timeout = minimum
+            self.entries[key] = (attributes, time.monotonic() + timeout, timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def _unchanged(cached, attributes):
+        return cached[FATTR3_MTIME] == attributes[FATTR3_MTIME] and \
+               cached[FATTR3_CTIME] == attributes[FATTR3_CTIME] and \
+               cached[FATTR3_SIZE] == attributes[FATTR3_SIZE]
+
+    def observe_wcc(self, host, fh, wcc):
+        _, after = wcc
+        self.set(host, fh, after)
+
+    def invalidate(self, host, fh):
+        with self.lock:
+            self.entries.pop((host, fh), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+attribute_cache = AttributeCache()
+
+
+class DirectoryCache:
+    """
+    Complete directory listings (READDIRPLUS entries) keyed by (host, directory handle), together
+    with the directory's mtime/ctime at the time of listing. A listing is handed out again only
+    while the directory still has that mtime and ctime.
+    At most max_entries directory entries are kept in total, evicting the least recently used
+    listings.
+    """
+
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.listings = OrderedDict()   # (host, dir) -> ((mtime, ctime), entries)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, host, dir_fh, attributes):
+        """
+        :param attributes: current attributes of the directory
+        :return: the cached entries, None if there are none or the directory changed since
+        """
+        key = (host, dir_fh)
+        with self.lock:
+            listing = self.listings.get(key)
+            if listing is not None and attributes is not None and \
+                    listing[0] == (attributes[FATTR3_MTIME], attributes[FATTR3_CTIME]):
+                self.listings.move_to_end(key)
+                self.hits += 1
+                return listing[1]
+            self.misses += 1
+
+    def set(self, host, dir_fh, attributes, entries):
+        """
+        :param attributes: attributes of the directory returned with the last page
+        """
+        if attributes is None:
+            self.invalidate(host, dir_fh)
+            return
+        key = (host, dir_fh)
+        with self.lock:
+            previous = self.listings.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.listings[key] = ((attributes[FATTR3_MTIME], attributes[FATTR3_CTIME]), entries)
+            self.size += len(entries)
+            while self.size > self.max_entries and len(self.listings) > 1:
+                _, (_, evicted) = self.listings.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, host, dir_fh):
+        with self.lock:
+            listing = self.listings.pop((host, dir_fh), None)
+            if listing is not None:
+                self.size -= len(listing[1])
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"listings": len(self.listings),
+                    "entries": self.size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+directory_cache = DirectoryCache()
@@ -1,6 +1,12 @@
+from collections import deque
+from concurrent.futures import Future
 from enum import Enum
+from functools import partial
 
+import nfscache
 import rpc
+import xdr
+from asyncrpc import AsyncTCPClient
 from mountclient import MountPacker, MountUnpacker
 from rpc import TCPClient
 
@@ -31,6 +37,13 @@ class NfsStat3(Enum):
     NFS3ERR_STALE = 70
     NFS3ERR_REMOTE = 71
     NFS3ERR_BADHANDLE = 10001
+    NFS3ERR_NOT_SYNC = 10002
+    NFS3ERR_BAD_COOKIE = 10003
+    NFS3ERR_NOTSUPP = 10004
+    NFS3ERR_TOOSMALL = 10005
+    NFS3ERR_SERVERFAULT = 10006
+    NFS3ERR_BADTYPE = 10007
+    NFS3ERR_JUKEBOX = 10008
 
 
 class CreateMode(Enum):
@@ -39,8 +52,64 @@ class CreateMode(Enum):
     EXCLUSIVE = 2
 
 
+class StableHow(Enum):
+    UNSTABLE = 0
+    DATA_SYNC = 1
+    FILE_SYNC = 2
+
+
 class UnexpectedNfsStatus(Exception):
-    pass
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+# Statuses meaning that the file handle used is not valid anymore
+STALE_HANDLE_STATUSES = (NfsStat3.NFS3ERR_STALE, NfsStat3.NFS3ERR_BADHANDLE)
+
+
+# Compiled layouts of the fixed-size parts of NFSv3 replies (RFC 1813)
+nfstime3 = xdr.Struct('nfstime3', [('seconds', xdr.UINT),
+                                   ('nseconds', xdr.UINT)])
+
+fattr3 = xdr.Struct('fattr3', [('type', xdr.ENUM),
+                               ('mode', xdr.UINT),
+                               ('nlink', xdr.UINT),
+                               ('uid', xdr.UINT),
+                               ('gid', xdr.UINT),
+                               ('size', xdr.UHYPER),
+                               ('used', xdr.UHYPER),
+                               ('rdev', xdr.UHYPER),
+                               ('fsid', xdr.UHYPER),
+                               ('fileid', xdr.UHYPER),
+                               ('atime', nfstime3),
+                               ('mtime', nfstime3),
+                               ('ctime', nfstime3)])
+
+wcc_attr = xdr.Struct('wcc_attr', [('size', xdr.UHYPER),
+                                   ('mtime', nfstime3),
+                                   ('ctime', nfstime3)])
+
+fsinfo3 = xdr.Struct('FSINFO3resok', [('rtmax', xdr.UINT),
+                                      ('rtpref', xdr.UINT),
+                                      ('rtmult', xdr.UINT),
+                                      ('wtmax', xdr.UINT),
+                                      ('wtpref', xdr.UINT),
+                                      ('wtmult', xdr.UINT),
+                                      ('dtpref', xdr.UINT),
+                                      ('maxfilesize', xdr.UHYPER),
+                                      ('time_delta', nfstime3),
+                                      ('properties', xdr.UINT)])
+
+# entry3 and entryplus3 split into the fixed runs between their variable-length fields
+entry3_head = xdr.Struct('entry3 head', [('fileid', xdr.UHYPER),
+                                         ('name_length', xdr.UINT)])
+
+entry3_cookie = xdr.Struct('entry3 cookie', [('cookie', xdr.UHYPER),
+                                             ('attributes_follow', xdr.BOOL)])
+
+entryplus3_attributes = xdr.Struct('entryplus3 attributes', [('name_attributes', fattr3),
+                                                             ('handle_follows', xdr.BOOL)])
 
 
 class NFSPacker(MountPacker):
@@ -109,12 +178,18 @@ class NFSPacker(MountPacker):
         self.pack_readdirargs(ra)
         self.pack_uint(ra["maxcount"])
 
+    def pack_read_args(self, ra):
+        self.pack_fhandle(ra["file"])
+        self.pack_uhyper(ra["offset"])
+        self.pack_uint(ra["count"])
+
     def pack_write_args(self, wa):
         self.pack_fhandle(wa["file"])
         self.pack_uhyper(wa["offset"])
         self.pack_uint(wa["count"])
         self.pack_uint(wa["Stable"])
-        self.pack_data(wa["Data"].encode())
+        data = wa["Data"]
+        self.pack_data(data.encode() if isinstance(data, str) else data)
 
     def pack_create_args(self, ca):
         self.pack_diropargs(ca['where'])
@@ -132,9 +207,8 @@ class NFSPacker(MountPacker):
         self.pack_fhandle(fh)
 
     def pack_data(self, data):
-        data_length = len(data)
-        self.pack_uint(data_length)
-        self.pack_fopaque(data_length, data)
+        # Written data goes onto the socket straight from the caller's buffer
+        self.pack_opaque_ref(data)
 
     def pack_timeval(self, tv):
         secs, usecs = tv
@@ -154,13 +228,35 @@ class NFSUnpacker(MountUnpacker):
         return status, rest
 
     def unpack_readdirplus(self):
+        status, attr, verifier, entries, eof = self.unpack_readdirplus_page()
+        rest = (entries, eof)
+        return status, attr, rest
+
+    def unpack_readdirplus_page(self):
+        """
+        Like unpack_readdirplus, but also returns the cookie verifier, which the next page's
+        arguments must carry
+        :return: status, dir attributes, verifier, entries, eof
+        """
         status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
         attr = self.unpack_obj_attributes()
-        self.unpack_uhyper() # Verifier
+        verifier = self.unpack_fopaque(8)
         entries = self.unpack_list(self.unpack_entry_plus)
         eof = self.unpack_bool()
-        rest = (entries, eof)
-        return status, attr, rest
+        return status, attr, verifier, entries, eof
+
+    def unpack_readdirplus_columns(self, listing):
+        """
+        Like unpack_readdirplus_page, but the entries are appended to listing, an
+        nfscolumns.ColumnarListing
+        :return: status, dir attributes, verifier, number of entries, eof
+        """
+        status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
+        attr = self.unpack_obj_attributes()
+        verifier = self.unpack_fopaque(8)
+        count = listing.unpack_entries(self)
+        eof = self.unpack_bool()
+        return status, attr, verifier, count, eof
 
     def unpack_obj_attributes(self):
         attributes_follow = self.unpack_bool()
@@ -169,12 +265,14 @@ class NFSUnpacker(MountUnpacker):
             return fattr3
 
     def unpack_dir_or_file_wcc(self):
+        before = after = None
         before_follows = self.unpack_bool()
         if before_follows:
-            self.unpack_wcc_attr()
+            before = self.unpack_wcc_attr()
         after_follows = self.unpack_bool()
         if after_follows:
-            self.unpack_fattr3()
+            after = self.unpack_fattr3()
+        return before, after
 
     def unpack_wcc_attributes(self):
         op_attr = self.unpack_uint()
@@ -204,66 +302,122 @@ class NFSUnpacker(MountUnpacker):
         """
         verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
         attr = self.unpack_obj_attributes()
-        rtmax = self.unpack_uint()
-        rtpref = self.unpack_uint()
-        rtmult= self.unpack_uint()
-        wtmax = self.unpack_uint()
-        wtpref = self.unpack_uint()
-        wtmult = self.unpack_uint()
-        dtpref = self.unpack_uint()
-        time_delta = self.unpack_uhyper()
-        properties = self.unpack_uint()
-        max_file_size = self.unpack_uhyper()
+        rtmax, rtpref, rtmult, wtmax, wtpref, wtmult, dtpref, max_file_size, time_delta, properties = \
+            self.unpack_struct(fsinfo3)
         return attr, rtmax, rtpref, rtmult, wtmax, wtpref, wtmult, dtpref, time_delta, \
                properties, max_file_size
 
     def unpack_entry(self):
-        file_id = self.unpack_uhyper()
-        name = self.unpack_string()
+        file_id, name_length = self.unpack_struct(entry3_head)
+        name = self.unpack_fstring(name_length)
         cookie = self.unpack_uhyper()
         return file_id, name, cookie
 
     def unpack_entry_plus(self):
-        fh = None
-        fileid, name, cookie = self.unpack_entry()
-        entry_attr = self.unpack_obj_attributes()
-        handle_follow = self.unpack_bool()
+        entry_attr = fh = None
+        fileid, name_length = self.unpack_struct(entry3_head)
+        name = self.unpack_fstring(name_length)
+        cookie, attributes_follow = self.unpack_struct(entry3_cookie)
+        if attributes_follow:
+            entry_attr, handle_follow = self.unpack_struct(entryplus3_attributes)
+        else:
+            handle_follow = self.unpack_bool()
         if handle_follow:
             fh = self.unpack_fh_attributes()
         return fileid, name, cookie, entry_attr, fh
 
-    def unpack_write_res(self):
+    def unpack_read_res(self):
+        """
+        struct READ3resok {
+           post_op_attr   file_attributes;
+           count3         count;
+           bool           eof;
+           opaque         data<>;
+        };
+        """
+        status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
+        attributes = self.unpack_obj_attributes()
+        count = self.unpack_uint()
+        eof = self.unpack_bool()
+        data = self.unpack_opaque()
+        return status, attributes, count, eof, data
+
+    def unpack_read_res_into(self, buffer):
+        """
+        Like unpack_read_res, but the data is copied straight out of the reply into buffer
+        :return: status, attributes, count, eof
+        """
         status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
-        self.unpack_dir_or_file_wcc()
-        # count
-        self.unpack_uint()
-        # committed
-        self.unpack_uint()
-        # committed:
-        self.unpack_uhyper()
+        attributes = self.unpack_obj_attributes()
+        count = self.unpack_uint()
+        eof = self.unpack_bool()
+        self.unpack_opaque_into(buffer)
+        return status, attributes, count, eof
+
+    def unpack_write_res(self):
+        status, _, _, _, _ = self.unpack_write_res_attributes()
         return status
 
+    def unpack_write_res_attributes(self):
+        """
+        Like unpack_write_res, but also returns the wcc data of the file, the number of bytes
+        written, how they were committed and the write verifier
+        """
+        status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
+        file_wcc = self.unpack_dir_or_file_wcc()
+        count = self.unpack_uint()
+        committed = self.unpack_enum()
+        verifier = self.unpack_fopaque(8)
+        return status, file_wcc, count, committed, verifier
+
+    def unpack_commit_res(self):
+        """
+        struct COMMIT3resok {
+           wcc_data   file_wcc;
+           writeverf3 verf;
+        };
+        """
+        status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
+        file_wcc = self.unpack_dir_or_file_wcc()
+        verifier = self.unpack_fopaque(8)
+        return status, file_wcc, verifier
+
     def unpack_create_res(self):
+        status, fh, _, _ = self.unpack_create_res_attributes()
+        return status, fh
+
+    def unpack_create_res_attributes(self):
+        """
+        Like unpack_create_res, but also returns the attributes of the new file and the wcc data
+        of the directory
+        """
         fh = None
         status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
         handle_follow = self.unpack_bool()
         if handle_follow:
             fh = self.unpack_fh_attributes()
-        self.unpack_obj_attributes()
-        self.unpack_dir_or_file_wcc()
-        return status, fh
-
+        obj_attributes = self.unpack_obj_attributes()
+        dir_wcc = self.unpack_dir_or_file_wcc()
+        return status, fh, obj_attributes, dir_wcc
 
     def unpack_dirop_res(self):
-        file_handle = None
+        status, file_handle, _, _ = self.unpack_dirop_res_attributes()
+        return status, file_handle
+
+    def unpack_dirop_res_attributes(self):
+        """
+        Like unpack_dirop_res, but also returns the post-op attributes of the object and the
+        directory
+        """
+        file_handle = obj_attributes = None
         status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK, NfsStat3.NFS3ERR_NOENT])
         if status == NfsStat3.NFS3_OK:
             file_handle = self.unpack_fhandle()
-            self.unpack_obj_attributes()
-            self.unpack_obj_attributes()
-        elif status == NfsStat3.NFS3ERR_NOENT:
-            self.unpack_obj_attributes()
-        return status, file_handle
+            obj_attributes = self.unpack_obj_attributes()
+            dir_attributes = self.unpack_obj_attributes()
+        else:
+            dir_attributes = self.unpack_obj_attributes()
+        return status, file_handle, obj_attributes, dir_attributes
 
     def unpack_attribute_status(self):
         status = verify_nfs_status(self.unpack_enum(), [NfsStat3.NFS3_OK])
@@ -288,20 +442,7 @@ class NFSUnpacker(MountUnpacker):
          nfstime3   ctime;
       };
         """
-        _type = self.unpack_enum()
-        mode = self.unpack_uint()
-        nlink = self.unpack_uint()
-        uid = self.unpack_uint()
-        gid = self.unpack_uint()
-        size = self.unpack_uhyper()
-        used = self.unpack_uhyper()
-        rdev = self.unpack_uhyper()
-        fsid = self.unpack_uhyper()
-        fileid = self.unpack_uhyper()
-        atime = self.unpack_timeval()
-        mtime = self.unpack_timeval()
-        ctime = self.unpack_timeval()
-        return _type, mode, nlink, uid, gid, size, used, rdev, fsid, fileid, atime, mtime, ctime
+        return self.unpack_struct(fattr3)
 
     def unpack_wcc_attr(self):
         """
@@ -311,21 +452,13 @@ class NFSUnpacker(MountUnpacker):
          nfstime3    ctime;
         };
         """
-        size = self.unpack_uhyper()
-        mtime = self.unpack_timeval()
-        ctime = self.unpack_timeval()
-        return size, mtime, ctime
+        return self.unpack_struct(wcc_attr)
 
     def unpack_timeval(self):
-        secs = self.unpack_uint()
-        usecs = self.unpack_uint()
-        return (secs, usecs)
+        return self.unpack_struct(nfstime3)
 
 
-class NFSClient(TCPClient):
-
-    def __init__(self, host):
-        TCPClient.__init__(self, host, NFS_PROGRAM, NFS_VERSION)
+class PartialNFSClient:
 
     def addpackers(self):
         self.packer = NFSPacker()
@@ -361,6 +494,11 @@ class NFSClient(TCPClient):
                               self.packer.pack_readdirplus,
                               self.unpacker.unpack_readdirplus)
 
+    def read(self, ra):
+        return self.make_call(6, ra,
+                              self.packer.pack_read_args,
+                              self.unpacker.unpack_read_res)
+
     def write(self, wa):
         return self.make_call(7, wa,
                               self.packer.pack_write_args,
@@ -376,23 +514,303 @@ class NFSClient(TCPClient):
                               self.packer.pack_fs_info_args,
                               self.unpacker.unpack_fsinfo_res)
 
-    def listdir_wrapper(self, dir_handle):
-        list_dir = []
-        ra = (dir_handle, 0, 0, 2000, 2000)
-        while 1:
-            status, dir_params, rest = self.read_dir_plus(ra)
-            if status != NfsStat3.NFS3_OK:
-                print ("Server returned {}".format(status))
-                break
-            entries, eof = rest
-            last_cookie = None
-            for file_id, dir_or_file_name, dir_params, cookie, fh in entries:
-                list_dir.append((file_id, dir_or_file_name))
-                last_cookie = cookie
-            if eof or last_cookie is None:
+    def commit(self, ca):
+        return self.make_call(21, ca,
+                              self.packer.pack_commitargs,
+                              self.unpacker.unpack_commit_res)
+
+
+class NFSClient(PartialNFSClient, TCPClient):
+    # Shared by all clients of the process, set to None to always ask the server
+    name_cache = nfscache.name_cache
+    attribute_cache = nfscache.attribute_cache
+    directory_cache = nfscache.directory_cache
+
+    def __init__(self, host):
+        TCPClient.__init__(self, host, NFS_PROGRAM, NFS_VERSION)
+
+    def _observe_attributes(self, fh, attributes):
+        if self.attribute_cache is not None:
+            self.attribute_cache.set(self.host, fh, attributes)
+        if self.name_cache is not None and attributes is not None and \
+                attributes[nfscache.FATTR3_TYPE] == nfscache.NF3DIR:
+            self.name_cache.observe_dir(self.host, fh, attributes)
+
+    def _observe_wcc(self, fh, wcc):
+        if self.attribute_cache is not None:
+            self.attribute_cache.observe_wcc(self.host, fh, wcc)
+
+    def getattr(self, fh):
+        if self.attribute_cache is not None:
+            attributes = self.attribute_cache.get(self.host, fh)
+            if attributes is not None:
+                return NfsStat3.NFS3_OK, attributes
+        status, attributes = PartialNFSClient.getattr(self, fh)
+        self._observe_attributes(fh, attributes)
+        return status, attributes
+
+    def setattr(self, sa):
+        if self.attribute_cache is not None:
+            self.attribute_cache.invalidate(self.host, sa[0])
+        return PartialNFSClient.setattr(self, sa)
+
+    def read_dir_plus(self, ra):
+        status, dir_attributes, verifier, entries, eof = self.read_dir_plus_page(ra)
+        return status, dir_attributes, (entries, eof)
+
+    def read_dir_plus_page(self, ra):
+        """
+        READDIRPLUS, also returning the cookie verifier to continue with
+        :return: status, dir attributes, verifier, entries, eof
+        """
+        status, dir_attributes, verifier, entries, eof = self.make_call(17, ra,
+                                                                         self.packer.pack_readdirplus,
+                                                                         self.unpacker.unpack_readdirplus_page)
+        self._observe_attributes(ra["dir"], dir_attributes)
+        name_cache = self.name_cache if dir_attributes is not None else None
+        for fileid, name, cookie, attributes, fh in entries:
+            if fh is None:
+                continue
+            self._observe_attributes(fh, attributes)
+            if name_cache is not None and name not in (b'.', b'..'):
+                name_cache.set(self.host, ra["dir"], name.decode(errors='surrogateescape'), fh)
+        return status, dir_attributes, verifier, entries, eof
+
+    def read_dir_plus_async(self, ra, callback=None):
+        """
+        Send a READDIRPLUS without waiting for it. Unlike read_dir_plus the caches are not fed,
+        so crawling a large tree does not flush them.
+        :return: future of (status, dir attributes, verifier, entries, eof)
+        """
+        return self.call_async(17, ra,
+                               self.packer.pack_readdirplus,
+                               self.unpacker.unpack_readdirplus_page,
+                               callback)
+
+    def read_dir_plus_columns_async(self, ra, listing, callback=None):
+        """
+        Send a READDIRPLUS without waiting for it; the entries of the reply are appended to
+        listing (see nfscolumns). The caches are not fed.
+        :return: future of (status, dir attributes, verifier, number of entries, eof)
+        """
+        return self.call_async(17, ra,
+                               self.packer.pack_readdirplus,
+                               partial(self.unpacker.unpack_readdirplus_columns, listing),
+                               callback)
+
+    def write(self, wa):
+        status, file_wcc, count, committed, verifier = self.make_call(7, wa,
+                                                                      self.packer.pack_write_args,
+                                                                      self.unpacker.unpack_write_res_attributes)
+        self._observe_wcc(wa["file"], file_wcc)
+        return status
+
+    def read(self, ra):
+        status, attributes, count, eof, data = PartialNFSClient.read(self, ra)
+        self._observe_attributes(ra["file"], attributes)
+        return status, attributes, count, eof, data
+
+    def read_into_async(self, ra, buffer, callback=None):
+        """
+        Send a READ without waiting for it; the data of the reply is decoded straight into buffer,
+        which must have room for ra["count"] bytes
+        :return: future of (status, attributes, count, eof)
+        """
+        future = self.call_async(6, ra,
+                                 self.packer.pack_read_args,
+                                 partial(self.unpacker.unpack_read_res_into, buffer))
+        future.add_done_callback(partial(self._observe_read, ra["file"]))
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def read_into(self, ra, buffer):
+        return self.read_into_async(ra, buffer).result()
+
+    def _observe_read(self, fh, future):
+        if not future.cancelled() and future.exception() is None:
+            self._observe_attributes(fh, future.result()[1])
+
+    def write_async(self, wa, callback=None):
+        """
+        Send a WRITE without waiting for it, see rpc.Client.call_async
+        :return: future of (status, file_wcc, count, committed, verifier)
+        """
+        future = self.call_async(7, wa,
+                                 self.packer.pack_write_args,
+                                 self.unpacker.unpack_write_res_attributes)
+        future.add_done_callback(partial(self._observe_write, wa["file"]))
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def _observe_write(self, fh, future):
+        if not future.cancelled() and future.exception() is None:
+            self._observe_wcc(fh, future.result()[1])
+
+    def commit(self, ca):
+        status, file_wcc, verifier = PartialNFSClient.commit(self, ca)
+        self._observe_wcc(ca[0], file_wcc)
+        return status, file_wcc, verifier
+
+    def fsinfo(self, fh):
+        fsinfo = PartialNFSClient.fsinfo(self, fh)
+        self._observe_attributes(fh, fsinfo[0])
+        return fsinfo
+
+    def lookup(self, da):
+        cached = self._cached_lookup(da)
+        if cached is not None:
+            return cached
+        return self._observe_lookup(da, self.make_call(3, da,
+                                                       self.packer.pack_diropargs,
+                                                       self.unpacker.unpack_dirop_res_attributes))
+
+    def lookup_async(self, da, callback=None):
+        """
+        Send a LOOKUP without waiting for it, unless the name cache already knows the answer
+        :return: future of (status, fh)
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        cached = self._cached_lookup(da)
+        if cached is not None:
+            future.set_result(cached)
+            return future
+        call = self.call_async(3, da,
+                               self.packer.pack_diropargs,
+                               self.unpacker.unpack_dirop_res_attributes)
+        call.add_done_callback(partial(self._complete_lookup, da, future))
+        return future
+
+    def _complete_lookup(self, da, future, call):
+        if call.cancelled():
+            future.cancel()
+        elif call.exception() is not None:
+            future.set_exception(call.exception())
+        else:
+            future.set_result(self._observe_lookup(da, call.result()))
+
+    def _cached_lookup(self, da):
+        name_cache = self.name_cache
+        if self.attribute_cache is not None and not self.attribute_cache.is_valid(self.host, da["dir"]):
+            # The directory may have changed since its entries were cached: ask the server, whose
+            # reply carries the directory's attributes, like the kernel revalidates its dcache
+            return None
+        if name_cache is not None:
+            fh = name_cache.get(self.host, da["dir"], da["Name"])
+            if fh is not name_cache.MISS:
+                return (NfsStat3.NFS3_OK, fh) if fh is not None else (NfsStat3.NFS3ERR_NOENT, None)
+        return None
+
+    def _observe_lookup(self, da, result):
+        status, fh, obj_attributes, dir_attributes = result
+        self._observe_attributes(da["dir"], dir_attributes)
+        if fh is not None:
+            self._observe_attributes(fh, obj_attributes)
+        if self.name_cache is not None:
+            self.name_cache.set(self.host, da["dir"], da["Name"], fh)
+        return status, fh
+
+    def resolve(self, export_handle, path):
+        """
+        Look up a path of several components, e.g. "a/b/c/file", relative to export_handle.
+        Intermediate directories come from the name cache where possible.
+        :return: (status, fh), the status of the first component that could not be looked up
+        """
+        return self.resolve_many(export_handle, [path])[path]
+
+    def resolve_many(self, export_handle, paths, window=64):
+        """
+        Resolve many paths relative to export_handle at once. The paths are walked level by level:
+        every distinct directory is looked up only once, and the LOOKUPs of a level are in flight
+        together, up to window of them, so the cost is about one round-trip per level instead of
+        one per component of every path.
+        :return: {path: (status, fh)}
+        """
+        components = {path: tuple(name for name in path.split('/') if name not in ('', '.'))
+                      for path in paths}
+        resolved = {(): (NfsStat3.NFS3_OK, export_handle)}
+        stale = set()           # prefixes whose directory handle was stale
+        retried = set()         # directories looked up again after their handle was stale
+        depth = 0
+        while True:
+            prefixes = {parts[:depth + 1] for parts in components.values()
+                        if len(parts) > depth and parts[:depth + 1] not in resolved
+                        and resolved[parts[:depth]][0] == NfsStat3.NFS3_OK}
+            if not prefixes:
                 break
-            ra = (ra[0], last_cookie, ra[1], ra[2])
-        return list_dir
+            in_flight = deque()
+            for prefix in prefixes:
+                if len(in_flight) >= window:
+                    self._collect_lookup(in_flight, resolved, stale)
+                da = {"dir": resolved[prefix[:-1]][1], "Name": prefix[-1]}
+                in_flight.append((prefix, self.lookup_async(da)))
+            while in_flight:
+                self._collect_lookup(in_flight, resolved, stale)
+            retry = {prefix[:-1] for prefix in stale} - retried
+            stale.clear()
+            if retry:
+                # The cached handles of these directories are stale, look them up once more
+                retried |= retry
+                for directory in retry:
+                    if self.name_cache is not None:
+                        self.name_cache.remove(self.host, resolved[directory[:-1]][1], directory[-1])
+                for prefix in [prefix for prefix in resolved
+                               if any(prefix[:len(directory)] == directory for directory in retry)]:
+                    del resolved[prefix]
+                depth = min(len(directory) for directory in retry) - 1
+                continue
+            depth += 1
+        results = {}
+        for path, parts in components.items():
+            length = 0
+            while length < len(parts) and resolved[parts[:length]][0] == NfsStat3.NFS3_OK:
+                length += 1
+            results[path] = resolved[parts[:length]]
+        return results
+
+    @staticmethod
+    def _collect_lookup(in_flight, resolved, stale):
+        prefix, future = in_flight.popleft()
+        try:
+            resolved[prefix] = future.result()
+        except UnexpectedNfsStatus as e:
+            if e.status in STALE_HANDLE_STATUSES:
+                if len(prefix) == 1:
+                    # The export handle itself is stale, the caller has to mount again
+                    raise
+                stale.add(prefix)
+            resolved[prefix] = (e.status, None)
+
+    def create(self, ca):
+        status, fh, obj_attributes, dir_wcc = self.make_call(8, ca,
+                                                             self.packer.pack_create_args,
+                                                             self.unpacker.unpack_create_res_attributes)
+        where = ca["where"]
+        self._observe_wcc(where["dir"], dir_wcc)
+        if fh is not None:
+            self._observe_attributes(fh, obj_attributes)
+        name_cache = self.name_cache
+        if name_cache is not None:
+            name_cache.observe_dir_change(self.host, where["dir"], dir_wcc)
+            name_cache.set(self.host, where["dir"], where["Name"], fh)
+        if self.directory_cache is not None:
+            self.directory_cache.invalidate(self.host, where["dir"])
+        return status, fh
+
+    def listdir_wrapper(self, dir_handle):
+        # nfswalk imports this module
+        from nfswalk import listdir
+        return [(file_id, dir_or_file_name) for file_id, dir_or_file_name, cookie, attributes, fh
+                in listdir(self, dir_handle)]
+
+
+class AsyncNFSClient(PartialNFSClient, AsyncTCPClient):
+
+    def __init__(self, host):
+        AsyncTCPClient.__init__(self, host, NFS_PROGRAM, NFS_VERSION)
 
 
 def verify_nfs_status(status, allowed_statuses):
@@ -402,5 +820,6 @@ def verify_nfs_status(status, allowed_statuses):
     :type allowed_statuses: list
     """
     if NfsStat3(status) not in allowed_statuses:
-        raise UnexpectedNfsStatus(f"{NfsStat3(status).name} ({NfsStat3(status).value})")
+        raise UnexpectedNfsStatus(f"{NfsStat3(status).name} ({NfsStat3(status).value})",
+                                  NfsStat3(status))
     return NfsStat3(status)
@@ -0,0 +1,170 @@
+# Columnar READDIRPLUS listings.
+#
+# A directory of millions of entries costs gigabytes as tuples of tuples.
+# A ColumnarListing keeps every entry's fixed-width fields as one record in a
+# single bytearray, in the big-endian layout they have on the wire, and the
+# names and file handles in byte arenas with offset arrays: about 200 bytes
+# per entry instead of well over a kilobyte.
+#
+# With numpy installed, to_numpy() views the records as a structured array
+# without copying them, so filtering and sorting are vectorized:
+#
+#     listing = listdir_columns(nfs_client, dir_handle)
+#     records = listing.to_numpy()
+#     for i in numpy.argsort(records['size'])[-10:]:
+#         print(listing.name(i), records['size'][i])
+
+import struct
+from array import array
+
+from nfsclient import entry3_cookie, entry3_head, fattr3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# entryplus3 fields kept in a record, in wire order after the leading ones
+RECORD_FIELDS = ['fileid', 'cookie', 'has_attributes',
+                 'type', 'mode', 'nlink', 'uid', 'gid', 'size', 'used', 'rdev', 'fsid', 'attr_fileid',
+                 'atime_seconds', 'atime_nseconds', 'mtime_seconds', 'mtime_nseconds',
+                 'ctime_seconds', 'ctime_nseconds']
+
+record_head = struct.Struct('>QQI')
+record = struct.Struct(record_head.format + fattr3.struct.format[1:])
+
+_bool = struct.Struct('>I')
+_NO_ATTRIBUTES = bytes(fattr3.size)
+
+
+def _numpy_dtype():
+    codes = {'I': '>u4', 'i': '>i4', 'Q': '>u8'}
+    return numpy.dtype([(name, codes[code]) for name, code in zip(RECORD_FIELDS, record.format[1:])])
+
+
+class ColumnarListing:
+    """
+    Directory entries in columnar form. Entry i is the i-th record; entries without attributes
+    have has_attributes 0 and zeroed attribute fields, entries without a file handle an empty one.
+    """
+
+    def __init__(self):
+        self.records = bytearray()
+        self.names = bytearray()
+        self.name_offsets = array('Q', [0])
+        self.handles = bytearray()
+        self.handle_offsets = array('Q', [0])
+        self.last_cookie = 0
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.entry(i)
+
+    def name(self, i):
+        return bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]])
+
+    def fh(self, i):
+        fh = bytes(self.handles[self.handle_offsets[i]:self.handle_offsets[i + 1]])
+        return fh or None
+
+    def attributes(self, i):
+        """
+        :return: the entry's attributes as an unpacked fattr3, None if the server sent none
+        """
+        values = record.unpack_from(self.records, i * record.size)
+        if not values[2]:
+            return None
+        return fattr3.build(values[3:])
+
+    def entry(self, i):
+        """
+        :return: (fileid, name, cookie, attributes, fh), as NFSUnpacker.unpack_entry_plus
+        """
+        fileid, cookie, _ = record_head.unpack_from(self.records, i * record.size)
+        return fileid, self.name(i), cookie, self.attributes(i), self.fh(i)
+
+    def column(self, name):
+        """
+        One field of every entry, e.g. column('size')
+        :rtype: array.array
+        """
+        index = RECORD_FIELDS.index(name)
+        return array(record.format[1 + index], (values[index] for values in record.iter_unpack(self.records)))
+
+    def to_numpy(self):
+        """
+        The records as a numpy structured array with the fields of RECORD_FIELDS. The array is a
+        view on the listing, which must not be extended while it is in use.
+        """
+        if numpy is None:
+            raise ImportError('to_numpy() requires numpy')
+        return numpy.frombuffer(self.records, dtype=_numpy_dtype())
+
+    def _truncate(self, lengths, last_cookie):
+        # Drop the entries of a partly decoded page, so records, arenas and offsets agree again
+        records, names, name_offsets, handles, handle_offsets = lengths
+        del self.records[records:]
+        del self.names[names:]
+        del self.name_offsets[name_offsets:]
+        del self.handles[handles:]
+        del self.handle_offsets[handle_offsets:]
+        self.last_cookie = last_cookie
+
+    def unpack_entries(self, unpacker):
+        """
+        Append the entryplus3 list at the unpacker's position, the way NFSUnpacker.unpack_list
+        would read it, without building a tuple per entry. If the list is cut short, nothing is
+        appended and EOFError is raised.
+        :return: number of entries appended
+        """
+        buf = unpacker.buf
+        pos = unpacker.pos
+        records = self.records
+        names = self.names
+        handles = self.handles
+        head_size = entry3_head.size
+        cookie_size = entry3_cookie.size
+        attributes_size = fattr3.size
+        count = 0
+        lengths = len(records), len(names), len(self.name_offsets), len(handles), len(self.handle_offsets)
+        last_cookie = self.last_cookie
+        try:
+            while True:
+                follows, = _bool.unpack_from(buf, pos)
+                pos += 4
+                if not follows:
+                    break
+                fileid, name_length = entry3_head.struct.unpack_from(buf, pos)
+                pos += head_size
+                names += buf[pos:pos + name_length]
+                self.name_offsets.append(len(names))
+                pos += (name_length + 3) & ~3
+                cookie, attributes_follow = entry3_cookie.struct.unpack_from(buf, pos)
+                pos += cookie_size
+                records += record_head.pack(fileid, cookie, attributes_follow)
+                if attributes_follow:
+                    records += buf[pos:pos + attributes_size]
+                    pos += attributes_size
+                else:
+                    records += _NO_ATTRIBUTES
+                handle_follows, = _bool.unpack_from(buf, pos)
+                pos += 4
+                if handle_follows:
+                    handle_length, = _bool.unpack_from(buf, pos)
+                    pos += 4
+                    handles += buf[pos:pos + handle_length]
+                    pos += (handle_length + 3) & ~3
+                self.handle_offsets.append(len(handles))
+                self.last_cookie = cookie
+                count += 1
+        except struct.error:
+            self._truncate(lengths, last_cookie)
+            raise EOFError from None
+        if pos > len(buf):
+            self._truncate(lengths, last_cookie)
+            raise EOFError
+        unpacker.pos = pos
+        return count
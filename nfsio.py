@@ -0,0 +1,411 @@
+# Bulk data transfer on top of NFSClient, sized from FSINFO and pipelined
+# over the client's connection (see rpc.Client.call_async).
+
+import io
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+from nfsclient import StableHow
+from packer_arguments import get_packer_arguments
+
+# Used when the server does not state a preferred size
+DEFAULT_TRANSFER_SIZE = 32768
+# Number of READ/WRITE calls kept in flight
+DEFAULT_WINDOW = 8
+
+FATTR3_FSID = 8
+FATTR3_SIZE = 5
+
+TransferSizes = namedtuple('TransferSizes', ['read', 'write', 'readdir'])
+
+
+class WriteVerifierChanged(Exception):
+    pass
+
+
+class WriteStalled(Exception):
+    pass
+
+
+def _check_progress(offset, count):
+    # A server that keeps writing nothing would have the rest sent forever
+    if count == 0:
+        raise WriteStalled(f"the server wrote nothing at offset {offset}, also when sent again")
+
+
+_transfer_sizes = {}
+_transfer_sizes_lock = threading.Lock()
+
+
+def _preferred(pref, maximum):
+    size = pref or maximum or DEFAULT_TRANSFER_SIZE
+    return min(size, maximum) if maximum else size
+
+
+def transfer_sizes(client, fh):
+    """
+    Preferred READ, WRITE and READDIR sizes of the file system fh lives on, from FSINFO.
+    FSINFO is asked once per (host, fsid).
+    :rtype: TransferSizes
+    """
+    _, attributes = client.getattr(fh)
+    key = (client.host, attributes[FATTR3_FSID])
+    with _transfer_sizes_lock:
+        sizes = _transfer_sizes.get(key)
+    if sizes is None:
+        attr, rtmax, rtpref, rtmult, wtmax, wtpref, wtmult, dtpref, time_delta, properties, \
+            max_file_size = client.fsinfo(fh)
+        sizes = TransferSizes(_preferred(rtpref, rtmax), _preferred(wtpref, wtmax), dtpref)
+        with _transfer_sizes_lock:
+            _transfer_sizes[key] = sizes
+    return sizes
+
+
+def _write_args(fh, offset, data, stable):
+    return get_packer_arguments("WRITE", file=fh, offset=offset, count=len(data), stable=stable, data=data)
+
+
+def _write_chunks(client, fh, data, offset, chunk_size, window):
+    """
+    Send data as UNSTABLE WRITEs of chunk_size bytes with up to window of them in flight
+    :return: the write verifiers of every reply that was not committed to stable storage yet
+    """
+    verifiers = set()
+    in_flight = deque()
+
+    def collect():
+        future, chunk_offset, chunk = in_flight.popleft()
+        status, file_wcc, count, committed, verifier = future.result()
+        while count < len(chunk):
+            # Short write, send the rest of the chunk again
+            chunk, chunk_offset = chunk[count:], chunk_offset + count
+            status, file_wcc, count, committed, verifier = client.write_async(
+                _write_args(fh, chunk_offset, chunk, StableHow.UNSTABLE.value)).result()
+            _check_progress(chunk_offset, count)
+            if committed != StableHow.FILE_SYNC.value:
+                verifiers.add(verifier)
+        if committed != StableHow.FILE_SYNC.value:
+            verifiers.add(verifier)
+
+    for start in range(0, len(data), chunk_size):
+        if len(in_flight) >= window:
+            collect()
+        chunk = data[start:start + chunk_size]
+        future = client.write_async(_write_args(fh, offset + start, chunk, StableHow.UNSTABLE.value))
+        in_flight.append((future, offset + start, chunk))
+    while in_flight:
+        collect()
+    return verifiers
+
+
+def write_stable(client, fh, data, offset=0, stable=StableHow.FILE_SYNC.value):
+    """
+    Write data at offset with one WRITE at a time, asking for stable, and send the rest again
+    after a short write. A status other than NFS3_OK raises UnexpectedNfsStatus.
+    :param data: bytes-like object, at most wtmax bytes
+    :return: (committed, verifier) of the last reply
+    """
+    data = memoryview(data).cast('B')
+    resent = False
+    while True:
+        status, file_wcc, count, committed, verifier = client.write_async(
+            _write_args(fh, offset, data, stable)).result()
+        if resent:
+            _check_progress(offset, count)
+        if count >= len(data):
+            return committed, verifier
+        data, offset, resent = data[count:], offset + count, True
+
+
+def write_file(client, fh, data, offset=0, window=DEFAULT_WINDOW, max_resends=3):
+    """
+    Write data at offset as wtpref-sized UNSTABLE WRITEs, keeping up to window of them in flight,
+    and make it stable with a single COMMIT. If the server's write verifier changed in between
+    (e.g. it rebooted and lost uncommitted data), everything is sent again.
+    :param data: bytes-like object
+    :return: number of bytes written
+    """
+    data = memoryview(data).cast('B')
+    if not data:
+        return 0
+    chunk_size = transfer_sizes(client, fh).write
+    for _ in range(max_resends + 1):
+        verifiers = _write_chunks(client, fh, data, offset, chunk_size, window)
+        if not verifiers:
+            # The server committed every chunk synchronously
+            return len(data)
+        status, file_wcc, verifier = client.commit((fh, offset, len(data)))
+        if verifiers == {verifier}:
+            return len(data)
+    raise WriteVerifierChanged(f"write verifier kept changing, gave up after {max_resends} resends")
+
+
+def _read_args(fh, offset, count):
+    return get_packer_arguments("READ", file=fh, offset=offset, count=count)
+
+
+def read_file_into(client, fh, buffer, offset=0, window=DEFAULT_WINDOW):
+    """
+    Fill buffer with the file's data from offset on, with rtpref-sized READs of which up to window
+    are in flight. Every reply is decoded straight into its part of buffer.
+    :param buffer: writable bytes-like object
+    :return: number of bytes read, less than len(buffer) only at end of file
+    """
+    view = memoryview(buffer).cast('B')
+    chunk_size = transfer_sizes(client, fh).read
+    in_flight = deque()
+    position = 0
+    total = 0
+    eof = False
+    while in_flight or (position < len(view) and not eof):
+        while position < len(view) and not eof and len(in_flight) < window:
+            chunk = view[position:position + chunk_size]
+            in_flight.append((position, len(chunk),
+                              client.read_into_async(_read_args(fh, offset + position, len(chunk)), chunk)))
+            position += len(chunk)
+        start, requested, future = in_flight.popleft()
+        status, attributes, count, chunk_eof = future.result()
+        if eof:
+            # Read beyond the end of the file
+            continue
+        if 0 < count < requested and not chunk_eof:
+            # Short read in the middle of the file, get the rest of this chunk
+            count += read_file_into(client, fh, view[start + count:start + requested],
+                                    offset + start + count, window=1)
+        total = start + count
+        eof = chunk_eof or count < requested
+    return total
+
+
+class ReadAhead:
+    """
+    Reads one file through a client. As long as the reads are sequential, the following
+    rtpref-sized chunks are requested ahead of time, keeping up to window READs in flight, so a
+    sequential reader is served at link speed instead of one round-trip per chunk. A read that does
+    not continue where the previous one ended drops the read-ahead and goes to the server directly.
+    """
+
+    def __init__(self, client, fh, window=DEFAULT_WINDOW):
+        self.client = client
+        self.fh = fh
+        self.window = window
+        self.chunk_size = transfer_sizes(client, fh).read
+        self.next_offset = 0
+        self.end = None                 # end of file, once seen
+        self.chunks = OrderedDict()     # chunk offset -> (future, buffer)
+
+    def readinto(self, offset, buffer):
+        """
+        :return: number of bytes read into buffer, 0 at end of file
+        """
+        view = memoryview(buffer).cast('B')
+        if offset != self.next_offset:
+            self.chunks.clear()
+            count = read_file_into(self.client, self.fh, view, offset, self.window)
+        else:
+            count = self._read_ahead(offset, view)
+        self.next_offset = offset + count
+        return count
+
+    def invalidate(self, offset, length):
+        """
+        Forget what was read ahead after length bytes were written at offset. A write past the end
+        of file seen moves the end, so it is not known anymore.
+        """
+        self.chunks.clear()
+        if self.end is not None and offset + length > self.end:
+            self.end = None
+            self.next_offset = None
+
+    def _read_ahead(self, offset, view):
+        total = 0
+        while total < len(view):
+            position = offset + total
+            chunk_offset = position - position % self.chunk_size
+            self._schedule(chunk_offset)
+            if chunk_offset not in self.chunks:
+                break
+            future, chunk = self.chunks[chunk_offset]
+            status, attributes, count, eof = future.result()
+            if eof:
+                self.end = chunk_offset + count
+            skip = position - chunk_offset
+            if skip >= count:
+                del self.chunks[chunk_offset]
+                if eof or count == 0:
+                    break
+                # Short read in the middle of the file
+                count = read_file_into(self.client, self.fh, view[total:], position, window=1)
+                total += count
+                if count == 0:
+                    break
+                continue
+            n = min(count - skip, len(view) - total)
+            view[total:total + n] = chunk[skip:skip + n]
+            total += n
+            if skip + n == count:
+                del self.chunks[chunk_offset]
+        return total
+
+    def _schedule(self, chunk_offset):
+        for i in range(self.window):
+            start = chunk_offset + i * self.chunk_size
+            if self.end is not None and start >= self.end:
+                break
+            if start not in self.chunks:
+                chunk = bytearray(self.chunk_size)
+                future = self.client.read_into_async(_read_args(self.fh, start, self.chunk_size), chunk)
+                self.chunks[start] = (future, chunk)
+        # Drop chunks the reader has moved past
+        for start in [start for start in self.chunks if start < chunk_offset]:
+            del self.chunks[start]
+
+
+class NFSFile(io.RawIOBase):
+    """
+    File object over an NFS file handle:
+
+        with NFSFile(nfs_client, fh) as f:
+            f.seek(0, io.SEEK_END)
+            f.write(b'log line\n')
+
+    Writes are write-behind: sequential writes are coalesced into wtpref-sized UNSTABLE WRITEs that
+    are sent as soon as they are full, with up to window of them in flight, and flush() sends the
+    rest, waits for the replies and COMMITs. Data that was not committed yet is kept, so it can be
+    sent again if the server's write verifier changes. Sequential reads go through a ReadAhead.
+    The client is shared, not owned: closing the file does not close it.
+    """
+
+    def __init__(self, client, fh, window=DEFAULT_WINDOW, commit_threshold=16 * 1024 * 1024):
+        """
+        :param commit_threshold: uncommitted bytes after which a write COMMITs, bounding the data
+                                 kept for resending
+        """
+        io.RawIOBase.__init__(self)
+        self.client = client
+        self.fh = fh
+        self.window = window
+        self.commit_threshold = commit_threshold
+        self.chunk_size = transfer_sizes(client, fh).write
+        self.position = 0
+        self.read_ahead = ReadAhead(client, fh, window)
+        self.write_offset = 0
+        self.write_buffer = bytearray()
+        self.in_flight = deque()        # (future, offset, data, resent)
+        self.uncommitted = []           # (offset, data, verifier) of UNSTABLE writes
+        self.uncommitted_size = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        self._check_closed()
+        self._drain()
+        count = self.read_ahead.readinto(self.position, buffer)
+        self.position += count
+        return count
+
+    def write(self, data):
+        self._check_closed()
+        data = memoryview(data).cast('B')
+        if self.write_buffer and self.write_offset + len(self.write_buffer) != self.position:
+            # Not sequential, the buffered data goes out first
+            self._send(self.write_buffer)
+            self.write_buffer = bytearray()
+        if not self.write_buffer:
+            self.write_offset = self.position
+        self.write_buffer += data
+        full = len(self.write_buffer) - len(self.write_buffer) % self.chunk_size
+        if full:
+            self._send(self.write_buffer[:full])
+            del self.write_buffer[:full]
+            self.write_offset += full
+        # Whatever was read ahead may be stale now
+        self.read_ahead.invalidate(self.position, len(data))
+        self.position += len(data)
+        if self.uncommitted_size > self.commit_threshold:
+            self._commit()
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            self._drain()
+            _, attributes = self.client.getattr(self.fh)
+            position = attributes[FATTR3_SIZE] + offset
+        else:
+            raise ValueError(f'invalid whence ({whence})')
+        if position < 0:
+            raise ValueError(f'negative seek position {position}')
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if not self.closed:
+            self._commit()
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+    def _send(self, data):
+        # One copy, which the chunks in flight and the uncommitted chunks then only reference
+        data = memoryview(bytes(data))
+        offset = self.write_offset
+        for start in range(0, len(data), self.chunk_size):
+            if len(self.in_flight) >= self.window:
+                self._collect()
+            chunk = data[start:start + self.chunk_size]
+            future = self.client.write_async(_write_args(self.fh, offset + start, chunk,
+                                                         StableHow.UNSTABLE.value))
+            self.in_flight.append((future, offset + start, chunk, False))
+
+    def _collect(self):
+        future, offset, data, resent = self.in_flight.popleft()
+        status, file_wcc, count, committed, verifier = future.result()
+        if resent:
+            _check_progress(offset, count)
+        if count < len(data):
+            # Short write, send the rest again
+            self.in_flight.appendleft((self.client.write_async(
+                _write_args(self.fh, offset + count, data[count:], StableHow.UNSTABLE.value)),
+                offset + count, data[count:], True))
+            data = data[:count]
+        if committed != StableHow.FILE_SYNC.value:
+            self.uncommitted.append((offset, data, verifier))
+            self.uncommitted_size += len(data)
+
+    def _drain(self):
+        # Send the buffered data and wait for every reply
+        if self.write_buffer:
+            self._send(self.write_buffer)
+            self.write_buffer = bytearray()
+        while self.in_flight:
+            self._collect()
+
+    def _commit(self):
+        self._drain()
+        if not self.uncommitted:
+            return
+        # A status other than NFS3_OK raises UnexpectedNfsStatus, keeping the data uncommitted
+        status, file_wcc, verifier = self.client.commit((self.fh, 0, 0))
+        stale = [(offset, data) for offset, data, written_with in self.uncommitted
+                 if written_with != verifier]
+        for offset, data in stale:
+            # The server lost these (e.g. it rebooted), they are written again synchronously
+            write_stable(self.client, self.fh, data, offset)
+        self.uncommitted = []
+        self.uncommitted_size = 0
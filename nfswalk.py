@@ -0,0 +1,179 @@
+# Crawling directory trees with READDIRPLUS.
+#
+# Every entry of a READDIRPLUS reply carries the entry's file handle and
+# attributes, so a tree is crawled without a single LOOKUP or GETATTR.
+# Entries are handed out as their page arrives, and the listings of many
+# directories are in flight at once, over one or several connections.
+#
+#     for entry in walk(nfs_client, export_handle):
+#         if not entry.is_dir():
+#             print(entry.path, entry.attributes[FATTR3_SIZE])
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import count
+
+from nfscache import FATTR3_SIZE, FATTR3_TYPE, NF3DIR
+from nfscolumns import ColumnarListing
+from nfsclient import NfsStat3, UnexpectedNfsStatus
+from nfsio import transfer_sizes
+from packer_arguments import get_packer_arguments
+
+# READDIRPLUS calls kept in flight by walk()
+DEFAULT_WORKERS = 16
+
+
+class Entry(namedtuple('Entry', ['path', 'name', 'fileid', 'fh', 'attributes'])):
+    """
+    A directory entry. path is relative to the directory the walk started at; fh and attributes
+    are None if the server did not return them.
+    """
+    __slots__ = ()
+
+    def is_dir(self):
+        return self.attributes is not None and self.attributes[FATTR3_TYPE] == NF3DIR
+
+    @property
+    def size(self):
+        return self.attributes[FATTR3_SIZE] if self.attributes is not None else None
+
+
+def _page_args(dir_handle, cookie, verifier, sizes):
+    # dtpref of directory data per page; the reply also carries handles and attributes, so it
+    # may be as large as a READ
+    return get_packer_arguments("READDIRPLUS", dir=dir_handle, cookie=cookie, verifier=verifier,
+                                count=sizes.readdir, maxcount=sizes.read)
+
+
+def _entries(path, entries):
+    for fileid, name, cookie, attributes, fh in entries:
+        if name in (b'.', b'..'):
+            continue
+        name = name.decode(errors='surrogateescape')
+        yield Entry(f'{path}/{name}' if path else name, name, fileid, fh, attributes)
+
+
+def listdir(client, dir_handle, max_restarts=3):
+    """
+    All entries of a directory, as returned by READDIRPLUS. The listing is kept in
+    client.directory_cache and handed out again without any READDIRPLUS while the directory's
+    mtime and ctime stay the same (as far as client.getattr knows); a listing that ended with an
+    empty page before eof is not.
+    :param max_restarts: how often to start over when the server rejects a cookie because the
+                         directory changed during the listing
+    :return: tuple of (fileid, name, cookie, attributes, fh)
+    """
+    directory_cache = client.directory_cache
+    if directory_cache is not None:
+        _, attributes = client.getattr(dir_handle)
+        entries = directory_cache.get(client.host, dir_handle, attributes)
+        if entries is not None:
+            return entries
+    sizes = transfer_sizes(client, dir_handle)
+    for restart in range(max_restarts + 1):
+        entries = []
+        cookie = verifier = 0
+        eof = False
+        try:
+            while not eof:
+                status, dir_attributes, verifier, page, eof = client.read_dir_plus_page(
+                    _page_args(dir_handle, cookie, verifier, sizes))
+                if not page:
+                    # No cookie to go on from: the listing stops here, but it is not complete
+                    break
+                entries.extend(page)
+                cookie = page[-1][2]
+        except UnexpectedNfsStatus as e:
+            if e.status != NfsStat3.NFS3ERR_BAD_COOKIE or restart == max_restarts:
+                raise
+            continue
+        entries = tuple(entries)
+        if directory_cache is not None and eof:
+            directory_cache.set(client.host, dir_handle, dir_attributes, entries)
+        return entries
+
+
+def listdir_columns(client, dir_handle, max_restarts=3):
+    """
+    All entries of a directory as an nfscolumns.ColumnarListing, for directories too large to
+    hold as tuples. Not cached, see listdir.
+    """
+    sizes = transfer_sizes(client, dir_handle)
+    for restart in range(max_restarts + 1):
+        listing = ColumnarListing()
+        verifier = 0
+        eof = False
+        try:
+            while not eof:
+                status, dir_attributes, verifier, count, eof = client.read_dir_plus_columns_async(
+                    _page_args(dir_handle, listing.last_cookie, verifier, sizes), listing).result()
+                if not count:
+                    break
+        except UnexpectedNfsStatus as e:
+            if e.status != NfsStat3.NFS3ERR_BAD_COOKIE or restart == max_restarts:
+                raise
+            continue
+        return listing
+
+
+def scandir(client, dir_handle):
+    """
+    Entries of a single directory, streamed page by page; the next page is asked for before the
+    entries of the current one are handed out
+    """
+    sizes = transfer_sizes(client, dir_handle)
+    future = client.read_dir_plus_async(_page_args(dir_handle, 0, 0, sizes))
+    while future is not None:
+        status, dir_attributes, verifier, entries, eof = future.result()
+        future = None
+        if not eof and entries:
+            future = client.read_dir_plus_async(_page_args(dir_handle, entries[-1][2], verifier, sizes))
+        yield from _entries('', entries)
+
+
+def walk(clients, top_handle, workers=DEFAULT_WORKERS, onerror=None):
+    """
+    Every entry below top_handle, in no particular order. Up to workers READDIRPLUS calls are in
+    flight, spread over clients; directories waiting to be listed are kept on a stack, so the
+    crawl goes depth first and memory stays bounded by the tree's depth and fan-out rather than
+    its size.
+    :param clients: an NFSClient, or several connected to the same server
+    :param onerror: called with the path and the UnexpectedNfsStatus of a directory that could
+                    not be listed (e.g. removed meanwhile), which is then skipped; by default the
+                    error is raised
+    :rtype: Iterator[Entry]
+    """
+    if not isinstance(clients, (list, tuple)):
+        clients = [clients]
+    sizes = transfer_sizes(clients[0], top_handle)
+    turn = count()
+    directories = [('', top_handle)]
+    pages = []                      # (path, dir handle, client, arguments) of next pages to ask for
+    in_flight = {}                  # future -> (path, dir handle, client)
+    while directories or pages or in_flight:
+        while (directories or pages) and len(in_flight) < workers:
+            # Directories being listed go first, so they are done with soonest
+            if pages:
+                path, dir_handle, client, arguments = pages.pop()
+            else:
+                path, dir_handle = directories.pop()
+                client = clients[next(turn) % len(clients)]
+                arguments = _page_args(dir_handle, 0, 0, sizes)
+            in_flight[client.read_dir_plus_async(arguments)] = (path, dir_handle, client)
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            path, dir_handle, client = in_flight.pop(future)
+            try:
+                status, dir_attributes, verifier, entries, eof = future.result()
+            except UnexpectedNfsStatus as e:
+                if onerror is None:
+                    raise
+                onerror(path, e)
+                continue
+            if not eof and entries:
+                # Pages of one directory follow each other, on the same connection
+                pages.append((path, dir_handle, client, _page_args(dir_handle, entries[-1][2], verifier, sizes)))
+            for entry in _entries(path, entries):
+                if entry.is_dir() and entry.fh is not None:
+                    directories.append((entry.path, entry.fh))
+                yield entry
@@ -1,6 +1,10 @@
+import threading
+import time
+from concurrent.futures import Future
 from enum import Enum
 
 import rpc
+from asyncrpc import AsyncTCPClient
 from nfsclient import NFSPacker, NFSUnpacker
 from rpc import TCPClient
 
@@ -23,6 +27,10 @@ class NLM4_Stats(Enum):
 
 class NLMPacker(NFSPacker):
     def pack_cookie(self, cookie):
+        if isinstance(cookie, bytes):
+            self.pack_opaque(cookie)
+            return
+        # (length, contents), the netobj of length bytes that starts with the packed contents
         length, contents = cookie
         self.pack_uint(length)
         self.pack_opaque(contents.encode())
@@ -36,8 +44,9 @@ class NLMPacker(NFSPacker):
         self.pack_uhyper(lock_attrs["l_len"])
 
     def pack_owner_data(self, owner):
+        owner = owner.encode() if isinstance(owner, str) else owner
         self.pack_uint(len(owner))
-        self.pack_fopaque(len(owner), owner.encode())
+        self.pack_fopaque(len(owner), owner)
 
     def pack_lock_call(self, data):
         self.pack_cookie(data["cookie"])
@@ -45,12 +54,23 @@ class NLMPacker(NFSPacker):
         self.pack_bool(data["exclusive"])
         self.pack_lock_attrs(data["lock"])
         self.pack_bool(data["reclaim"])
-        self.pack_uhyper(data["state"])
+        self.pack_int(data["state"])
 
     def pack_unlock_call(self, data):
         self.pack_cookie(data["cookie"])
         self.pack_lock_attrs(data["lock"])
 
+    def pack_cancel_call(self, data):
+        self.pack_cookie(data["cookie"])
+        self.pack_bool(data["block"])
+        self.pack_bool(data["exclusive"])
+        self.pack_lock_attrs(data["lock"])
+
+    def pack_test_call(self, data):
+        # nlm4_testargs, the arguments of GRANTED as well
+        self.pack_cookie(data["cookie"])
+        self.pack_bool(data["exclusive"])
+        self.pack_lock_attrs(data["lock"])
 
 
 class NLMUnpacker(NFSUnpacker):
@@ -58,18 +78,14 @@ class NLMUnpacker(NFSUnpacker):
         NFSUnpacker.__init__(self, '')
 
     def unpack_cookie(self):
-        cookie_len = self.unpack_uint()
-        if cookie_len > 0:
-            self.unpack_opaque()
+        return self.unpack_opaque()
 
     def unpack_lock_unlock_reply(self):
         self.unpack_cookie()
         return self.unpack_enum()
 
 
-class NLMClient(TCPClient):
-    def __init__(self, host):
-        TCPClient.__init__(self, host, NLM_PROGRAM, NLM_VERSION)
+class PartialNLMClient:
 
     def addpackers(self):
         self.packer = NLMPacker()
@@ -91,4 +107,206 @@ class NLMClient(TCPClient):
                               self.packer.pack_unlock_call,
                               self.unpacker.unpack_lock_unlock_reply)
 
+    def lock_async(self, data, callback=None):
+        return self.call_async(2, data,
+                               self.packer.pack_lock_call,
+                               self.unpacker.unpack_lock_unlock_reply,
+                               callback)
+
+    def unlock_async(self, data, callback=None):
+        return self.call_async(4, data,
+                               self.packer.pack_unlock_call,
+                               self.unpacker.unpack_lock_unlock_reply,
+                               callback)
+
+    def cancel_async(self, data, callback=None):
+        """
+        Cancel a blocked lock request, data being the arguments of the LOCK call
+        """
+        return self.call_async(3, data,
+                               self.packer.pack_cancel_call,
+                               self.unpacker.unpack_lock_unlock_reply,
+                               callback)
+
+    def granted(self, data):
+        """
+        Tell a client that its blocked lock request was granted (a server's callback)
+        """
+        return self.make_call(5, data,
+                              self.packer.pack_test_call,
+                              self.unpacker.unpack_lock_unlock_reply)
+
+
+class NLMClient(PartialNLMClient, TCPClient):
+    def __init__(self, host):
+        TCPClient.__init__(self, host, NLM_PROGRAM, NLM_VERSION)
+
+
+class RawNLMClient(PartialNLMClient, rpc.RawTCPClient):
+    # To a known port, e.g. of a callback service that could not take over the NLM mapping
+    def __init__(self, host, port):
+        rpc.RawTCPClient.__init__(self, host, NLM_PROGRAM, NLM_VERSION, port)
+
+
+class AsyncNLMClient(PartialNLMClient, AsyncTCPClient):
+    def __init__(self, host):
+        AsyncTCPClient.__init__(self, host, NLM_PROGRAM, NLM_VERSION)
+
+
+def lock_key(lock_attrs):
+    """
+    What identifies a lock request in GRANTED callbacks: (fh, owner, svid, offset, length)
+    """
+    owner = lock_attrs["owner"]
+    return (lock_attrs["fh"], owner.encode() if isinstance(owner, str) else owner, lock_attrs["svid"],
+            lock_attrs["l_offset"], lock_attrs["l_len"])
+
+
+class BlockedLock:
+
+    def __init__(self, client, data, future):
+        self.client = client
+        self.data = data
+        self.future = future
+        self.sent = 0.0
+        self.attempts = 0
+
+
+class NLMCallbackServer(rpc.Server):
+    """
+    Waits for blocking locks without polling: a server answers a blocking LOCK it cannot grant
+    yet with NLM4_BLOCKED and calls NLM_GRANTED on the client's host once it granted the lock.
+    This serves NLM_GRANTED, registered with the local port mapper, and completes the futures
+    handed out by wait_for_lock().
+    Requests are still sent again every poll_interval, in case a callback got lost; if the
+    registration failed (e.g. the kernel's lockd is registered already) every
+    unregistered_poll_interval instead.
+    """
+
+    def __init__(self, host='', port=0, poll_interval=30.0, unregistered_poll_interval=1.0):
+        rpc.Server.__init__(self, host, port)
+        self.programs[(NLM_PROGRAM, NLM_VERSION)] = {0: self.null, 5: self.nlm_granted, 10: self.nlm_granted_msg}
+        self.poll_interval = poll_interval
+        self.unregistered_poll_interval = unregistered_poll_interval
+        self.blocked = {}           # lock_key -> BlockedLock
+        self.registered = False
+        self.pmap_host = None
+        self.granted_by_callback = 0    # waits ended by an NLM_GRANTED call rather than a reply
+        self.stopped = threading.Event()
+
+    def start(self, pmap_host='localhost'):
+        rpc.Server.start(self)
+        try:
+            self.registered = self.register(pmap_host)
+        except (OSError, RuntimeError):
+            self.registered = False
+        if self.registered:
+            self.pmap_host = pmap_host
+        threading.Thread(target=self.poll_blocked, daemon=True).start()
+
+    def close(self):
+        self.stopped.set()
+        if self.registered:
+            try:
+                self.unregister(self.pmap_host)
+            except (OSError, RuntimeError):
+                pass
+        rpc.Server.close(self)
+
+    def wait_for_lock(self, client, data):
+        """
+        Send a blocking LOCK and wait for the lock without blocking the caller. Cancelling the
+        future cancels the request on the server.
+        :param client: an NLMClient to the server
+        :param data: the arguments of the LOCK call, block is set
+        :return: Future of the final NLM4_Stats value: NLM4_GRANTED once the lock is held, an
+                 error status if the server refused the request
+        """
+        data = dict(data, block=True)
+        key = lock_key(data["lock"])
+        future = Future()
+        blocked = BlockedLock(client, data, future)
+        with self.lock:
+            if key in self.blocked:
+                raise RuntimeError(f'already waiting for the lock {key}')
+            self.blocked[key] = blocked
+        future.add_done_callback(lambda future: self.forget(key, blocked))
+        self.send_lock(blocked)
+        return future
+
+    def send_lock(self, blocked):
+        blocked.sent = time.monotonic()
+        blocked.attempts += 1
+        try:
+            blocked.client.lock_async(blocked.data, lambda reply: self.lock_replied(blocked, reply))
+        except (OSError, RuntimeError) as e:
+            self.complete(blocked, error=e)
+
+    def lock_replied(self, blocked, reply):
+        if reply.cancelled():
+            return
+        error = reply.exception()
+        if error is not None:
+            # Only the first request failing ends the wait, a callback may still come otherwise
+            if blocked.attempts == 1:
+                self.complete(blocked, error=error)
+            return
+        status = reply.result()
+        if status != NLM4_Stats.NLM4_BLOCKED.value:
+            self.complete(blocked, status)
+
+    def complete(self, blocked, status=None, error=None):
+        with self.lock:
+            if blocked.future.done():
+                return False
+            if error is not None:
+                blocked.future.set_exception(error)
+            else:
+                blocked.future.set_result(status)
+            return True
+
+    def forget(self, key, blocked):
+        with self.lock:
+            if self.blocked.get(key) is blocked:
+                del self.blocked[key]
+        if blocked.future.cancelled():
+            try:
+                blocked.client.cancel_async(blocked.data)
+            except (OSError, RuntimeError):
+                pass
+
+    def poll_blocked(self):
+        while not self.stopped.wait(min(self.poll_interval, self.unregistered_poll_interval) / 4):
+            interval = self.poll_interval if self.registered else self.unregistered_poll_interval
+            now = time.monotonic()
+            with self.lock:
+                overdue = [blocked for blocked in self.blocked.values() if now - blocked.sent >= interval]
+            for blocked in overdue:
+                self.send_lock(blocked)
+
+    def unpack_granted_args(self, unpacker):
+        cookie = unpacker.unpack_opaque()
+        unpacker.unpack_bool()      # exclusive
+        unpacker.unpack_string()    # caller_name
+        fh = unpacker.unpack_opaque()
+        owner = unpacker.unpack_opaque()
+        svid = unpacker.unpack_uint()
+        offset = unpacker.unpack_uhyper()
+        length = unpacker.unpack_uhyper()
+        return cookie, (fh, owner, svid, offset, length)
+
+    def nlm_granted(self, unpacker, packer):
+        cookie, key = self.unpack_granted_args(unpacker)
+        blocked = self.blocked.get(key)
+        # Denying a grant nobody waits for (anymore) makes the server release the lock
+        granted = blocked is not None and self.complete(blocked, NLM4_Stats.NLM4_GRANTED.value)
+        if granted:
+            self.granted_by_callback += 1
+        packer.pack_opaque(cookie)
+        packer.pack_enum((NLM4_Stats.NLM4_GRANTED if granted else NLM4_Stats.NLM4_DENIED).value)
 
+    def nlm_granted_msg(self, unpacker, packer):
+        cookie, key = self.unpack_granted_args(unpacker)
+        blocked = self.blocked.get(key)
+        if blocked is not None and self.complete(blocked, NLM4_Stats.NLM4_GRANTED.value):
+            self.granted_by_callback += 1
@@ -22,37 +22,41 @@ def get_packer_arguments(action_name, **action_input):
                                   "Stable": action_input.get("stable"),
                                   "Data": action_input.get("data")},
 
+                        "READ": {"file": action_input.get("file"),
+                                 "offset": action_input.get("offset"),
+                                 "count": action_input.get("count")},
+
                         "READDIR": {"dir": action_input.get("dir"),
-                                    "cookie": 0,
-                                    "Verifier": 0,
-                                    "count": 2000},
+                                    "cookie": action_input.get("cookie", 0),
+                                    "Verifier": action_input.get("verifier", 0),
+                                    "count": action_input.get("count", 2000)},
 
                         "READDIRPLUS": {"dir": action_input.get("dir"),
-                                        "cookie": 0,
-                                        "Verifier": 0,
-                                        "count": 2000,
-                                        "maxcount": 2000,
+                                        "cookie": action_input.get("cookie", 0),
+                                        "Verifier": action_input.get("verifier", 0),
+                                        "count": action_input.get("count", 2000),
+                                        "maxcount": action_input.get("maxcount", 2000),
                                         },
 
-                        "LOCK": {"cookie":  (4, ''),
+                        "LOCK": {"cookie": action_input.get("cookie", (4, '')),
                                  "block": action_input.get("block"),
                                  "exclusive": action_input.get("exclusive"),
                                  "lock":
                                      {"caller_name": action_input.get("caller_name"),
                                       "fh": action_input.get("fh"),
                                       "owner": action_input.get("owner"),
-                                      "svid": 4,
+                                      "svid": action_input.get("svid", 4),
                                       "l_offset": action_input.get("l_offset"),
                                       "l_len": action_input.get("l_len")},
-                                 "reclaim": False,
-                                 "state": 3},
+                                 "reclaim": action_input.get("reclaim", False),
+                                 "state": action_input.get("state", 3)},
 
-                        "UNLOCK": {"cookie": (4, ''),
+                        "UNLOCK": {"cookie": action_input.get("cookie", (4, '')),
                                    "lock":
                                        {"caller_name": action_input.get("caller_name"),
                                         "fh": action_input.get("fh"),
                                         "owner": action_input.get("owner"),
-                                        "svid": 4,
+                                        "svid": action_input.get("svid", 4),
                                         "l_offset": action_input.get("l_offset"),
                                         "l_len": action_input.get("l_len")}
                                    }
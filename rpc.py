@@ -1,10 +1,16 @@
 import errno
 import os
 import socket
-import xdrlib
+import struct
+import threading
+import time
 import arrow
+import rpcmetrics
+import xdr
+from concurrent.futures import Future
 from enum import Enum
 from os import getuid, getgid
+from select import select
 
 
 # Sun RPC version 2 -- RFC1057.
@@ -87,7 +93,31 @@ class GarbageArgs(Exception):
     pass
 
 
-class Packer(xdrlib.Packer):
+class ProgUnavail(RuntimeError):
+    pass
+
+
+# Fixed-size leading parts of the call and reply headers
+call_header = xdr.Struct('call_header', [('xid', xdr.UINT),
+                                         ('mtype', xdr.ENUM),
+                                         ('rpcvers', xdr.UINT),
+                                         ('prog', xdr.UINT),
+                                         ('vers', xdr.UINT),
+                                         ('proc', xdr.UINT)])
+
+reply_header = xdr.Struct('reply_header', [('xid', xdr.UINT),
+                                           ('mtype', xdr.ENUM),
+                                           ('stat', xdr.ENUM)])
+
+
+# The xid leads the call header, see Client.start_call
+call_xid = struct.Struct('>I')
+
+# Call header templates kept per client
+MAX_CALL_TEMPLATES = 64
+
+
+class Packer(xdr.Packer):
 
     def pack_auth(self, auth):
         flavor, stuff = auth
@@ -104,26 +134,19 @@ class Packer(xdrlib.Packer):
             self.pack_uint(i)
 
     def pack_callheader(self, xid, prog, vers, proc, cred, verf):
-        self.pack_uint(xid)
-        self.pack_enum(MsgType.CALL.value)
-        self.pack_uint(RPCVERSION)
-        self.pack_uint(prog)
-        self.pack_uint(vers)
-        self.pack_uint(proc)
+        self.pack_struct(call_header, (xid, MsgType.CALL.value, RPCVERSION, prog, vers, proc))
         self.pack_auth(cred)
         self.pack_auth(verf)
         # Caller must add procedure-specific part of call
 
     def pack_replyheader(self, xid, verf):
-        self.pack_uint(xid)
-        self.pack_enum(MsgType.REPLY.value)
-        self.pack_uint(ReplyStat.MSG_ACCEPTED.value)
+        self.pack_struct(reply_header, (xid, MsgType.REPLY.value, ReplyStat.MSG_ACCEPTED.value))
         self.pack_auth(verf)
         self.pack_enum(AcceptStat.SUCCESS.value)
         # Caller must add procedure-specific part of reply
 
 
-class Unpacker(xdrlib.Unpacker):
+class Unpacker(xdr.Unpacker):
 
     def unpack_auth(self):
         flavor = self.unpack_enum()
@@ -131,29 +154,20 @@ class Unpacker(xdrlib.Unpacker):
         return flavor, stuff
 
     def unpack_callheader(self):
-        xid = self.unpack_uint()
-        temp = self.unpack_enum()
-        if temp != AuthFlavor.CALL.value:
-            raise BadRPCFormat(f'No CALL but {temp}'
-                               )
-        temp = self.unpack_uint()
-        if temp != RPCVERSION:
-            raise BadRPCVersion(f'Bad RPC version {temp}')
-
-        prog = self.unpack_uint()
-        vers = self.unpack_uint()
-        proc = self.unpack_uint()
+        xid, temp, rpcvers, prog, vers, proc = self.unpack_struct(call_header)
+        if temp != MsgType.CALL.value:
+            raise BadRPCFormat(f'No CALL but {temp}')
+        if rpcvers != RPCVERSION:
+            raise BadRPCVersion(f'Bad RPC version {rpcvers}')
         cred = self.unpack_auth()
         verf = self.unpack_auth()
         return xid, prog, vers, proc, cred, verf
         # Caller must add procedure-specific part of call
 
     def unpack_replyheader(self):
-        xid = self.unpack_uint()
-        mtype = self.unpack_enum()
+        xid, mtype, stat = self.unpack_struct(reply_header)
         if mtype != MsgType.REPLY.value:
             raise RuntimeError(f'no REPLY but {mtype}')
-        stat = self.unpack_enum()
         if stat == ReplyStat.MSG_DENIED.value:
             stat = self.unpack_enum()
             if stat == RejectStat.RPC_MISMATCH.value:
@@ -169,7 +183,7 @@ class Unpacker(xdrlib.Unpacker):
         verf = self.unpack_auth()
         stat = self.unpack_enum()
         if stat == AcceptStat.PROG_UNAVAIL.value:
-            raise RuntimeError('Call failed: PROG_UNAVAIL')
+            raise ProgUnavail('Call failed: PROG_UNAVAIL')
         if stat == AcceptStat.PROG_MISMATCH.value:
             low = self.unpack_uint()
             high = self.unpack_uint()
@@ -208,6 +222,11 @@ def make_auth_unix_default():
 # Common base class for clients
 
 class Client:
+    # Shared by all clients of the process, set to None to not record any metrics
+    metrics = rpcmetrics.metrics
+    # An rpccapture.CaptureWriter recording every call, see rpccapture.capture
+    capture = None
+
     def __init__(self, host, prog, vers, port):
         self.host = host
         self.prog = prog
@@ -223,6 +242,12 @@ class Client:
         self.addpackers()
         self.cred = None
         self.verf = None
+        self.call_templates = {}        # (proc, cred, verf) -> packed call header
+        self.call_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = {}
+        self.reader = None
+        self.reader_error = None
 
     def close(self):
         self.sock.close()
@@ -247,28 +272,142 @@ class Client:
     def make_call(self, proc, args, pack_func, unpack_func):
         if pack_func is None and args is not None:
             raise TypeError('non-null args with null pack_func')
-        self.start_call(proc)
-        if pack_func:
-            pack_func(args)
-        self.do_call()
-        if unpack_func:
-            result = unpack_func()
-        else:
-            result = None
-        self.unpacker.done()
-        return result
+        # Under call_lock, so that no call_async on another thread starts the reader, or packs,
+        # while a call is sent and its reply read here
+        with self.call_lock:
+            if self.reader is None:
+                self.start_call(proc)
+                if pack_func:
+                    pack_func(args)
+                call = self.call_record(proc)
+                try:
+                    self.do_call()
+                    if unpack_func:
+                        result = unpack_func()
+                    else:
+                        result = None
+                    self.unpacker.done()
+                except Exception as e:
+                    self.observe_call(call, 0, error=e)
+                    raise
+                self.observe_call(call, len(self.unpacker.buf), result)
+                return result
+        # The reader thread owns the unpacker once pipelining started
+        return self.call_async(proc, args, pack_func, unpack_func).result()
+
+    def call_record(self, proc):
+        """
+        What the metrics need to know about a call that was just packed: (proc, time sent, size)
+        """
+        buffers = self.packer.get_buffers()
+        if self.capture is not None:
+            self.capture.record(self, buffers)
+        return proc, time.perf_counter(), sum(len(buf) for buf in buffers)
+
+    def observe_call(self, call, received, result=None, error=None):
+        if self.metrics is not None and call is not None:
+            proc, started, sent = call
+            self.metrics.observe(self.prog, self.vers, proc, time.perf_counter() - started, sent, received,
+                                 rpcmetrics.call_status(result, error))
 
     def start_call(self, proc):
         self.last_xid = xid = self.last_xid + 1
         cred = self.mkcred()
         verf = self.mkverf()
+        key = (proc, cred, verf)
+        template = self.call_templates.get(key)
+        if template is None:
+            template = self.make_call_template(proc, cred, verf)
+            if len(self.call_templates) >= MAX_CALL_TEMPLATES:
+                # Credentials that change with every call
+                self.call_templates.clear()
+            self.call_templates[key] = template
         packer = self.packer
-        packer.reset()
-        packer.pack_callheader(xid, self.prog, self.vers, proc, cred, verf)
+        packer.reset(template)
+        call_xid.pack_into(packer.buf, 0, xid)
+
+    def make_call_template(self, proc, cred, verf):
+        """
+        Everything but the xid of a call header is the same for all calls of a procedure with the
+        same credential and verifier, so it is packed only once
+        """
+        packer = Packer()
+        packer.pack_callheader(0, self.prog, self.vers, proc, cred, verf)
+        return packer.get_buffer()
 
     def do_call(self):
         raise RuntimeError('do_call not defined')
 
+    def call_async(self, proc, args, pack_func, unpack_func, callback=None):
+        """
+        Send a call without waiting for its reply, so that many calls can be in flight on one
+        connection. Replies are matched to their callers by xid on a reader thread.
+        :param callback: called with the future once the reply was unpacked (on the reader thread)
+        :rtype: concurrent.futures.Future
+        """
+        if pack_func is None and args is not None:
+            raise TypeError('non-null args with null pack_func')
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        with self.call_lock:
+            self.start_call(proc)
+            if pack_func:
+                pack_func(args)
+            xid = self.last_xid
+            call = self.call_record(proc)
+            with self.pending_lock:
+                if self.reader_error is not None:
+                    raise self.reader_error
+                self.pending[xid] = (future, unpack_func, call)
+            self.start_reader()
+            try:
+                self.send_call(self.packer.get_buffers())
+            except Exception as e:
+                with self.pending_lock:
+                    self.pending.pop(xid, None)
+                self.observe_call(call, 0, error=e)
+                future.set_exception(e)
+        return future
+
+    def send_call(self, call):
+        raise RuntimeError('send_call not defined')
+
+    def start_reader(self):
+        raise RuntimeError('start_reader not defined')
+
+    def dispatch_reply(self, reply):
+        """
+        Complete the pending call the given reply belongs to. Must only be called by the reader,
+        since the unpack functions are bound to the shared unpacker.
+        """
+        xid, = struct.unpack_from('>I', reply)
+        with self.pending_lock:
+            future, unpack_func, call = self.pending.pop(xid, (None, None, None))
+        if future is None or future.cancelled():
+            # Reply to a call nobody waits for anymore (e.g. a duplicate)
+            return
+        u = self.unpacker
+        u.reset(reply)
+        try:
+            u.unpack_replyheader()
+            result = unpack_func() if unpack_func else None
+            u.done()
+        except Exception as e:
+            self.observe_call(call, len(reply), error=e)
+            future.set_exception(e)
+        else:
+            self.observe_call(call, len(reply), result)
+            future.set_result(result)
+
+    def fail_pending(self, error):
+        with self.pending_lock:
+            self.reader_error = error
+            pending, self.pending = self.pending, {}
+        for future, _, call in pending.values():
+            self.observe_call(call, 0, error=error)
+            future.set_exception(error)
+
     def mkcred(self):
         # Override this to use more powerful credentials
         if self.cred is None:
@@ -287,44 +426,105 @@ class Client:
 
 # Record-Marking standard support
 
+LAST_FRAGMENT = 0x80000000
+
+record_header = struct.Struct('>I')
+
+
+def sendbuffers(sock, buffers):
+    """
+    Send several buffers as one contiguous stream, using scatter-gather I/O where the platform
+    has it so the buffers never need to be joined into a single bytes object.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [view for view in (memoryview(buf).cast('B') for buf in buffers) if view]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
 def sendfrag(sock, last, frag):
-    x = len(frag)
+    """
+    :param frag: bytes-like object, or a list of them making up the fragment (see
+                 xdr.Packer.get_buffers)
+    """
+    buffers = frag if isinstance(frag, list) else [frag]
+    x = sum(memoryview(buf).nbytes for buf in buffers)
     if last:
-        x = x | 0x80000000
-    header = bytes(
-        chr(int(x >> 24 & 0xff)) + chr(int(x >> 16 & 0xff)) + chr(int(x >> 8 & 0xff)) + chr(
-            int(x & 0xff)), 'raw_unicode_escape')
-    sock.send(header + frag)
+        x = x | LAST_FRAGMENT
+    sendbuffers(sock, [record_header.pack(x)] + buffers)
 
 
 def sendrecord(sock, record):
     sendfrag(sock, 1, record)
 
 
-def recvfrag(sock):
-    header = sock.recv(4)
-    if len(header) < 4:
-        raise EOFError
-    x = int(header[0]) << 24 | header[1] << 16 | header[2] << 8 | header[3]
-    last = ((x & 0x80000000) != 0)
-    n = int(x & 0x7fffffff)
-    frag = b''
-    while n > 0:
-        buf = sock.recv(n)
-        if not buf:
+def recvall_into(sock, view):
+    while view:
+        n = sock.recv_into(view)
+        if not n:
             raise EOFError
-        n = n - len(buf)
-        frag = frag + buf
-    return last, frag
+        view = view[n:]
+
+
+def recvheader(sock):
+    header = bytearray(record_header.size)
+    recvall_into(sock, memoryview(header))
+    x, = record_header.unpack(header)
+    return (x & LAST_FRAGMENT) != 0, x & ~LAST_FRAGMENT
+
+
+def recvfrag(sock):
+    last, n = recvheader(sock)
+    frag = bytearray(n)
+    recvall_into(sock, memoryview(frag))
+    return last, bytes(frag)
 
 
 def recvrecord(sock):
-    record = b''
+    frags = []
     last = 0
     while not last:
         last, frag = recvfrag(sock)
-        record = record + frag
-    return record
+        frags.append(frag)
+    return b''.join(frags)
+
+
+class RecordReader:
+    """
+    Receives records from a stream socket into a single reusable buffer.
+    The returned memoryview is only valid until the next record is received.
+    """
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.header = memoryview(bytearray(record_header.size))
+        self.buf = bytearray(size)
+
+    def recvrecord(self):
+        length = 0
+        last = False
+        while not last:
+            recvall_into(self.sock, self.header)
+            x, = record_header.unpack(self.header)
+            last = (x & LAST_FRAGMENT) != 0
+            n = x & ~LAST_FRAGMENT
+            if length + n > len(self.buf):
+                # Never resize in place: an unpacker may still hold a view on the old buffer
+                buf = bytearray(max(length + n, 2 * len(self.buf)))
+                buf[:length] = memoryview(self.buf)[:length]
+                self.buf = buf
+            recvall_into(self.sock, memoryview(self.buf)[length:length + n])
+            length += n
+        return memoryview(self.buf)[:length]
 
 
 # Try to bind to a reserved port (must be root)
@@ -351,11 +551,39 @@ def bindresvport(sock, host):
 class RawTCPClient(Client):
     def make_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.record_reader = RecordReader(self.sock)
+
+    def close(self):
+        reader = self.reader
+        if reader is not None:
+            # Wake the reader up so it fails whatever is still pending
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+
+    def send_call(self, call):
+        sendrecord(self.sock, call)
+
+    def start_reader(self):
+        if self.reader is None:
+            self.reader = threading.Thread(target=self.read_replies, daemon=True)
+            self.reader.start()
+
+    def read_replies(self):
+        try:
+            while True:
+                self.dispatch_reply(self.record_reader.recvrecord())
+        except (EOFError, OSError) as e:
+            self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} lost: {e!r}'))
 
     def do_call(self):
-        call = self.packer.get_buf()
+        call = self.packer.get_buffers()
         sendrecord(self.sock, call)
-        reply = recvrecord(self.sock)
+        reply = self.record_reader.recvrecord()
         u = self.unpacker
         u.reset(reply)
         xid, verf = u.unpack_replyheader()
@@ -363,42 +591,201 @@ class RawTCPClient(Client):
             raise RuntimeError (f'wrong xid in reply {xid} instead of {self.last_xid}')
 
 
+# Retransmission timeouts for UDP -- Jacobson/Karels, as in RFC 6298
+
+class RTTEstimator:
+    """
+    Smoothed round-trip time and its variance per procedure class, from which the retransmission
+    timeout of the next call of that class is derived. Only calls answered without being
+    retransmitted are sampled (Karn's algorithm).
+    """
+
+    def __init__(self, initial=1.0, minimum=0.1, maximum=25.0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.srtt = {}
+        self.rttvar = {}
+
+    def timeout(self, key):
+        with self.lock:
+            srtt = self.srtt.get(key)
+            if srtt is None:
+                return self.initial
+            return min(max(srtt + 4 * self.rttvar[key], self.minimum), self.maximum)
+
+    def sample(self, key, rtt):
+        with self.lock:
+            srtt = self.srtt.get(key)
+            if srtt is None:
+                self.srtt[key] = rtt
+                self.rttvar[key] = rtt / 2
+            else:
+                self.rttvar[key] = 0.75 * self.rttvar[key] + 0.25 * abs(srtt - rtt)
+                self.srtt[key] = 0.875 * srtt + 0.125 * rtt
+
+
+# Estimators are kept per server and program, so short-lived clients start from what earlier ones
+# measured
+rtt_estimators = {}
+rtt_estimators_lock = threading.Lock()
+
+
+def get_rtt_estimator(host, port, prog, vers):
+    with rtt_estimators_lock:
+        estimator = rtt_estimators.get((host, port, prog, vers))
+        if estimator is None:
+            estimator = rtt_estimators[(host, port, prog, vers)] = RTTEstimator()
+        return estimator
+
+
+class Transmission:
+    """State of an outstanding UDP call"""
+
+    def __init__(self, call, proc, key, sent, deadline, timeout, retries):
+        self.call = call
+        self.proc = proc
+        self.key = key
+        self.sent = sent
+        self.deadline = deadline
+        self.timeout = timeout
+        self.retries = retries
+        self.retransmitted = False
+
+
 # Client using UDP to a specific port
 
 class RawUDPClient(Client):
+    """
+    Any number of calls may be outstanding on the socket; a reader thread matches replies to
+    calls by xid and retransmits calls whose timeout expired, see RTTEstimator.
+    """
+    # Large enough for any UDP datagram
+    bufsize = 65536
+    retries = 5
+    # Procedures whose round-trip times are alike may share a class (proc -> class), every other
+    # procedure is a class of its own
+    procedure_classes = {}
 
     def make_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recv_buffer = bytearray(self.bufsize)
+        # Written to when the reader has to wake up early: a new call or close()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.transmissions = {}         # xid -> Transmission, guarded by pending_lock
+        self.closing = False
 
-    def do_call(self):
-        call = self.packer.get_buf()
-        self.sock.send(call)
+    def connect_socket(self):
+        Client.connect_socket(self)
+        self.rtt = get_rtt_estimator(self.host, self.port, self.prog, self.vers)
+
+    def close(self):
+        self.closing = True
+        reader = self.reader
+        if reader is not None:
+            self.wakeup_sender.send(b'\0')
+            if reader is not threading.current_thread():
+                reader.join()
+        self.sock.close()
+        self.wakeup_sender.close()
+        self.wakeup_receiver.close()
+
+    def make_call(self, proc, args, pack_func, unpack_func):
+        return self.call_async(proc, args, pack_func, unpack_func).result()
+
+    def send_call(self, call):
+        call = b''.join(call)
+        xid, _, _, _, _, proc = call_header.unpack_from(call)
+        key = self.procedure_classes.get(proc, proc)
+        timeout = self.rtt.timeout(key)
+        now = time.monotonic()
+        with self.pending_lock:
+            self.transmissions[xid] = Transmission(call, proc, key, now, now + timeout, timeout, self.retries)
         try:
-            from select import select
-        except ImportError:
-            print ('WARNING: select not found, RPC may hang')
-            select = None
-        BUFSIZE = 8192 # Max UDP buffer size
-        timeout = 1
-        count = 5
-        while 1:
-            r, w, x = [self.sock], [], []
-            if select:
-                r, w, x = select(r, w, x, timeout)
-            if self.sock not in r:
-                count = count - 1
-                if count < 0:
-                    raise RuntimeError('timeout')
-                if timeout < 25: timeout = timeout *2
-                self.sock.send(call)
-                continue
-            reply = self.sock.recv(BUFSIZE)
-            u = self.unpacker
-            u.reset(reply)
-            xid, verf = u.unpack_replyheader()
-            if xid != self.last_xid:
-                continue
-            break
+            self.sock.send(call)
+        except OSError:
+            with self.pending_lock:
+                self.transmissions.pop(xid, None)
+            raise
+        # The reader may be waiting for a later deadline
+        self.wakeup_sender.send(b'\0')
+
+    def start_reader(self):
+        if self.reader is None:
+            self.reader = threading.Thread(target=self.read_replies, daemon=True)
+            self.reader.start()
+
+    def read_replies(self):
+        view = memoryview(self.recv_buffer)
+        try:
+            while not self.closing:
+                r, _, _ = select([self.sock, self.wakeup_receiver], [], [], self.retransmit())
+                if self.wakeup_receiver in r:
+                    self.wakeup_receiver.recv(4096)
+                if self.sock in r:
+                    try:
+                        n = self.sock.recv_into(view)
+                    except ConnectionRefusedError as e:
+                        # ICMP port unreachable for one of the calls; the service is gone
+                        self.fail_outstanding(e)
+                        continue
+                    self.dispatch_reply(view[:n])
+            self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} closed'))
+        except OSError as e:
+            self.fail_pending(ConnectionError(f'connection to {self.host}:{self.port} lost: {e!r}'))
+
+    def dispatch_reply(self, reply):
+        if len(reply) < 4:
+            return
+        xid, = struct.unpack_from('>I', reply)
+        with self.pending_lock:
+            transmission = self.transmissions.pop(xid, None)
+        if transmission is not None and not transmission.retransmitted:
+            self.rtt.sample(transmission.key, time.monotonic() - transmission.sent)
+        Client.dispatch_reply(self, reply)
+
+    def retransmit(self):
+        """
+        Send the calls whose timeout expired again, with twice the timeout, and fail those out of
+        retries
+        :return: seconds until the next timeout expires, None if nothing is outstanding
+        """
+        now = time.monotonic()
+        expired = []
+        next_deadline = None
+        with self.pending_lock:
+            for xid, transmission in list(self.transmissions.items()):
+                if transmission.deadline <= now:
+                    if transmission.retries == 0:
+                        del self.transmissions[xid]
+                        expired.append(self.pending.pop(xid, (None, None, None)))
+                        continue
+                    if self.metrics is not None:
+                        self.metrics.retransmitted(self.prog, self.vers, transmission.proc)
+                    transmission.retries -= 1
+                    transmission.retransmitted = True
+                    transmission.timeout = min(transmission.timeout * 2, self.rtt.maximum)
+                    transmission.deadline = now + transmission.timeout
+                    self.sock.send(transmission.call)
+                if next_deadline is None or transmission.deadline < next_deadline:
+                    next_deadline = transmission.deadline
+        for future, _, call in expired:
+            if future is not None and not future.cancelled():
+                error = RuntimeError('timeout')
+                self.observe_call(call, 0, error=error)
+                future.set_exception(error)
+        return None if next_deadline is None else max(next_deadline - now, 0)
+
+    def fail_outstanding(self, error):
+        # Unlike fail_pending the client remains usable
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            self.transmissions.clear()
+        for future, _, call in pending.values():
+            if not future.cancelled():
+                self.observe_call(call, 0, error=error)
+                future.set_exception(error)
 
 
 # Client using UDP broadcast to a specific port
@@ -420,6 +807,11 @@ class RawBroadcastUDPClient(RawUDPClient):
     def set_timeout(self, timeout):
         self.timeout = timeout # Use None for infinite timeout
 
+    def call_async(self, proc, args, pack_func, unpack_func, callback=None):
+        # A broadcast gets any number of replies, collected by make_call; no reader thread, round-trip
+        # estimates or retransmissions
+        raise RuntimeError('broadcast calls cannot be pipelined, use make_call')
+
     def make_call(self, proc, args, pack_func, unpack_func):
         if pack_func is None and args is not None:
             raise TypeError('non-null args with null pack_func')
@@ -428,26 +820,19 @@ class RawBroadcastUDPClient(RawUDPClient):
             pack_func(args)
         call = self.packer.get_buf()
         self.sock.sendto(call, (self.host, self.port))
-        try:
-            from select import select
-        except ImportError:
-            print ('WARNING: select not found, broadcast will hang')
-            select = None
-        BUFSIZE = 8192 # Max UDP buffer size (for reply)
         replies = []
         if unpack_func is None:
             def dummy(): pass
             unpack_func = dummy
         while 1:
             r, w, x = [self.sock], [], []
-            if select:
-                if self.timeout is None:
-                    r, w, x = select(r, w, x)
-                else:
-                    r, w, x = select(r, w, x, self.timeout)
+            if self.timeout is None:
+                r, w, x = select(r, w, x)
+            else:
+                r, w, x = select(r, w, x, self.timeout)
             if self.sock not in r:
                 break
-            reply, fromaddr = self.sock.recvfrom(BUFSIZE)
+            reply, fromaddr = self.sock.recvfrom(self.bufsize)
             u = self.unpacker
             u.reset(reply)
             xid, verf = u.unpack_replyheader()
@@ -554,25 +939,287 @@ class BroadcastUDPPortMapperClient(PartialPortMapperClient, RawBroadcastUDPClien
         RawBroadcastUDPClient.__init__(self, bcastaddr, PMAP_PROG, PMAP_VERS, PMAP_PORT)
 
 
+# Cache of port mapper lookups shared by all clients of the process
+
+class PortCache:
+    """
+    Maps (host, prog, vers, prot) to the port the program was registered on, so constructing a
+    client does not cost a port mapper round-trip every time.
+    Entries expire after ttl seconds and are dropped as soon as the port turns out to be wrong
+    (connection refused or PROG_UNAVAIL).
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.ports = {}
+
+    def get(self, host, prog, vers, prot):
+        with self.lock:
+            port, expires = self.ports.get((host, prog, vers, prot), (None, 0))
+        if expires > time.monotonic():
+            return port
+
+    def set(self, host, prog, vers, prot, port):
+        with self.lock:
+            self.ports[(host, prog, vers, prot)] = (port, time.monotonic() + self.ttl)
+
+    def invalidate(self, host, prog, vers, prot):
+        with self.lock:
+            self.ports.pop((host, prog, vers, prot), None)
+
+    def clear(self):
+        with self.lock:
+            self.ports.clear()
+
+    def lookup(self, host, prog, vers, prot):
+        port = self.get(host, prog, vers, prot)
+        if port is None:
+            pmap = TCPPortMapperClient(host) if prot == IPPROTO_TCP else UDPPortMapperClient(host)
+            try:
+                port = pmap.get_port((prog, vers, prot, 0))
+            finally:
+                pmap.close()
+            if port == 0:
+                raise RuntimeError('program not registered')
+            self.set(host, prog, vers, prot, port)
+        return port
+
+    def prewarm(self, host):
+        """
+        Fill the cache with every mapping registered on host using a single PMAPPROC_DUMP
+        """
+        pmap = TCPPortMapperClient(host)
+        try:
+            mappings = pmap.dump()
+        finally:
+            pmap.close()
+        for prog, vers, prot, port in mappings:
+            self.set(host, prog, vers, prot, port)
+        return mappings
+
+
+port_cache = PortCache()
+
+
 # Generic clients that find their server through the Port mapper
 
 class TCPClient(RawTCPClient):
 
     def __init__(self, host, prog, vers):
-        pmap = TCPPortMapperClient(host)
-        port = pmap.get_port((prog, vers, IPPROTO_TCP, 0))
-        pmap.close()
-        if port == 0:
-            raise RuntimeError('program not registered')
-        RawTCPClient.__init__(self, host, prog, vers, port)
+        port = port_cache.lookup(host, prog, vers, IPPROTO_TCP)
+        try:
+            RawTCPClient.__init__(self, host, prog, vers, port)
+        except ConnectionRefusedError:
+            # The service may have been restarted on another port
+            self.sock.close()
+            port_cache.invalidate(host, prog, vers, IPPROTO_TCP)
+            port = port_cache.lookup(host, prog, vers, IPPROTO_TCP)
+            RawTCPClient.__init__(self, host, prog, vers, port)
+
+    def make_call(self, proc, args, pack_func, unpack_func):
+        try:
+            return RawTCPClient.make_call(self, proc, args, pack_func, unpack_func)
+        except ProgUnavail:
+            port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_TCP)
+            raise
+
+    def call_async(self, proc, args, pack_func, unpack_func, callback=None):
+        future = RawTCPClient.call_async(self, proc, args, pack_func, unpack_func)
+        future.add_done_callback(self.check_prog_unavail)
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def check_prog_unavail(self, future):
+        if not future.cancelled() and isinstance(future.exception(), ProgUnavail):
+            port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_TCP)
 
 
 class UDPClient(RawUDPClient):
 
     def __init__(self, host, prog, vers):
-        pmap = UDPPortMapperClient(host)
-        port = pmap.get_port((prog, vers, IPPROTO_UDP, 0))
-        pmap.close()
-        if port == 0:
-            raise RuntimeError('program not registered')
-        RawUDPClient.__init__(self, host, prog, vers, port)
\ No newline at end of file
+        port = port_cache.lookup(host, prog, vers, IPPROTO_UDP)
+        RawUDPClient.__init__(self, host, prog, vers, port)
+
+    def make_call(self, proc, args, pack_func, unpack_func):
+        try:
+            return RawUDPClient.make_call(self, proc, args, pack_func, unpack_func)
+        except ProgUnavail:
+            port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_UDP)
+            raise
+
+    def call_async(self, proc, args, pack_func, unpack_func, callback=None):
+        future = RawUDPClient.call_async(self, proc, args, pack_func, unpack_func)
+        future.add_done_callback(self.check_prog_unavail)
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def check_prog_unavail(self, future):
+        if not future.cancelled() and isinstance(future.exception(), ProgUnavail):
+            port_cache.invalidate(self.host, self.prog, self.vers, IPPROTO_UDP)
+
+
+# Server serving several programs on one port over both TCP and UDP
+
+class Server:
+    """
+    self.programs maps (prog, vers) to {proc: handler}; a handler is called with an unpacker
+    positioned at the call's arguments and a packer holding the reply header, to which it adds
+    the results. Handlers of all connections are called one at a time, under self.lock.
+    """
+    packer_class = PortMapperPacker
+    unpacker_class = PortMapperUnpacker
+
+    def __init__(self, host='', port=0):
+        self.host = host
+        self.programs = {}
+        self.lock = threading.RLock()
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind((host, port))
+        self.port = self.tcp_socket.getsockname()[1]
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((host, self.port))
+        self.connections = set()
+        self.closing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        self.tcp_socket.listen(128)
+        for target in (self.accept_connections, self.serve_udp):
+            threading.Thread(target=target, daemon=True).start()
+
+    def close(self):
+        self.closing = True
+        for sock in [self.tcp_socket, self.udp_socket] + list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def register(self, pmap_host='localhost'):
+        """
+        Register the programs with the port mapper on pmap_host, for both protocols. If some were
+        registered already, the mappings that were set are unset again.
+        :return: True if all of them were registered, False if some were registered already
+        """
+        mapped = []
+        pmap = TCPPortMapperClient(pmap_host)
+        try:
+            for prog, vers in self.programs:
+                for prot in (IPPROTO_TCP, IPPROTO_UDP):
+                    if pmap.set_mapping((prog, vers, prot, self.port)):
+                        mapped.append((prog, vers, prot, self.port))
+            registered = len(mapped) == 2 * len(self.programs)
+            if not registered:
+                for mapping in mapped:
+                    pmap.unset(mapping)
+        finally:
+            pmap.close()
+        return registered
+
+    def unregister(self, pmap_host='localhost'):
+        pmap = TCPPortMapperClient(pmap_host)
+        try:
+            for prog, vers in self.programs:
+                for prot in (IPPROTO_TCP, IPPROTO_UDP):
+                    pmap.unset((prog, vers, prot, self.port))
+        finally:
+            pmap.close()
+
+    def accept_connections(self):
+        while not self.closing:
+            try:
+                sock, _ = self.tcp_socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.add(sock)
+            threading.Thread(target=self.serve_connection, args=(sock,), daemon=True).start()
+
+    def serve_connection(self, sock):
+        reader = RecordReader(sock)
+        send_lock = threading.Lock()
+
+        def send(reply):
+            with send_lock:
+                sendrecord(sock, reply)
+        try:
+            while not self.closing:
+                reply = self.handle_call(reader.recvrecord())
+                if reply is not None:
+                    self.reply(send, reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.connections.discard(sock)
+            sock.close()
+
+    def serve_udp(self):
+        while not self.closing:
+            try:
+                call, address = self.udp_socket.recvfrom(65536)
+            except OSError:
+                return
+            reply = self.handle_call(call)
+            if reply is not None:
+                self.reply(lambda reply, address=address: self.udp_socket.sendto(reply, address), reply)
+
+    def reply(self, send, reply):
+        # Override this to hold replies back
+        send(reply)
+
+    def handle_call(self, call):
+        """
+        :return: the reply to the call, None if it is not a valid call
+        """
+        unpacker = self.unpacker_class(call)
+        try:
+            xid, prog, vers, proc, cred, verf = unpacker.unpack_callheader()
+        except Exception:
+            return None
+        packer = self.packer_class()
+        procedures = self.programs.get((prog, vers))
+        if procedures is None:
+            versions = [program_vers for program, program_vers in self.programs if program == prog]
+            if not versions:
+                self.pack_rejection(packer, xid, AcceptStat.PROG_UNAVAIL)
+            else:
+                self.pack_rejection(packer, xid, AcceptStat.PROG_MISMATCH)
+                packer.pack_uint(min(versions))
+                packer.pack_uint(max(versions))
+            return packer.get_buffer()
+        procedure = procedures.get(proc)
+        if procedure is None:
+            self.pack_rejection(packer, xid, AcceptStat.PROC_UNAVAIL)
+            return packer.get_buffer()
+        packer.pack_replyheader(xid, (AuthFlavor.AUTH_NULL.value, make_auth_null()))
+        header_size = len(packer.buf)
+        try:
+            with self.lock:
+                self.dispatch(prog, proc, procedure, unpacker, packer)
+        except (EOFError, struct.error, ValueError):
+            del packer.buf[header_size:]
+            packer.buf[header_size - 4:header_size] = struct.pack('>I', AcceptStat.GARBAGE_ARGS.value)
+        return packer.get_buffer()
+
+    def dispatch(self, prog, proc, procedure, unpacker, packer):
+        procedure(unpacker, packer)
+
+    @staticmethod
+    def pack_rejection(packer, xid, stat):
+        packer.pack_struct(reply_header, (xid, MsgType.REPLY.value, ReplyStat.MSG_ACCEPTED.value))
+        packer.pack_auth((AuthFlavor.AUTH_NULL.value, make_auth_null()))
+        packer.pack_enum(stat.value)
+
+    def null(self, unpacker, packer):
+        pass
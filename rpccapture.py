@@ -0,0 +1,257 @@
+# Capturing the RPC calls of a workload and replaying them as load.
+#
+# While rpc.Client.capture is set, every call any client makes is appended to
+# a capture file: when it was sent, by which client, its xid, program,
+# version, procedure and packed arguments. replay() reissues the calls to
+# another server at the recorded pace, N times as fast or as fast as
+# possible, keeping the calls of each recorded client in order:
+#
+#     with rpccapture.capture('workload.rpccap'):
+#         run_workload()
+#     rpccapture.replay('workload.rpccap', 'lab-filer', speed=2.0, concurrency=32)
+#
+# or from the command line:
+#
+#     python rpccapture.py replay workload.rpccap lab-filer --speed 2 --concurrency 32
+#
+# The arguments are sent as they were captured, file handles included, so the
+# target must serve the same files (e.g. a copy or snapshot of the captured
+# export). Replayed calls show up in rpcmetrics like any other.
+
+import struct
+import threading
+import time
+import weakref
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from itertools import count
+
+import rpc
+import rpcmetrics
+
+MAGIC = b'RPCCAP01'
+
+# A captured call: microseconds since the capture started, client number, xid, prog, vers, proc
+# and the length of the packed arguments, which follow
+record = struct.Struct('>QIIIIII')
+
+CapturedCall = namedtuple('CapturedCall', ['offset', 'client', 'xid', 'prog', 'vers', 'proc', 'args'])
+
+
+class BadCaptureFile(Exception):
+    pass
+
+
+class CaptureWriter:
+    """
+    Appends the calls of every client to a capture file, set it as rpc.Client.capture (see
+    capture()) to start recording
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.clients = weakref.WeakKeyDictionary()      # client -> client number
+        # Never reused, the number of a collected client may still be in the file
+        self.client_numbers = count()
+        self.calls = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, client, buffers):
+        """
+        :param buffers: the packed call, header included, see xdr.Packer.get_buffers
+        """
+        offset = int((time.perf_counter() - self.started) * 1000000)
+        call = b''.join(buffers)
+        unpacker = rpc.Unpacker(call)
+        xid, prog, vers, proc, cred, verf = unpacker.unpack_callheader()
+        args = call[unpacker.get_position():]
+        with self.lock:
+            if self.file.closed:
+                return
+            number = self.clients.get(client)
+            if number is None:
+                number = self.clients[client] = next(self.client_numbers)
+            self.file.write(record.pack(offset, number, xid, prog, vers, proc, len(args)))
+            self.file.write(args)
+            self.calls += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+@contextmanager
+def capture(path):
+    """
+    Record the calls of all clients to path while in the with block
+    """
+    writer = CaptureWriter(path)
+    rpc.Client.capture = writer
+    try:
+        yield writer
+    finally:
+        rpc.Client.capture = None
+        writer.close()
+
+
+def read_capture(path):
+    """
+    :rtype: Iterator[CapturedCall], in the order the calls were captured
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise BadCaptureFile(f'{path} is not a capture file')
+        while True:
+            header = f.read(record.size)
+            if not header:
+                return
+            if len(header) < record.size:
+                raise BadCaptureFile(f'{path} is truncated')
+            offset, client, xid, prog, vers, proc, length = record.unpack(header)
+            args = f.read(length)
+            if len(args) < length:
+                raise BadCaptureFile(f'{path} is truncated')
+            yield CapturedCall(offset / 1000000, client, xid, prog, vers, proc, args)
+
+
+class ReplayPacker(rpc.Packer):
+
+    def pack_raw(self, data):
+        # Arguments packed when they were captured
+        self.buf += data
+
+
+class ReplayUnpacker(rpc.Unpacker):
+
+    def skip_result(self):
+        self.pos = len(self.buf)
+
+
+class PartialReplayClient:
+
+    def addpackers(self):
+        self.packer = ReplayPacker()
+        self.unpacker = ReplayUnpacker('')
+
+    def mkcred(self):
+        if self.cred is None:
+            self.cred = rpc.AuthFlavor.AUTH_UNIX.value, rpc.make_auth_unix_default()
+        return self.cred
+
+    def replay_async(self, call):
+        return self.call_async(call.proc, call.args, self.packer.pack_raw, self.unpacker.skip_result)
+
+
+class ReplayClient(PartialReplayClient, rpc.TCPClient):
+
+    def __init__(self, host, prog, vers):
+        rpc.TCPClient.__init__(self, host, prog, vers)
+
+
+class ReplayPortMapperClient(PartialReplayClient, rpc.RawTCPClient):
+    # The port mapper is not asked for its own port
+
+    def __init__(self, host, vers):
+        rpc.RawTCPClient.__init__(self, host, rpc.PMAP_PROG, vers, rpc.PMAP_PORT)
+
+
+def replay(path, host, speed=1.0, concurrency=16, connections=1):
+    """
+    Reissue the calls of a capture file to host, over TCP. The calls of each captured client go
+    over the same connection, in their captured order; calls are only held back to keep the pace
+    and to keep no more than concurrency of them in flight.
+    :param speed: 1.0 to send the calls at the pace they were captured, 2.0 twice as fast, None
+                  as fast as possible
+    :param connections: connections to host per program, the captured clients are spread over them
+    :return: {"calls": .., "errors": .., "elapsed": seconds, "max_lag": seconds the calls were
+              sent behind their schedule at worst}
+    """
+    clients = {}                # (prog, vers, connection) -> client
+    in_flight = set()
+    calls = errors = 0
+    max_lag = 0.0
+
+    def collect(done):
+        nonlocal errors
+        for future in done:
+            in_flight.discard(future)
+            if future.exception() is not None:
+                errors += 1
+
+    started = time.perf_counter()
+    try:
+        for call in read_capture(path):
+            if speed:
+                lag = time.perf_counter() - started - call.offset / speed
+                if lag < 0:
+                    time.sleep(-lag)
+                max_lag = max(max_lag, lag)
+            while len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            key = (call.prog, call.vers, call.client % connections)
+            client = clients.get(key)
+            if client is None:
+                if call.prog == rpc.PMAP_PROG:
+                    client = ReplayPortMapperClient(host, call.vers)
+                else:
+                    client = ReplayClient(host, call.prog, call.vers)
+                clients[key] = client
+            in_flight.add(client.replay_async(call))
+            calls += 1
+        collect(wait(in_flight)[0])
+    finally:
+        for client in clients.values():
+            client.close()
+    return {"calls": calls, "errors": errors, "elapsed": time.perf_counter() - started, "max_lag": max_lag}
+
+
+def summary(path):
+    """
+    :return: {(prog, vers, procedure name): number of calls} of a capture file
+    """
+    counts = {}
+    for call in read_capture(path):
+        key = (call.prog, call.vers, rpcmetrics.procedure_name(call.prog, call.vers, call.proc))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay or summarize an RPC capture file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='reissue the captured calls to a server')
+    replay_parser.add_argument('capture_file')
+    replay_parser.add_argument('host')
+    replay_parser.add_argument('--speed', default='1',
+                               help='how many times faster than captured, or "max" (default: 1)')
+    replay_parser.add_argument('--concurrency', type=int, default=16, help='calls in flight at most')
+    replay_parser.add_argument('--connections', type=int, default=1, help='connections per program')
+    replay_parser.add_argument('--metrics', action='store_true', help='print the RPC metrics afterwards')
+    summary_parser = commands.add_parser('summary', help='count the captured calls by procedure')
+    summary_parser.add_argument('capture_file')
+    arguments = parser.parse_args()
+    if arguments.command == 'summary':
+        for (prog, vers, procedure), number in sorted(summary(arguments.capture_file).items()):
+            program = rpcmetrics.PROGRAM_NAMES.get(prog, str(prog))
+            print(f'{program} v{vers} {procedure}: {number}')
+    else:
+        result = replay(arguments.capture_file, arguments.host,
+                        speed=None if arguments.speed == 'max' else float(arguments.speed),
+                        concurrency=arguments.concurrency, connections=arguments.connections)
+        print(f'{result["calls"]} calls, {result["errors"]} errors in {result["elapsed"]:.3f} s '
+              f'({result["calls"] / result["elapsed"]:.1f} calls/s), at most {result["max_lag"] * 1000:.1f} ms '
+              f'behind schedule')
+        if arguments.metrics:
+            print(rpcmetrics.metrics.prometheus(), end='')
@@ -0,0 +1,155 @@
+# Process-wide metrics of the RPC calls made by all clients.
+#
+# Every completed call is counted per (prog, vers, proc) and status, with its
+# latency in a histogram and the bytes it sent and received; UDP clients also
+# count their retransmissions. rpc.Client feeds rpcmetrics.metrics unless its
+# metrics attribute is set to None.
+#
+#     print(rpcmetrics.metrics.prometheus())
+
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from enum import Enum
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+PROGRAM_NAMES = {100000: 'portmap', 100003: 'nfs', 100005: 'mount', 100021: 'nlm'}
+
+# (prog, vers) -> procedure names
+PROCEDURE_NAMES = {
+    (100000, 2): ['NULL', 'SET', 'UNSET', 'GETPORT', 'DUMP', 'CALLIT'],
+    (100003, 3): ['NULL', 'GETATTR', 'SETATTR', 'LOOKUP', 'ACCESS', 'READLINK', 'READ', 'WRITE', 'CREATE',
+                  'MKDIR', 'SYMLINK', 'MKNOD', 'REMOVE', 'RMDIR', 'RENAME', 'LINK', 'READDIR', 'READDIRPLUS',
+                  'FSSTAT', 'FSINFO', 'PATHCONF', 'COMMIT'],
+    (100005, 3): ['NULL', 'MNT', 'DUMP', 'UMNT', 'UMNTALL', 'EXPORT'],
+    (100021, 4): ['NULL', 'TEST', 'LOCK', 'CANCEL', 'UNLOCK', 'GRANTED', 'TEST_MSG', 'LOCK_MSG', 'CANCEL_MSG',
+                  'UNLOCK_MSG', 'GRANTED_MSG', 'TEST_RES', 'LOCK_RES', 'CANCEL_RES', 'UNLOCK_RES',
+                  'GRANTED_RES'],
+}
+
+
+def procedure_name(prog, vers, proc):
+    names = PROCEDURE_NAMES.get((prog, vers), ())
+    return names[proc] if proc < len(names) else str(proc)
+
+
+def call_status(result=None, error=None):
+    """
+    Status label of a completed call: the name of the status enum a result leads with (e.g.
+    NFS3_OK) or an error carries (UnexpectedNfsStatus), otherwise OK or the error's type
+    """
+    if error is not None:
+        status = getattr(error, 'status', None)
+        return status.name if isinstance(status, Enum) else type(error).__name__
+    first = result[0] if isinstance(result, tuple) and result else result
+    return first.name if isinstance(first, Enum) else 'OK'
+
+
+class ProcedureMetrics:
+
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retransmits = 0
+
+    @property
+    def calls(self):
+        return sum(self.statuses.values())
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procedures = defaultdict(ProcedureMetrics)    # (prog, vers, proc) -> ProcedureMetrics
+
+    def observe(self, prog, vers, proc, latency, sent, received, status):
+        """
+        Record a completed call
+        :param latency: seconds from sending the call to its reply (or failure)
+        :param status: see call_status
+        """
+        bucket = bisect_left(LATENCY_BUCKETS, latency)
+        with self.lock:
+            procedure = self.procedures[(prog, vers, proc)]
+            procedure.statuses[status] += 1
+            procedure.buckets[bucket] += 1
+            procedure.latency_sum += latency
+            procedure.bytes_sent += sent
+            procedure.bytes_received += received
+
+    def retransmitted(self, prog, vers, proc):
+        with self.lock:
+            self.procedures[(prog, vers, proc)].retransmits += 1
+
+    def reset(self):
+        with self.lock:
+            self.procedures.clear()
+
+    def snapshot(self):
+        """
+        :return: {(prog, vers, proc): {"calls": .., "statuses": {status: count}, "latency_sum": ..,
+                  "latency_buckets": {upper bound: cumulative count}, "bytes_sent": ..,
+                  "bytes_received": .., "retransmits": ..}}
+        """
+        with self.lock:
+            snapshot = {}
+            for key, procedure in self.procedures.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), procedure.buckets):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                snapshot[key] = {"calls": procedure.calls,
+                                 "statuses": dict(procedure.statuses),
+                                 "latency_sum": procedure.latency_sum,
+                                 "latency_buckets": buckets,
+                                 "bytes_sent": procedure.bytes_sent,
+                                 "bytes_received": procedure.bytes_received,
+                                 "retransmits": procedure.retransmits}
+            return snapshot
+
+    def prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+
+        def family(name, metric_type, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+        def labels(key, **extra):
+            prog, vers, proc = key
+            pairs = dict(program=PROGRAM_NAMES.get(prog, str(prog)), prog=prog, vers=vers,
+                         procedure=procedure_name(prog, vers, proc), proc=proc, **extra)
+            return '{' + ','.join(f'{label}="{value}"' for label, value in pairs.items()) + '}'
+
+        family('rpc_calls_total', 'counter', 'Completed RPC calls by procedure and status')
+        for key, values in snapshot:
+            for status, count in sorted(values["statuses"].items()):
+                lines.append(f'rpc_calls_total{labels(key, status=status)} {count}')
+        family('rpc_call_duration_seconds', 'histogram', 'Time from sending an RPC call to its reply')
+        for key, values in snapshot:
+            for bound, count in values["latency_buckets"].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'rpc_call_duration_seconds_bucket{labels(key, le=le)} {count}')
+            lines.append(f'rpc_call_duration_seconds_sum{labels(key)} {values["latency_sum"]!r}')
+            lines.append(f'rpc_call_duration_seconds_count{labels(key)} {values["calls"]}')
+        for name, field, help_text in (('rpc_sent_bytes_total', 'bytes_sent', 'Bytes of RPC calls sent'),
+                                       ('rpc_received_bytes_total', 'bytes_received', 'Bytes of RPC replies received'),
+                                       ('rpc_retransmits_total', 'retransmits', 'RPC calls sent again after a timeout')):
+            family(name, 'counter', help_text)
+            for key, values in snapshot:
+                lines.append(f'{name}{labels(key)} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,386 @@
+# XDR encoding and decoding -- RFC 4506
+#
+# A drop-in replacement for the Packer and Unpacker of the standard library
+# xdrlib module (removed in Python 3.13), extended with compiled layouts:
+# a Struct describes a fixed-size XDR structure once, and is then packed or
+# unpacked with a single struct.Struct call instead of one method call per
+# field.
+
+import struct
+
+
+class Error(Exception):
+    pass
+
+
+class ConversionError(Error):
+    pass
+
+
+# Field types usable in a Struct layout
+UINT = 'uint'
+INT = 'int'
+ENUM = 'enum'
+BOOL = 'bool'
+UHYPER = 'uhyper'
+HYPER = 'hyper'
+
+# field type -> (struct format code, expression building the unpacked value)
+_FIELD_TYPES = {
+    UINT: ('I', '{}'),
+    INT: ('i', '{}'),
+    ENUM: ('i', '{}'),
+    BOOL: ('I', 'bool({})'),
+    UHYPER: ('Q', '{}'),
+    HYPER: ('q', '{}'),
+}
+
+_uint = struct.Struct('>I')
+_int = struct.Struct('>i')
+_uhyper = struct.Struct('>Q')
+_hyper = struct.Struct('>q')
+_float = struct.Struct('>f')
+_double = struct.Struct('>d')
+
+_TRUE = _uint.pack(1)
+_FALSE = _uint.pack(0)
+
+# Opaque data at least this large is kept by reference by Packer.pack_fopaque_ref, anything
+# smaller is cheaper to copy than to send as a separate buffer
+REFERENCE_THRESHOLD = 4096
+
+
+class Struct:
+    """
+    Compiled layout of a fixed-size XDR structure.
+    Fields are (name, type) pairs, where type is one of the field type constants above or another
+    Struct, which is unpacked as a nested tuple (e.g. nfstime3 inside fattr3).
+
+        nfstime3 = Struct('nfstime3', [('seconds', UINT), ('nseconds', UINT)])
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        codes, build, flatten = self._compile(fields, 'values', [0])
+        self.struct = struct.Struct('>' + codes)
+        self.size = self.struct.size
+        # The nesting is resolved once here, so (un)packing is a single generated expression
+        self.build = eval(f'lambda v: {build}')
+        self.flatten = eval(f'lambda values: ({"".join(e + ", " for e in flatten)})')
+
+    @staticmethod
+    def _compile(fields, path, index):
+        codes = ''
+        build = []
+        flatten = []
+        for position, (_, field_type) in enumerate(fields):
+            field_path = f'{path}[{position}]'
+            if isinstance(field_type, Struct):
+                sub_codes, sub_build, sub_flatten = Struct._compile(field_type.fields, field_path, index)
+                codes += sub_codes
+                build.append(sub_build)
+                flatten.extend(sub_flatten)
+            else:
+                code, expression = _FIELD_TYPES[field_type]
+                codes += code
+                build.append(expression.format(f'v[{index[0]}]'))
+                flatten.append(field_path)
+                index[0] += 1
+        return codes, '(' + ''.join(b + ', ' for b in build) + ')', flatten
+
+    def pack(self, values):
+        return self.struct.pack(*self.flatten(values))
+
+    def unpack_from(self, buffer, offset=0):
+        return self.build(self.struct.unpack_from(buffer, offset))
+
+    def __repr__(self):
+        return f'<xdr.Struct {self.name} {self.struct.format}>'
+
+
+class Packer:
+    """
+    Pack various data representations into a buffer.
+    Large opaque data can be packed by reference (pack_opaque_ref); the packed data is then a list
+    of buffers, see get_buffers().
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, data=b''):
+        """
+        :param data: already packed data to start with, e.g. a header template
+        """
+        self.buf = bytearray(data)
+        self.segments = []
+
+    def get_buffer(self):
+        if self.segments:
+            return b''.join(self.segments + [self.buf])
+        return bytes(self.buf)
+
+    def get_buffers(self):
+        """
+        The packed data without copying it: buffers to be sent one after the other, e.g. with
+        socket.sendmsg(). They reference the data packed by reference, which must not change
+        until they were sent.
+        """
+        return self.segments + [self.buf]
+
+    # backwards compatibility with xdrlib
+    get_buf = get_buffer
+
+    def pack_uint(self, x):
+        try:
+            self.buf += _uint.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    def pack_int(self, x):
+        try:
+            self.buf += _int.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    pack_enum = pack_int
+
+    def pack_bool(self, x):
+        self.buf += _TRUE if x else _FALSE
+
+    def pack_uhyper(self, x):
+        try:
+            self.buf += _uhyper.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    def pack_hyper(self, x):
+        try:
+            self.buf += _hyper.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    def pack_float(self, x):
+        try:
+            self.buf += _float.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    def pack_double(self, x):
+        try:
+            self.buf += _double.pack(x)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+    def pack_fstring(self, n, s):
+        if n < 0:
+            raise ValueError('fstring size must be nonnegative')
+        data = s[:n]
+        self.buf += data
+        self.buf += bytes(((n + 3) // 4) * 4 - len(data))
+
+    pack_fopaque = pack_fstring
+
+    def pack_string(self, s):
+        n = len(s)
+        self.pack_uint(n)
+        self.pack_fstring(n, s)
+
+    pack_opaque = pack_string
+    pack_bytes = pack_string
+
+    def pack_fopaque_ref(self, n, data):
+        """
+        Like pack_fopaque, but large data (any bytes-like object) is referenced instead of being
+        copied into the buffer
+        """
+        if n < 0:
+            raise ValueError('fopaque size must be nonnegative')
+        view = memoryview(data).cast('B')[:n]
+        if len(view) < REFERENCE_THRESHOLD:
+            self.pack_fopaque(n, view)
+            return
+        self.segments.append(self.buf)
+        self.segments.append(view)
+        self.buf = bytearray(((n + 3) // 4) * 4 - len(view))
+
+    def pack_opaque_ref(self, data):
+        n = memoryview(data).nbytes
+        self.pack_uint(n)
+        self.pack_fopaque_ref(n, data)
+
+    def pack_list(self, list, pack_item):
+        for item in list:
+            self.buf += _TRUE
+            pack_item(item)
+        self.buf += _FALSE
+
+    def pack_farray(self, n, list, pack_item):
+        if len(list) != n:
+            raise ValueError('wrong array size')
+        for item in list:
+            pack_item(item)
+
+    def pack_array(self, list, pack_item):
+        n = len(list)
+        self.pack_uint(n)
+        self.pack_farray(n, list, pack_item)
+
+    def pack_struct(self, layout, values):
+        try:
+            self.buf += layout.pack(values)
+        except struct.error as e:
+            raise ConversionError(e.args[0]) from None
+
+
+class Unpacker:
+    """
+    Unpacks various data representations from the given buffer.
+    The buffer may be a memoryview on a reused receive buffer, so every string and opaque handed
+    out is copied into its own bytes object.
+    """
+
+    def __init__(self, data):
+        self.reset(data)
+
+    def reset(self, data):
+        self.buf = data
+        self.pos = 0
+
+    def get_position(self):
+        return self.pos
+
+    def set_position(self, position):
+        self.pos = position
+
+    def get_buffer(self):
+        return self.buf
+
+    def done(self):
+        if self.pos < len(self.buf):
+            raise Error('unextracted data remains')
+
+    def unpack_uint(self):
+        try:
+            x, = _uint.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 4
+        return x
+
+    def unpack_int(self):
+        try:
+            x, = _int.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 4
+        return x
+
+    unpack_enum = unpack_int
+
+    def unpack_bool(self):
+        return bool(self.unpack_int())
+
+    def unpack_uhyper(self):
+        try:
+            x, = _uhyper.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 8
+        return x
+
+    def unpack_hyper(self):
+        try:
+            x, = _hyper.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 8
+        return x
+
+    def unpack_float(self):
+        try:
+            x, = _float.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 4
+        return x
+
+    def unpack_double(self):
+        try:
+            x, = _double.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += 8
+        return x
+
+    def unpack_fstring(self, n):
+        if n < 0:
+            raise ValueError('fstring size must be nonnegative')
+        i = self.pos
+        j = i + (n + 3) // 4 * 4
+        if j > len(self.buf):
+            raise EOFError
+        self.pos = j
+        return bytes(self.buf[i:i + n])
+
+    unpack_fopaque = unpack_fstring
+
+    def unpack_string(self):
+        n = self.unpack_uint()
+        return self.unpack_fstring(n)
+
+    def unpack_fopaque_into(self, n, buffer):
+        """
+        Copy fixed-length opaque data straight into buffer (a writable bytes-like object) instead
+        of returning a new bytes object
+        """
+        if n < 0:
+            raise ValueError('fopaque size must be nonnegative')
+        i = self.pos
+        j = i + (n + 3) // 4 * 4
+        if j > len(self.buf):
+            raise EOFError
+        view = memoryview(buffer).cast('B')
+        if n > len(view):
+            raise ConversionError(f'{n} bytes of opaque data do not fit into {len(view)} bytes')
+        view[:n] = self.buf[i:i + n]
+        self.pos = j
+        return n
+
+    def unpack_opaque_into(self, buffer):
+        n = self.unpack_uint()
+        return self.unpack_fopaque_into(n, buffer)
+
+    unpack_opaque = unpack_string
+    unpack_bytes = unpack_string
+
+    def unpack_list(self, unpack_item):
+        list = []
+        while 1:
+            x = self.unpack_uint()
+            if x == 0:
+                break
+            if x != 1:
+                raise ConversionError(f'0 or 1 expected, got {x!r}')
+            item = unpack_item()
+            list.append(item)
+        return list
+
+    def unpack_farray(self, n, unpack_item):
+        list = []
+        for i in range(n):
+            list.append(unpack_item())
+        return list
+
+    def unpack_array(self, unpack_item):
+        n = self.unpack_uint()
+        return self.unpack_farray(n, unpack_item)
+
+    def unpack_struct(self, layout):
+        try:
+            values = layout.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise EOFError from None
+        self.pos += layout.size
+        return values